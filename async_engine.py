@@ -0,0 +1,278 @@
+import asyncio
+import subprocess
+import threading
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from utils import DownloadCancelled
+
+# Number of blocking calls (pytube lookups, file writes, hashing) run at the same time. Transfers
+# and ffmpeg pipes are tasks of the event loop and don't count against it.
+DEFAULT_BLOCKING_WORKERS = 32
+
+# States of a job.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMED_OUT = "timed_out"
+
+
+class EngineJob:
+    """Handle on a download run by the engine: wait for its result, cancel it, or be told when it ends."""
+
+    def __init__(self, engine: "AsyncEngine", create_strategy, link: str = None, timeout: float = None) -> None:
+        """
+        :param create_strategy: Callable returning the job's `IDownloadStrategy`; called in the
+                                engine's workers, as building a playlist strategy fetches its first page.
+        :param link: (optional) Link the job downloads.
+        :param timeout: (optional) Seconds the job may run once started before it is stopped.
+        """
+        self.link = link
+        self.timeout = timeout
+        self.status = QUEUED
+        self.strategy = None
+        self._engine = engine
+        self._create_strategy = create_strategy
+        self._future = Future()
+        self._task = None
+        self._cancel_requested = False
+
+    def result(self, timeout: float = None):
+        """
+        Wait for the job and return what the strategy's `download()` returned.
+
+        :raises DownloadCancelled: If the job was cancelled.
+        :raises TimeoutError: If the job ran longer than its timeout.
+        """
+        return self._future.result(timeout)
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def add_done_callback(self, fn) -> None:
+        """Call `fn(job)` once the job has ended, at once if it already has."""
+        self._future.add_done_callback(lambda _: fn(self))
+
+    def cancel(self) -> bool:
+        """
+        Stop the job. Its task is cancelled at once, which stops its transfers and ffmpeg runs;
+        a blocking call of the strategy already running in a worker stops at its next step.
+
+        :return: False if the job had already ended.
+        """
+        if self._future.done():
+            return False
+        self._cancel_requested = True
+        if self.strategy:
+            self.strategy.cancel()
+        self._engine.loop.call_soon_threadsafe(self._cancel_task)
+        return True
+
+    def _cancel_task(self) -> None:
+        if self._task:
+            self._task.cancel()
+        else:
+            self._settle(CANCELLED, self._future.set_exception, DownloadCancelled())
+
+    def _settle(self, status: str, method, value) -> None:
+        try:
+            method(value)
+            self.status = status
+        except InvalidStateError:
+            pass  # Already settled.
+
+
+class AsyncEngine:
+    """
+    Helper class responsible for running download jobs as tasks on one asyncio event loop,
+    in a thread of its own.
+
+    The transfers of a job are tasks of the loop: range requests over asyncio connections,
+    feeding ffmpeg through pipes of asyncio subprocesses, and backing off between failed
+    attempts. The engine's bounded pool of workers, the loop's default executor, only runs what
+    blocks: pytube lookups, file writes and hashing. Hundreds of jobs can be queued at once at the
+    cost of a task each, and up to `max_jobs` of them run at the same time. Each job can be
+    cancelled or given a timeout.
+    """
+
+    def __init__(self, blocking_workers: int = DEFAULT_BLOCKING_WORKERS, max_jobs: int = None) -> None:
+        """
+        :param blocking_workers: Number of blocking calls run at the same time.
+        :param max_jobs: (optional) Number of jobs run at the same time. None means no limit.
+        """
+        self.blocking_workers = blocking_workers
+        self.max_jobs = max_jobs
+        self._loop = None
+        self._executor = None
+        self._job_slots = None
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def configure(self, blocking_workers: int = DEFAULT_BLOCKING_WORKERS, max_jobs: int = None) -> None:
+        """Resize the worker pool and the number of jobs run at once; calls already running finish on the old workers."""
+        with self._lock:
+            self.blocking_workers = max(1, blocking_workers)
+            self.max_jobs = max(1, max_jobs) if max_jobs else None
+            self._job_slots = None
+            if self._executor:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+                if self._loop:
+                    self._loop.set_default_executor(self._new_executor())
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """The engine's event loop, started on first use."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                # `run_in_executor(None, ...)` of the transfers runs in the engine's bounded pool.
+                self._loop.set_default_executor(self._executor or self._new_executor())
+                threading.Thread(target=self._loop.run_forever, name="download-engine", daemon=True).start()
+            return self._loop
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """The bounded pool the blocking calls run in."""
+        self.loop  # Creates the pool along with the loop.
+        with self._lock:
+            if self._executor is None:
+                self._loop.set_default_executor(self._new_executor())
+            return self._executor
+
+    def _new_executor(self) -> ThreadPoolExecutor:
+        # The caller holds `_lock`.
+        self._executor = ThreadPoolExecutor(max_workers=self.blocking_workers, thread_name_prefix="engine")
+        return self._executor
+
+    def submit(self, create_strategy, link: str = None, timeout: float = None) -> EngineJob:
+        """
+        Queue a download and return its job at once.
+
+        :param create_strategy: Callable returning the job's `IDownloadStrategy`.
+        :param link: (optional) Link the job downloads.
+        :param timeout: (optional) Seconds the job may run once started before it is stopped.
+        """
+        job = EngineJob(self, create_strategy, link, timeout)
+        self.loop.call_soon_threadsafe(self._start, job)
+        return job
+
+    def call(self, fn, *args, **kwargs) -> Future:
+        """Run the blocking `fn(*args, **kwargs)` in the engine's workers and return its future."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def run(self, coroutine):
+        """
+        Run `coroutine` on the engine's loop and wait for its result, for callers outside the
+        loop such as `IDownloadStrategy.download()`.
+        """
+        loop = self.loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coroutine.close()
+            raise RuntimeError("AsyncEngine.run() would block the engine's own loop; await the coroutine instead")
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    @asynccontextmanager
+    async def process(self, cmd: list, **kwargs):
+        """
+        Start `cmd` as a subprocess of the loop for the duration of the block. The process is
+        killed if it is still running when the block exits, e.g. because its task was cancelled,
+        and terminated if the engine is shut down meanwhile.
+
+        :param kwargs: Passed on to `asyncio.create_subprocess_exec`, e.g. `pass_fds`.
+        """
+        kwargs.setdefault("stdin", subprocess.DEVNULL)
+        process = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+        self._processes.add(process)
+        try:
+            yield process
+        finally:
+            self._processes.discard(process)
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    async def run_process(self, cmd: list) -> int:
+        """
+        Run `cmd` as a subprocess of the loop and wait for it to exit.
+
+        :return: The exit status of the process.
+        """
+        async with self.process(cmd) as process:
+            return await process.wait()
+
+    def shutdown(self) -> None:
+        """Cancel every job still running and stop the ffmpeg processes they started."""
+        if self._loop is None:
+            return
+
+        def stop():
+            for task in asyncio.all_tasks(self._loop):
+                task.cancel()
+            for process in list(self._processes):
+                if process.returncode is None:
+                    process.terminate()
+        self._loop.call_soon_threadsafe(stop)
+
+    def _start(self, job: EngineJob) -> None:
+        if job.done():
+            return
+        job._task = self._loop.create_task(self._run(job))
+        job._task.add_done_callback(lambda task: self._task_done(job, task))
+
+    async def _run(self, job: EngineJob):
+        if self.max_jobs and self._job_slots is None:
+            self._job_slots = asyncio.Semaphore(self.max_jobs)
+        job_slots = self._job_slots
+        if job_slots:
+            await job_slots.acquire()
+        job.status = RUNNING
+        try:
+            return await asyncio.wait_for(self._download(job), job.timeout)
+        except asyncio.TimeoutError:
+            self._stop_strategy(job)
+            raise TimeoutError(f"Timed out after {job.timeout:g}s") from None
+        except asyncio.CancelledError:
+            self._stop_strategy(job)
+            raise
+        finally:
+            if job_slots:
+                job_slots.release()
+
+    @staticmethod
+    def _stop_strategy(job: EngineJob) -> None:
+        # A blocking call of the strategy keeps running in its worker after the task is cancelled; have it stop too.
+        if job.strategy:
+            job.strategy.cancel()
+
+    async def _download(self, job: EngineJob):
+        loop = asyncio.get_running_loop()
+        job.strategy = await loop.run_in_executor(None, job._create_strategy)
+        if job._cancel_requested:
+            job.strategy.cancel()
+            raise DownloadCancelled()
+        download_async = getattr(job.strategy, "download_async", None)
+        if download_async:
+            return await download_async()
+        # Strategies without a coroutine of their own run in a worker.
+        return await loop.run_in_executor(None, job.strategy.download)
+
+    @staticmethod
+    def _task_done(job: EngineJob, task: asyncio.Task) -> None:
+        if task.cancelled():
+            job._settle(CANCELLED, job._future.set_exception, DownloadCancelled())
+        elif task.exception():
+            error = task.exception()
+            status = CANCELLED if isinstance(error, DownloadCancelled) else TIMED_OUT if isinstance(error, TimeoutError) else FAILED
+            job._settle(status, job._future.set_exception, error)
+        else:
+            job._settle(DONE, job._future.set_result, task.result())
+
+
+# Engine shared by every download of the process: one event loop and one bounded worker pool.
+download_engine = AsyncEngine()
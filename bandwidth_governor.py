@@ -0,0 +1,201 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+# How many seconds worth of the rate limit can be spent in one burst after an idle period.
+DEFAULT_BURST_SECONDS = 1.0
+
+# How often coroutines waiting for a connection or their share of the rate check again, in
+# seconds at most. They can't wait on the condition the threads wait on without blocking the loop.
+ASYNC_POLL_INTERVAL = 0.05
+
+
+def parse_rate(text: str) -> float:
+    """
+    Parse a rate such as `500K`, `2.5M` or `1G` (bytes per second, powers of 1024).
+
+    :return: The rate in bytes per second, or None for `0`, `none` or `unlimited`.
+    :raises ValueError: If the text isn't a rate.
+    """
+    text = text.strip().upper() if text else ""
+    if text.endswith("/S"):
+        text = text[:-2]
+    if text.endswith("B"):
+        text = text[:-1]
+    if text in ("", "0", "NONE", "UNLIMITED"):
+        return None
+    multipliers = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text[-1] in multipliers:
+        return float(text[:-1]) * multipliers[text[-1]]
+    return float(text)
+
+
+class BandwidthGovernor:
+    """
+    Helper class responsible for sharing bandwidth and connections between every transfer of
+    the process: stream ranges, sequential streams, piped merges and thumbnails.
+
+    Bandwidth is limited with a token bucket. While the limit is reached, waiting transfers are
+    served one job at a time in turn, so a job fetching over eight connections gets the same
+    share as a job fetching over one. Both the rate and the connection cap can be changed while
+    transfers are running.
+    """
+
+    def __init__(self, rate: float = None, max_connections: int = None, burst_seconds: float = DEFAULT_BURST_SECONDS) -> None:
+        """
+        :param rate: (optional) Bandwidth limit in bytes per second. None means unlimited.
+        :param max_connections: (optional) Number of transfers open at the same time. None means unlimited.
+        :param burst_seconds: Seconds worth of `rate` that may be spent at once after an idle period.
+        """
+        self._condition = threading.Condition()
+        self._rate = rate
+        self._max_connections = max_connections
+        self.burst_seconds = burst_seconds
+        self._tokens = self._capacity()
+        self._last_refill = time.monotonic()
+        self._open_connections = 0
+        # Waiting transfers, grouped by job in the order the jobs get their turn.
+        self._waiting = OrderedDict()
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    @property
+    def max_connections(self) -> int:
+        return self._max_connections
+
+    @property
+    def open_connections(self) -> int:
+        return self._open_connections
+
+    def set_rate(self, rate: float = None) -> None:
+        """Change the bandwidth limit, in bytes per second. None removes it."""
+        with self._condition:
+            self._refill()
+            self._rate = rate
+            self._tokens = min(self._tokens, self._capacity())
+            self._condition.notify_all()
+
+    def set_max_connections(self, max_connections: int = None) -> None:
+        """Change the cap on open transfers. None removes it."""
+        with self._condition:
+            self._max_connections = max_connections
+            self._condition.notify_all()
+
+    @contextmanager
+    def connection(self):
+        """Hold one of the `max_connections` transfer slots for the duration of the block."""
+        with self._condition:
+            while not self._has_free_connection():
+                self._condition.wait()
+            self._open_connections += 1
+        try:
+            yield
+        finally:
+            self._close_connection()
+
+    @asynccontextmanager
+    async def connection_async(self):
+        """`connection()` for coroutines of an event loop, which wait for a slot without blocking the loop."""
+        while True:
+            with self._condition:
+                if self._has_free_connection():
+                    self._open_connections += 1
+                    break
+            await asyncio.sleep(ASYNC_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self._close_connection()
+
+    def throttle(self, byte_count: int, job_id=None) -> None:
+        """
+        Account for `byte_count` transferred bytes, blocking while the job is over its share of the rate.
+
+        :param byte_count: Number of bytes just transferred (or about to be).
+        :param job_id: (optional) Identifies the job the transfer belongs to, for fair sharing.
+        """
+        with self._condition:
+            if self._rate is None:
+                return
+            ticket = self._join_line(job_id)
+            try:
+                while True:
+                    wait = self._spend(byte_count, job_id, ticket)
+                    if wait is None:
+                        return
+                    self._condition.wait(timeout=min(wait, 0.5))
+            finally:
+                self._leave_line(job_id, ticket)
+
+    async def throttle_async(self, byte_count: int, job_id=None) -> None:
+        """`throttle()` for coroutines of an event loop, which wait for their turn without blocking the loop."""
+        with self._condition:
+            if self._rate is None:
+                return
+            ticket = self._join_line(job_id)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._spend(byte_count, job_id, ticket)
+                if wait is None:
+                    return
+                await asyncio.sleep(min(max(wait, 0.001), ASYNC_POLL_INTERVAL))
+        finally:
+            with self._condition:
+                self._leave_line(job_id, ticket)
+
+    def _has_free_connection(self) -> bool:
+        return self._max_connections is None or self._open_connections < self._max_connections
+
+    def _close_connection(self) -> None:
+        with self._condition:
+            self._open_connections -= 1
+            self._condition.notify_all()
+
+    def _join_line(self, job_id):
+        ticket = object()
+        self._waiting.setdefault(job_id, deque()).append(ticket)
+        return ticket
+
+    def _spend(self, byte_count: int, job_id, ticket):
+        """
+        Spend `byte_count` tokens if it is the ticket's turn and the bucket isn't empty. Called
+        with the condition held.
+
+        :return: None once spent, else the seconds to wait before trying again.
+        """
+        if self._rate is None:
+            return None
+        self._refill()
+        first_job, first_tickets = next(iter(self._waiting.items()))
+        if first_job == job_id and first_tickets[0] is ticket and self._tokens > 0:
+            # Spending may take the bucket below zero; the next transfers wait until it is repaid.
+            self._tokens -= byte_count
+            return None
+        return max(-self._tokens, 1) / self._rate
+
+    def _leave_line(self, job_id, ticket) -> None:
+        tickets = self._waiting[job_id]
+        tickets.remove(ticket)
+        # The job goes to the back of the line, or leaves it if it has nothing else waiting.
+        del self._waiting[job_id]
+        if tickets:
+            self._waiting[job_id] = tickets
+        self._condition.notify_all()
+
+    def _capacity(self) -> float:
+        return self._rate * self.burst_seconds if self._rate else 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self._rate:
+            self._tokens = min(self._capacity(), self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+
+
+# Governor shared by every download of the process. Unlimited until configured.
+governor = BandwidthGovernor()
@@ -0,0 +1,172 @@
+"""
+Offline stand-in for the network side of YouTube: a local HTTP server serving synthetic DASH
+payloads, and stubbed metadata for the shared metadata cache that points at it.
+"""
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from metadata_cache import CachedVideo, CachedPlaylist, metadata_cache
+
+# itag, mime type and resolution of the synthetic streams, taken from YouTube's own itag table.
+VIDEO_FORMAT = (137, 'video/mp4; codecs="avc1.640028"', "1080p")
+AUDIO_FORMAT = (140, 'audio/mp4; codecs="mp4a.40.2"', None)
+
+SEND_BLOCK_SIZE = 16 * 1024
+
+
+class FakeStreamHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files of `server.payload_dir` with Range support, either as a `Range` header
+    (segmented downloads) or as pytube's `range=` query parameter (sequential downloads).
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        path = os.path.join(self.server.payload_dir, os.path.basename(parts.path))
+        if not os.path.isfile(path):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        header_range = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        query_range = parse_qs(parts.query).get("range")
+        if header_range:
+            start = int(header_range.group(1))
+            end = int(header_range.group(2)) if header_range.group(2) else end
+        elif query_range:
+            first, last = query_range[0].split("-")
+            start, end = int(first), int(last)
+        end = min(end, size - 1)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.send_response(206 if header_range else 200)
+        if header_range:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.end_headers()
+        self._send_file(path, start, end)
+
+    def _send_file(self, path: str, start: int, end: int) -> None:
+        """Send bytes start..end, pacing each connection to `server.connection_rate` if set."""
+        began = time.monotonic()
+        sent = 0
+        with open(path, "rb") as fh:
+            fh.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = fh.read(min(SEND_BLOCK_SIZE, remaining))
+                try:
+                    self.wfile.write(block)
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                remaining -= len(block)
+                sent += len(block)
+                if self.server.connection_rate:
+                    ahead = sent / self.server.connection_rate - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeStreamServer(ThreadingHTTPServer):
+    """Local stream server with a configurable response latency and per-connection throttle."""
+    daemon_threads = True
+    # Playlists open dozens of range connections at once; the default backlog of 5 drops some of
+    # their SYNs, which stalls them for the 1s retransmit where a real CDN would accept them.
+    request_queue_size = 128
+
+    def __init__(self, payload_dir: str, latency: float = 0.0, connection_rate: float = None) -> None:
+        """
+        :param payload_dir: Directory of the files served.
+        :param latency: Seconds waited before answering each request.
+        :param connection_rate: (optional) Bytes per second sent on each connection.
+        """
+        super().__init__(("127.0.0.1", 0), FakeStreamHandler)
+        self.payload_dir = payload_dir
+        self.latency = latency
+        self.connection_rate = connection_rate
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self) -> "FakeStreamServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def make_payloads(payload_dir: str, video_size: int, audio_size: int) -> dict:
+    """
+    Create the synthetic video and audio payloads.
+
+    With ffmpeg available they are real fragmented MP4 streams of about the requested sizes, so
+    the merge step can run on them. Without it they are random bytes: transfers can still be
+    measured, merges can't.
+
+    :return: Dict with the `video` and `audio` file names, their actual `video_size` and
+             `audio_size`, and whether they are `mergeable`.
+    """
+    os.makedirs(payload_dir, exist_ok=True)
+    mergeable = shutil.which("ffmpeg") is not None
+    extension = "mp4" if mergeable else "bin"
+    video_name, audio_name = f"video_{video_size}.{extension}", f"audio_{audio_size}.{extension}"
+    video_path, audio_path = os.path.join(payload_dir, video_name), os.path.join(payload_dir, audio_name)
+    # Payloads of an earlier run with the same sizes are reused.
+    if not (os.path.exists(video_path) and os.path.exists(audio_path)):
+        if mergeable:
+            duration = 10
+            common = ["ffmpeg", "-loglevel", "error", "-y", "-t", str(duration)]
+            fragmented = ["-movflags", "frag_keyframe+empty_moov+default_base_moof"]
+            subprocess.run(common + ["-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=25", "-c:v", "mpeg4",
+                                     "-b:v", str(video_size * 8 // duration), "-an"] + fragmented + [video_path], check=True)
+            subprocess.run(common + ["-f", "lavfi", "-i", "anoisesrc=color=pink", "-c:a", "aac",
+                                     "-b:a", str(audio_size * 8 // duration)] + fragmented + [audio_path], check=True)
+        else:
+            for path, size in ((video_path, video_size), (audio_path, audio_size)):
+                with open(path, "wb") as fh:
+                    fh.write(os.urandom(size))
+    return {"video": video_name, "audio": audio_name, "mergeable": mergeable,
+            "video_size": os.path.getsize(video_path), "audio_size": os.path.getsize(audio_path)}
+
+
+def fake_video_id(index: int) -> str:
+    """Return a valid-looking 11 character video ID for the index-th synthetic video."""
+    return f"bench{index:06d}"
+
+
+def fake_watch_url(index: int) -> str:
+    return f"https://www.youtube.com/watch?v={fake_video_id(index)}"
+
+
+def stub_metadata(base_url: str, payloads: dict, video_count: int = 1, playlist_id: str = "PLbenchmark") -> str:
+    """
+    Put synthetic videos and a playlist of them into the shared metadata cache, so the download
+    strategies resolve them without touching YouTube.
+
+    :return: The playlist link.
+    """
+    for index in range(video_count):
+        manifest = []
+        for kind, (itag, mime_type, _) in (("video", VIDEO_FORMAT), ("audio", AUDIO_FORMAT)):
+            manifest.append({"url": f"{base_url}/{payloads[kind]}?id={fake_video_id(index)}", "itag": itag,
+                             "mimeType": mime_type, "is_otf": False, "bitrate": 0,
+                             "contentLength": str(payloads[f"{kind}_size"])})
+        metadata_cache.put(CachedVideo(video_id=fake_video_id(index), title=f"Benchmark video {index + 1}",
+                                       thumbnail_url=f"{base_url}/thumbnail.jpg", manifest=manifest))
+    metadata_cache.put(CachedPlaylist(playlist_id=playlist_id, title="Benchmark playlist",
+                                      video_urls=[fake_watch_url(index) for index in range(video_count)]))
+    return f"https://www.youtube.com/playlist?list={playlist_id}"
@@ -0,0 +1,301 @@
+"""
+Offline benchmarks of the download pipeline, run against a local fake stream server.
+
+    python -m benchmarks.run_benchmarks --video-size 32M --audio-size 4M --playlist-videos 6
+    python -m benchmarks.run_benchmarks --latency 0.05 --connection-rate 2M --scenario video-streaming
+    python -m benchmarks.run_benchmarks --compare
+
+Every scenario runs in a fresh interpreter so its peak RSS and disk writes are its own. Results
+are appended to a JSON lines file with the git commit they were measured on, and `--compare`
+shows how the last two runs of each scenario differ.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_youtube import FakeStreamServer, make_payloads, stub_metadata, fake_watch_url
+from bandwidth_governor import parse_rate
+from progress import ProgressChannel, format_bytes
+
+SCENARIOS = ("startup", "video-streaming", "video-tempfiles", "playlist", "qualities", "merge")
+
+# Modules the entry points must not import until they are needed.
+HEAVY_MODULES = ("pytube", "PIL", "win32com")
+
+# Run in a fresh interpreter by the startup scenario: import the headless entry points and report
+# how long that took and which heavy modules came along.
+STARTUP_PROBE = f"""
+import sys, time
+start = time.perf_counter()
+import cli, server
+print(time.perf_counter() - start)
+print(",".join(module for module in {HEAVY_MODULES!r} if module in sys.modules))
+"""
+
+DEFAULT_RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.jsonl")
+DEFAULT_PAYLOAD_DIR = os.path.join(tempfile.gettempdir(), "youtube_downloader_benchmarks")
+
+# Metrics shown by --compare, with whether a higher value is the better one.
+COMPARED_METRICS = {"throughput": True, "elapsed": False, "ttfb": False, "merge_time": False,
+                    "startup_seconds": False, "import_seconds": False, "peak_rss": False, "disk_bytes_written": False}
+
+
+class TimingChannel(ProgressChannel):
+    """Progress channel that remembers when the first downloaded bytes were reported."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.first_byte_at = None
+
+    def post(self, job_id: str, bytes_done: int, total: int, rate: float = 0.0) -> None:
+        if bytes_done and self.first_byte_at is None:
+            self.first_byte_at = time.perf_counter()
+        super().post(job_id, bytes_done, total, rate)
+
+
+def disk_bytes_written() -> int:
+    """Bytes this process and its waited-for children (ffmpeg) wrote to storage so far, if known."""
+    written = None
+    try:
+        with open("/proc/self/io") as fh:
+            for line in fh:
+                if line.startswith("write_bytes:"):
+                    written = int(line.split()[1])
+    except OSError:
+        pass
+    if written is None:
+        written = resource.getrusage(resource.RUSAGE_SELF).ru_oublock * 512
+    return written + resource.getrusage(resource.RUSAGE_CHILDREN).ru_oublock * 512
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def folder_size(folder: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(folder) for name in names)
+
+
+def run_scenario(name: str, base_url: str, payloads: dict, params: dict, folder: str) -> dict:
+    """Run one scenario in this process and return its metrics."""
+    from async_engine import download_engine
+    from strategies import VideoDownloadStrategy, PlaylistDownloadStrategy
+    from utils import FileMerger, get_available_qualities
+    from metadata_cache import metadata_cache
+
+    playlist_link = stub_metadata(base_url, payloads, video_count=max(params["playlist_videos"], 1))
+    quality = "1080p"
+    metrics = {}
+    merge_times = []
+
+    # Time the temp file merges wherever the strategies run them.
+    original_merge = FileMerger.merge
+
+    async def timed_merge(self, *args, **kwargs):
+        merge_start = time.perf_counter()
+        try:
+            return await original_merge(self, *args, **kwargs)
+        finally:
+            merge_times.append(time.perf_counter() - merge_start)
+
+    FileMerger.merge = timed_merge
+
+    channel = TimingChannel()
+    written_before = disk_bytes_written()
+    start = time.perf_counter()
+    if name in ("video-streaming", "video-tempfiles"):
+        strategy = VideoDownloadStrategy(fake_watch_url(0), folder, quality, lambda *args: None,
+                                         streaming_merge=name == "video-streaming", progress_channel=channel)
+        metrics["succeeded"] = strategy.download()
+        metrics["bytes"] = strategy.bytes_downloaded
+    elif name == "playlist":
+        strategy = PlaylistDownloadStrategy(playlist_link, folder, quality, lambda *args: None,
+                                            max_workers=params["playlist_workers"], progress_channel=channel)
+        results = strategy.download()
+        metrics["succeeded"] = bool(results) and all(item[2] for item in results)
+        metrics["bytes"] = strategy.bytes_downloaded
+    elif name == "qualities":
+        timings = {}
+        for label, link in (("video", fake_watch_url(0)), ("playlist", playlist_link)):
+            link_start = time.perf_counter()
+            for _ in range(params["repeat"]):
+                qualities = get_available_qualities(link)
+            timings[label] = (time.perf_counter() - link_start) / params["repeat"]
+            metrics["succeeded"] = metrics.get("succeeded", True) and qualities == [quality]
+        metrics["seconds_per_call"] = timings
+    elif name == "startup":
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        startup_times, import_times = [], []
+        for _ in range(params["repeat"]):
+            launch_start = time.perf_counter()
+            subprocess.run([sys.executable, "cli.py", "--help"], cwd=repo_dir, stdout=subprocess.DEVNULL, check=True)
+            startup_times.append(time.perf_counter() - launch_start)
+        for _ in range(params["repeat"]):
+            probe = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=repo_dir, capture_output=True, text=True, check=True)
+            import_time, heavy_modules = probe.stdout.splitlines()
+            import_times.append(float(import_time))
+        # Medians, since a single slow launch says more about the machine than about the code.
+        metrics["startup_seconds"] = statistics.median(startup_times)
+        metrics["import_seconds"] = statistics.median(import_times)
+        metrics["heavy_modules"] = [module for module in heavy_modules.split(",") if module]
+        metrics["succeeded"] = not metrics["heavy_modules"]
+    elif name == "merge":
+        if not payloads["mergeable"]:
+            return {"skipped": "ffmpeg is not available, the payloads can't be merged"}
+        video_copy = shutil.copy(os.path.join(params["payload_dir"], payloads["video"]), os.path.join(folder, "video_"))
+        audio_copy = shutil.copy(os.path.join(params["payload_dir"], payloads["audio"]), os.path.join(folder, "audio_"))
+        merger = FileMerger(metadata_cache.get_video(fake_watch_url(0)), folder, quality)
+        written_before, start = disk_bytes_written(), time.perf_counter()
+        metrics["succeeded"] = download_engine.run(merger.merge(video_filename=video_copy, audio_filename=audio_copy)) is not None
+    elapsed = time.perf_counter() - start
+
+    metrics["elapsed"] = elapsed
+    if metrics.get("bytes"):
+        metrics["throughput"] = metrics["bytes"] / elapsed
+    if channel.first_byte_at is not None:
+        metrics["ttfb"] = channel.first_byte_at - start
+    if merge_times:
+        metrics["merge_time"] = sum(merge_times)
+    metrics["peak_rss"] = peak_rss()
+    metrics["disk_bytes_written"] = disk_bytes_written() - written_before
+    metrics["output_bytes"] = folder_size(folder)
+    return metrics
+
+
+def run_isolated(name: str, base_url: str, payloads: dict, params: dict) -> dict:
+    """Run a scenario in a fresh interpreter and return its metrics."""
+    folder = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    spec = json.dumps({"name": name, "base_url": base_url, "payloads": payloads, "params": params, "folder": folder})
+    try:
+        completed = subprocess.run([sys.executable, "-m", "benchmarks.run_benchmarks", "--worker", spec],
+                                   stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        lines = completed.stdout.strip().splitlines()
+        if completed.returncode != 0 or not lines:
+            return {"error": f"scenario exited with status {completed.returncode}"}
+        return json.loads(lines[-1])
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def load_results(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def describe(metrics: dict) -> str:
+    """Describe a scenario's metrics in one line."""
+    if "skipped" in metrics or "error" in metrics:
+        return metrics.get("skipped") or metrics["error"]
+    parts = [f"{metrics['elapsed']:.2f}s"]
+    if "throughput" in metrics:
+        parts.append(f"{format_bytes(metrics['throughput'])}/s")
+    if "ttfb" in metrics:
+        parts.append(f"TTFB {metrics['ttfb'] * 1000:.0f}ms")
+    if "merge_time" in metrics:
+        parts.append(f"merge {metrics['merge_time']:.2f}s")
+    if "startup_seconds" in metrics:
+        parts.append(f"cli --help {metrics['startup_seconds'] * 1000:.0f}ms, imports {metrics['import_seconds'] * 1000:.0f}ms")
+        if metrics["heavy_modules"]:
+            parts.append(f"loaded at startup: {', '.join(metrics['heavy_modules'])}")
+    if "seconds_per_call" in metrics:
+        parts += [f"{label} {seconds * 1000:.2f}ms/call" for label, seconds in metrics["seconds_per_call"].items()]
+    parts.append(f"peak RSS {format_bytes(metrics['peak_rss'])}")
+    parts.append(f"written {format_bytes(metrics['disk_bytes_written'])}")
+    if not metrics.get("succeeded", True):
+        parts.append("FAILED")
+    return ", ".join(parts)
+
+
+def compare(results: list) -> None:
+    """Print how the last two runs of every scenario differ."""
+    for name in SCENARIOS:
+        runs = [result for result in results if result["scenario"] == name and "elapsed" in result["metrics"]]
+        if len(runs) < 2:
+            continue
+        previous, latest = runs[-2], runs[-1]
+        print(f"{name}: {previous.get('commit')} -> {latest.get('commit')}")
+        if previous["params"] != latest["params"]:
+            print("  (the runs used different parameters)")
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            before, after = previous["metrics"].get(metric), latest["metrics"].get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            verdict = "" if abs(change) < 0.05 else " (better)" if (change > 0) == higher_is_better else " (worse)"
+            print(f"  {metric:<20} {before:>14.4g} -> {after:<14.4g} {change:+.1f}%{verdict}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark the downloader against a local fake stream server.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Scenario to run (default: all). Repeatable.")
+    parser.add_argument("--video-size", type=parse_rate, default=parse_rate("16M"), help="Size of the video stream (default: 16M).")
+    parser.add_argument("--audio-size", type=parse_rate, default=parse_rate("2M"), help="Size of the audio stream (default: 2M).")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the server waits before answering each request.")
+    parser.add_argument("--connection-rate", type=parse_rate, help="Bytes per second the server sends on each connection.")
+    parser.add_argument("--playlist-videos", type=int, default=4, help="Number of videos of the playlist scenario (default: 4).")
+    parser.add_argument("--playlist-workers", type=int, default=3, help="Playlist videos downloaded at the same time (default: 3).")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Calls per link of the qualities scenario and launches of the startup scenario (default: 20).")
+    parser.add_argument("--payload-dir", default=DEFAULT_PAYLOAD_DIR, help="Where the synthetic payloads are kept.")
+    parser.add_argument("--results", default=DEFAULT_RESULTS_FILE, help="JSON lines file the results are appended to.")
+    parser.add_argument("--compare", action="store_true", help="Compare the last two runs of each scenario and exit.")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.worker:
+        spec = json.loads(args.worker)
+        # Keep the downloader's own messages off the metrics line.
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        metrics = run_scenario(spec["name"], spec["base_url"], spec["payloads"], spec["params"], spec["folder"])
+        print(json.dumps(metrics), file=stdout)
+        return 0
+    if args.compare:
+        compare(load_results(args.results))
+        return 0
+
+    payloads = make_payloads(args.payload_dir, int(args.video_size), int(args.audio_size))
+    server = FakeStreamServer(args.payload_dir, latency=args.latency, connection_rate=args.connection_rate).start()
+    params = {"video_size": payloads["video_size"], "audio_size": payloads["audio_size"], "latency": args.latency,
+              "connection_rate": args.connection_rate, "playlist_videos": args.playlist_videos,
+              "playlist_workers": args.playlist_workers, "repeat": args.repeat, "payload_dir": args.payload_dir}
+    commit = git_commit()
+    try:
+        with open(args.results, "a", encoding="utf-8") as results:
+            for name in args.scenario or SCENARIOS:
+                metrics = run_isolated(name, server.base_url, payloads, params)
+                print(f"{name}: {describe(metrics)}")
+                record = {"scenario": name, "timestamp": time.time(), "commit": commit,
+                          "params": {key: value for key, value in params.items() if key != "payload_dir"},
+                          "metrics": metrics}
+                results.write(json.dumps(record) + "\n")
+                results.flush()
+    finally:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+"""
+Headless command line entry point for the YouTube downloader.
+
+Examples:
+    python cli.py --folder downloads --quality 720p https://www.youtube.com/watch?v=...
+    python cli.py --folder downloads --jobs 8 --batch-file links.txt
+    python cli.py --folder mirror --type playlist --sync --prune https://www.youtube.com/playlist?list=...
+    python cli.py --folder downloads --overwrite https://www.youtube.com/watch?v=...
+    python cli.py --folder catalog --type thumbnail --thumbnail-format webp --thumbnail-size 320x180 https://www.youtube.com/playlist?list=...
+
+A batch file has one job per line: `<strategy type> <link> [quality]`, e.g.
+    video https://www.youtube.com/watch?v=... 1080p
+    playlist https://www.youtube.com/playlist?list=... 720p
+    thumbnail https://www.youtube.com/watch?v=...
+    audio https://www.youtube.com/playlist?list=... mp3
+For `audio` jobs the quality is the audio format: m4a, mp3 or opus.
+Blank lines and lines starting with `#` are ignored.
+
+Every finished job is written to stdout as one JSON object per line. Messages from the downloader
+itself go to stderr so stdout stays machine-readable. The exit status is 0 when every job succeeded,
+1 when at least one failed and 2 for invalid arguments or batch files.
+"""
+import argparse
+import contextlib
+import json
+import sys
+import threading
+import time
+
+from async_engine import DEFAULT_BLOCKING_WORKERS, download_engine
+from bandwidth_governor import governor, parse_rate
+from content_store import content_store, parse_size
+from downloader_context import DownloaderContext, describe_result
+from merge_pool import DEFAULT_MERGE_WORKERS, merge_pool
+from metrics import SamplingProfiler, metrics_recorder
+from output_writer import DEFAULT_BUFFER_SIZE, DEFAULT_MIN_FREE, DEFAULT_SYNC_INTERVAL, FSYNC_NEVER, FSYNC_POLICIES, output_writer
+from retry_policy import DEFAULT_ATTEMPTS, retry_policy
+from progress import ProgressChannel, format_snapshot
+from thumbnails import parse_image_format, parse_thumbnail_size
+from utils import AUDIO_FORMATS, DEFAULT_AUDIO_FORMAT, validate_link
+
+STRATEGY_TYPES = ("video", "playlist", "thumbnail", "audio")
+
+EXIT_OK = 0
+EXIT_JOB_FAILED = 1
+EXIT_USAGE = 2
+
+# How often --progress prints the aggregate progress, in seconds.
+PROGRESS_TICK = 1.0
+
+
+class DownloadJob:
+    """One link to download with a given strategy type and quality."""
+
+    def __init__(self, strategy_type: str, link: str, quality: str = None) -> None:
+        self.strategy_type = strategy_type
+        self.link = link
+        self.quality = quality
+
+
+def parse_batch_file(path: str, default_quality: str = None, default_audio_format: str = None) -> list:
+    """
+    Read the jobs of a batch file.
+
+    :param path: Path to the batch file, or `-` for stdin.
+    :param default_quality: Quality of the jobs whose line doesn't give one.
+    :param default_audio_format: Audio format of the `audio` jobs whose line doesn't give one.
+    :return: List of `DownloadJob`.
+    :raises ValueError: If a line is malformed.
+    """
+    with (contextlib.nullcontext(sys.stdin) if path == "-" else open(path, encoding="utf-8")) as fh:
+        lines = fh.readlines()
+
+    jobs = []
+    for line_number, line in enumerate(lines, start=1):
+        fields = line.split()
+        if not fields or fields[0].startswith("#"):
+            continue
+        if len(fields) not in (2, 3) or fields[0] not in STRATEGY_TYPES:
+            raise ValueError(f"{path}:{line_number}: expected '<{'|'.join(STRATEGY_TYPES)}> <link> [quality]'")
+        quality = fields[2] if len(fields) == 3 else (default_audio_format if fields[0] == "audio" else default_quality)
+        jobs.append(DownloadJob(fields[0], fields[1], quality))
+    return jobs
+
+
+def start_job(job: DownloadJob, folder: str, on_record, playlist_workers: int = None,
+              progress_channel: ProgressChannel = None, playlist_options: dict = None, thumbnail_options: dict = None,
+              timeout: float = None, overwrite: bool = False) -> None:
+    """
+    Queue one job on the download engine and call `on_record` with its result record once it
+    ends. Never raises.
+
+    :param playlist_options: (optional) `sync`, `renumber` and `prune` settings of playlist jobs.
+    :param thumbnail_options: (optional) `thumbnail_format` and `thumbnail_size` settings of thumbnail jobs.
+    :param timeout: (optional) Seconds the job may run before it is stopped and counted as failed.
+    :param overwrite: (optional) Download again the files that already exist instead of keeping them.
+    """
+    record = {"link": job.link, "strategy": job.strategy_type, "quality": job.quality,
+              "started_at": time.time()}
+    start = time.perf_counter()
+    context = None
+
+    def finish(error=None, result=None):
+        if error is None:
+            if isinstance(result, list):
+                record["items"] = len(result)
+                record["items_failed"] = len([item for item in result if not item[2]])
+            succeeded, error = describe_result(job.strategy_type, result)
+            record["status"] = "ok" if succeeded else "failed"
+        else:
+            record["status"] = "failed"
+        if error:
+            record["error"] = str(error)
+        record["elapsed"] = round(time.perf_counter() - start, 3)
+        record["bytes"] = context.bytes_downloaded if context else 0
+        on_record(record)
+
+    def done(engine_job):
+        try:
+            result = engine_job.result()
+        except Exception as e:
+            finish(e)
+        else:
+            finish(result=result)
+
+    try:
+        error = validate_link(job.strategy_type, job.link)
+        if error:
+            raise ValueError(error)
+        context = DownloaderContext(strategy_type=job.strategy_type, link=job.link, folder=folder,
+                                    quality=job.quality, max_workers=playlist_workers, show_thumbnail=False,
+                                    progress_channel=progress_channel, timeout=timeout,
+                                    overwrite=overwrite,
+                                    **((playlist_options or {}) if job.strategy_type in ("playlist", "audio") else {}),
+                                    **((thumbnail_options or {}) if job.strategy_type == "thumbnail" else {}))
+        context.start_download().add_done_callback(done)
+    except Exception as e:
+        finish(e)
+
+
+def report_progress(progress_channel: ProgressChannel, stop: threading.Event, out=sys.stderr) -> None:
+    """Print the aggregate progress of every job to `out` once per tick until `stop` is set."""
+    while not stop.wait(PROGRESS_TICK):
+        snapshot = progress_channel.drain()
+        if snapshot.jobs:
+            print(format_snapshot(snapshot), file=out, flush=True)
+
+
+def run_jobs(jobs: list, folder: str, playlist_workers: int = None, out=sys.stdout,
+             show_progress: bool = False, playlist_options: dict = None, thumbnail_options: dict = None,
+             timeout: float = None, overwrite: bool = False) -> int:
+    """
+    Queue every job on the download engine, which runs up to its `max_jobs` of them at once,
+    and write each result to `out` as a JSON line as the jobs end.
+
+    :param show_progress: Print the aggregate progress, throughput and ETA to stderr every second.
+    :return: The process exit status.
+    """
+    write_lock = threading.Lock()
+    all_done = threading.Event()
+    counts = {"ended": 0, "failed": 0}
+    progress_channel = ProgressChannel() if show_progress else None
+    stop_progress = threading.Event()
+    if progress_channel:
+        threading.Thread(target=report_progress, args=(progress_channel, stop_progress), daemon=True).start()
+
+    def write(record):
+        with write_lock:
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            counts["ended"] += 1
+            if record["status"] != "ok":
+                counts["failed"] += 1
+            if counts["ended"] == len(jobs):
+                all_done.set()
+
+    for job in jobs:
+        start_job(job, folder, write, playlist_workers, progress_channel, playlist_options, thumbnail_options,
+                  timeout, overwrite)
+    all_done.wait()
+    stop_progress.set()
+    return EXIT_JOB_FAILED if counts["failed"] else EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Download YouTube videos, playlists and thumbnails without the GUI.")
+    parser.add_argument("links", nargs="*", help="Links to download with --type and --quality.")
+    parser.add_argument("-b", "--batch-file", help="File with one '<type> <link> [quality]' job per line ('-' for stdin).")
+    parser.add_argument("-t", "--type", choices=STRATEGY_TYPES, default="video", help="Strategy type of the positional links.")
+    parser.add_argument("-q", "--quality", help="Video quality, e.g. 720p, for jobs that don't give one.")
+    parser.add_argument("--audio-format", choices=tuple(AUDIO_FORMATS), default=DEFAULT_AUDIO_FORMAT,
+                        help=f"Format of audio jobs that don't give one (default: {DEFAULT_AUDIO_FORMAT}); m4a is a stream copy, the others are transcoded.")
+    parser.add_argument("-o", "--folder", default=".", help="Destination folder (default: current directory).")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of jobs run at the same time (default: 4).")
+    parser.add_argument("--playlist-workers", type=int, help="Number of videos (or thumbnails) of one playlist downloaded at the same time.")
+    parser.add_argument("--rate-limit", type=parse_rate, help="Total bandwidth of all jobs, e.g. 500K or 2M bytes per second.")
+    parser.add_argument("--max-connections", type=int, help="Total number of connections open at the same time.")
+    parser.add_argument("--job-timeout", type=float, help="Seconds a job may run before it is stopped and counted as failed.")
+    parser.add_argument("--engine-workers", type=int, default=DEFAULT_BLOCKING_WORKERS,
+                        help=f"Number of metadata lookups, file writes and hashes run at the same time across all jobs (default: {DEFAULT_BLOCKING_WORKERS}).")
+    parser.add_argument("--merge-workers", type=int, default=DEFAULT_MERGE_WORKERS,
+                        help=f"Number of ffmpeg merges run at the same time (default: {DEFAULT_MERGE_WORKERS}).")
+    parser.add_argument("--retries", type=int, default=DEFAULT_ATTEMPTS,
+                        help=f"Attempts of each metadata lookup and transfer before it fails (default: {DEFAULT_ATTEMPTS}).")
+    parser.add_argument("--write-buffer", type=parse_size, default=DEFAULT_BUFFER_SIZE,
+                        help="Write buffer of each output file, e.g. 4M (default: 1M).")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default=FSYNC_NEVER,
+                        help="Force output to the device on every file close, periodically (see --sync-interval) or never (default).")
+    parser.add_argument("--sync-interval", type=parse_size, default=DEFAULT_SYNC_INTERVAL,
+                        help="Bytes written between syncs with --fsync periodic (default: 64M).")
+    parser.add_argument("--min-free", type=parse_size, default=DEFAULT_MIN_FREE,
+                        help="Space left free in the destination; jobs that don't fit fail before downloading (default: 64M).")
+    parser.add_argument("--store", help="Content store directory; videos already in it are copied instead of downloaded.")
+    parser.add_argument("--store-max-size", type=parse_size, help="Size the content store is kept within, e.g. 50G.")
+    parser.add_argument("--store-hardlink", action="store_true",
+                        help="Hardlink videos restored from the content store instead of copying them; editing one in place also changes the stored copy.")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Download again the videos and audio files that already exist in the folder instead of keeping them.")
+    parser.add_argument("--sync", action="store_true",
+                        help="Mirror playlists: only download the videos that are new or incomplete in the folder's manifest.")
+    parser.add_argument("--renumber", action="store_true", help="With --sync, rename the files of videos that moved in the playlist.")
+    parser.add_argument("--prune", action="store_true", help="With --sync, delete the files of videos removed from the playlist.")
+    parser.add_argument("--thumbnail-format", type=parse_image_format, help="Convert thumbnails to this format: jpg, png, webp, gif or bmp.")
+    parser.add_argument("--thumbnail-size", type=parse_thumbnail_size, help="Shrink thumbnails to fit this size, e.g. 320x180.")
+    parser.add_argument("--progress", action="store_true", help="Print the overall progress, throughput and ETA to stderr every second.")
+    parser.add_argument("--metrics-jsonl", help="Append the phase timings, bytes, retries and ffmpeg runs of every job to this file.")
+    parser.add_argument("--metrics-prom", help="Write the totals of every job to this Prometheus textfile.")
+    parser.add_argument("--profile", help="Sample the transfer loops and write the stacks to this file (collapsed format).")
+    return parser
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if (args.renumber or args.prune) and not args.sync:
+        parser.error("--renumber and --prune only apply with --sync")
+    governor.set_rate(args.rate_limit)
+    governor.set_max_connections(args.max_connections)
+    metrics_recorder.configure(jsonl_path=args.metrics_jsonl, prometheus_path=args.metrics_prom)
+    retry_policy.configure(attempts=args.retries)
+    merge_pool.configure(workers=args.merge_workers)
+    download_engine.configure(blocking_workers=args.engine_workers, max_jobs=args.jobs)
+    output_writer.configure(buffer_size=args.write_buffer, fsync=args.fsync, sync_interval=args.sync_interval,
+                            min_free=args.min_free or 0)
+    if args.store:
+        content_store.configure(args.store, max_bytes=args.store_max_size, hardlink_outputs=args.store_hardlink)
+
+    jobs = [DownloadJob(args.type, link, args.audio_format if args.type == "audio" else args.quality) for link in args.links]
+    if args.batch_file:
+        try:
+            jobs += parse_batch_file(args.batch_file, default_quality=args.quality, default_audio_format=args.audio_format)
+        except (OSError, ValueError) as e:
+            print(f"Error reading batch file: {e}", file=sys.stderr)
+            return EXIT_USAGE
+    if not jobs:
+        parser.error("no links given")
+
+    # The downloader reports through print(); keep that off the JSON lines on stdout.
+    results_out = sys.stdout
+    profiler = SamplingProfiler().start() if args.profile else None
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            return run_jobs(jobs, args.folder, args.playlist_workers, out=results_out,
+                            show_progress=args.progress,
+                            playlist_options={"sync": args.sync, "renumber": args.renumber, "prune": args.prune},
+                            thumbnail_options={"thumbnail_format": args.thumbnail_format,
+                                               "thumbnail_size": args.thumbnail_size},
+                            timeout=args.job_timeout, overwrite=args.overwrite)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.write(args.profile)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
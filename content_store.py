@@ -0,0 +1,328 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+from bandwidth_governor import parse_rate
+
+# Streams are hashed in blocks of this size, so blocks fetched in parallel can be hashed as they arrive.
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+# ioctl of Linux filesystems that share extents between files (btrfs, XFS, ...).
+FICLONE = 0x40049409
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    video_id TEXT NOT NULL,
+    itag TEXT NOT NULL,
+    quality TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (video_id, itag, quality)
+);
+CREATE INDEX IF NOT EXISTS items_digest ON items (digest);
+"""
+
+
+class BlockHasher:
+    """
+    SHA-256 of a stream computed while its bytes come in, in whatever order the ranges arrive.
+
+    The stream is cut into `block_size` blocks; the digest is the SHA-256 of the concatenated
+    block digests. Bytes that arrive ahead of their turn within a block are held until the gap
+    is filled, which never happens when ranges are aligned to the block size.
+    """
+
+    def __init__(self, size: int, block_size: int = HASH_BLOCK_SIZE) -> None:
+        """
+        :param size: Size of the stream, in bytes.
+        :param block_size: Size of the blocks hashed separately.
+        """
+        self.size = size
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def update(self, offset: int, data: bytes) -> None:
+        """Hash `data`, found at `offset` in the stream. Safe to call from several threads."""
+        data = memoryview(data)
+        while data:
+            index = offset // self.block_size
+            length = min(len(data), (index + 1) * self.block_size - offset)
+            self._update_block(index, offset, data[:length])
+            offset += length
+            data = data[length:]
+
+    def _update_block(self, index: int, offset: int, data) -> None:
+        with self._lock:
+            block = self._blocks.setdefault(index, {"hash": hashlib.sha256(), "next": index * self.block_size,
+                                                    "pending": {}, "lock": threading.Lock()})
+        with block["lock"]:
+            if offset != block["next"]:
+                block["pending"][offset] = bytes(data)
+                return
+            block["hash"].update(data)
+            block["next"] += len(data)
+            while block["next"] in block["pending"]:
+                piece = block["pending"].pop(block["next"])
+                block["hash"].update(piece)
+                block["next"] += len(piece)
+
+    def hexdigest(self) -> str:
+        """
+        :return: The digest of the stream.
+        :raises ValueError: If some of the stream's bytes were never hashed.
+        """
+        digests = []
+        for index in range(-(-self.size // self.block_size)):
+            block = self._blocks.get(index)
+            if block is None or block["next"] != min((index + 1) * self.block_size, self.size):
+                raise ValueError(f"Block {index} of the stream was not hashed completely")
+            digests.append(block["hash"].digest())
+        return hashlib.sha256(b"".join(digests)).hexdigest()
+
+
+def parse_size(text: str) -> int:
+    """Parse a size such as `500M` or `20G` (bytes, powers of 1024). Returns None for `unlimited`."""
+    size = parse_rate(text)
+    return int(size) if size is not None else None
+
+
+def combine_digests(*digests: str) -> str:
+    """Digest of an output made from several streams, e.g. the video and audio of a merged file."""
+    return hashlib.sha256("+".join(digests).encode("ascii")).hexdigest()
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    """Make `destination` a hardlink to `source`, else a reflink, else a plain copy."""
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    reflink_or_copy(source, destination)
+
+
+def reflink_or_copy(source: str, destination: str) -> None:
+    """
+    Make `destination` a reflink of `source` where the filesystem shares extents between
+    files, else a plain copy. Either way, writing to one never changes the other.
+    """
+    if sys.platform.startswith("linux"):
+        import fcntl
+        try:
+            with open(source, "rb") as src, open(destination, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            os.remove(destination)
+    shutil.copyfile(source, destination)
+
+
+class ContentStore:
+    """
+    Helper class responsible for keeping finished downloads in a local content-addressed store,
+    so the same video at the same quality is never fetched twice.
+
+    Outputs are indexed by video ID, itag and quality, and stored once per digest of the streamed
+    bytes they were made from, as `objects/<digest[:2]>/<digest>`. Outputs are reflinked into the
+    store where the filesystem allows it and copied otherwise, so editing an output never changes
+    the stored object. They are put back the same way, or hardlinked with `hardlink_outputs`,
+    which takes no space but shares the file with the store. An object whose size or
+    modification time no longer matches the index is dropped rather than restored. The least
+    recently used objects are evicted once the store grows beyond `max_bytes`.
+    """
+
+    def __init__(self, root: str = None, max_bytes: int = None, hardlink_outputs: bool = False) -> None:
+        """
+        :param root: (optional) Directory of the store. None disables the store.
+        :param max_bytes: (optional) Size the store is kept within. None means unlimited.
+        :param hardlink_outputs: (optional) Hardlink the outputs restored from the store to its objects.
+        """
+        self._lock = threading.Lock()
+        self._connection = None
+        self.root = None
+        self.max_bytes = max_bytes
+        self.hardlink_outputs = hardlink_outputs
+        if root:
+            self.configure(root, max_bytes, hardlink_outputs)
+
+    def configure(self, root: str = None, max_bytes: int = None, hardlink_outputs: bool = False) -> None:
+        """Open the store at `root`, or disable the store with None."""
+        with self._lock:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+            self.root = root
+            self.max_bytes = max_bytes
+            self.hardlink_outputs = hardlink_outputs
+            if root:
+                os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+                self._connection = sqlite3.connect(os.path.join(root, "index.sqlite3"), check_same_thread=False)
+                self._connection.row_factory = sqlite3.Row
+                with self._connection:
+                    self._connection.executescript(SCHEMA)
+                    columns = [row["name"] for row in self._connection.execute("PRAGMA table_info(items)")]
+                    if "mtime_ns" not in columns:
+                        # Stores made before objects were checked; their rows are checked by size only.
+                        self._connection.execute("ALTER TABLE items ADD COLUMN mtime_ns INTEGER")
+
+    @property
+    def enabled(self) -> bool:
+        return self._connection is not None
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def lookup(self, video_id: str, itag: str, quality: str) -> dict:
+        """
+        Return the stored item, or None if it isn't stored, or its object is gone or was changed
+        since it was stored, e.g. by editing a hardlinked output.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM items WHERE video_id = ? AND itag = ? AND quality = ?",
+                                           (video_id, itag, quality or "")).fetchone()
+            if row is None:
+                return None
+            if not self._is_intact(row):
+                print(f"Dropping {row['digest']} from the content store: its object is gone or was changed.")
+                self._remove_object(row["digest"])
+                return None
+            with self._connection:
+                self._connection.execute("UPDATE items SET last_used = ? WHERE digest = ?", (time.time(), row["digest"]))
+        return dict(row)
+
+    def materialize(self, item: dict, destination: str, replace: bool = False) -> bool:
+        """
+        Put the stored item at `destination`, without touching the network.
+
+        :param replace: Replace a file already at `destination`, e.g. an incomplete download.
+        :return: False if the item couldn't be linked or copied, or `destination` already exists
+                 and `replace` is off.
+        """
+        if os.path.exists(destination):
+            if not replace:
+                return False
+            if os.path.samefile(destination, self.object_path(item["digest"])):
+                return True  # Already linked to the object.
+        # Link under a temporary name first, so `destination` is never missing or partial.
+        temp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+            (link_or_copy if self.hardlink_outputs else reflink_or_copy)(self.object_path(item["digest"]), temp_path)
+            os.replace(temp_path, destination)
+            return True
+        except OSError as e:
+            print(f"Error restoring {destination} from the content store: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+
+    def add(self, video_id: str, itag: str, quality: str, digest: str, path: str) -> None:
+        """
+        Record the finished output at `path`. It is reflinked or copied into the store, or, if an
+        object with the same digest is already stored, hardlinked to that object with
+        `hardlink_outputs`.
+        """
+        if not self.enabled:
+            return
+        object_path = self.object_path(digest)
+        try:
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                # Copy under a temporary name first, so a concurrent lookup never sees a partial copy.
+                temp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                reflink_or_copy(path, temp_path)
+                os.replace(temp_path, object_path)
+            elif self.hardlink_outputs and not os.path.samefile(path, object_path):
+                # Already stored from another download: share the stored copy's disk space.
+                temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                try:
+                    os.link(object_path, temp_path)
+                    os.replace(temp_path, path)
+                except OSError:
+                    pass
+            stat = os.stat(object_path)
+        except OSError as e:
+            print(f"Error adding {path} to the content store: {e}")
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO items (video_id, itag, quality, digest, size, mtime_ns, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (video_id, itag, quality or "", digest, stat.st_size, stat.st_mtime_ns, now, now))
+        self.evict(keep=digest)
+
+    def evict(self, keep: str = None) -> int:
+        """
+        Remove the least recently used objects until the store fits in `max_bytes`.
+
+        Only objects the store alone holds count: one still hardlinked to an output takes no
+        space of its own, and removing it would free none, so it is neither counted nor evicted.
+
+        :param keep: (optional) Digest never evicted, e.g. the one just added.
+        :return: Number of objects removed.
+        """
+        if not self.enabled or self.max_bytes is None:
+            return 0
+        removed = 0
+        with self._lock:
+            objects = self._connection.execute(
+                "SELECT digest, MAX(size) AS size, MAX(last_used) AS last_used FROM items "
+                "GROUP BY digest ORDER BY last_used").fetchall()
+            freeable = [row for row in objects if self._link_count(row["digest"]) == 1]
+            total = sum(row["size"] for row in freeable)
+            for row in freeable:
+                if total <= self.max_bytes:
+                    break
+                if row["digest"] == keep:
+                    continue
+                self._remove_object(row["digest"])
+                total -= row["size"]
+                removed += 1
+        return removed
+
+    def _is_intact(self, row) -> bool:
+        try:
+            stat = os.stat(self.object_path(row["digest"]))
+        except FileNotFoundError:
+            return False
+        return stat.st_size == row["size"] and row["mtime_ns"] in (None, stat.st_mtime_ns)
+
+    def _link_count(self, digest: str) -> int:
+        try:
+            return os.stat(self.object_path(digest)).st_nlink
+        except FileNotFoundError:
+            return 0
+
+    def _remove_object(self, digest: str) -> None:
+        """Delete an object and its rows; the caller holds `_lock`."""
+        try:
+            os.remove(self.object_path(digest))
+        except FileNotFoundError:
+            pass
+        with self._connection:
+            self._connection.execute("DELETE FROM items WHERE digest = ?", (digest,))
+
+    @property
+    def size(self) -> int:
+        """Bytes held by the store's objects."""
+        if not self.enabled:
+            return 0
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM items GROUP BY digest)").fetchone()
+        return row[0]
+
+
+# Store shared by every download of the process. Disabled until configured.
+content_store = ContentStore()
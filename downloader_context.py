@@ -1,16 +1,73 @@
+from async_engine import download_engine, EngineJob
 from strategies_factory import StrategyFactory
 
+
+def describe_result(strategy_type: str, result):
+    """
+    Interpret what `execute_download` returned for the given strategy type.
+
+    :return: Tuple of (succeeded, error message or None).
+    """
+    if isinstance(result, list):
+        failed = [item for item in result if not item[2]]
+        if failed:
+            return False, f"{len(failed)} of {len(result)} playlist videos failed"
+        return True, None
+    if result is None or result is False:
+        return False, "Download failed"
+    return True, None
+
+
 class DownloaderContext:
-    def __init__(self, strategy_type: str, link: str, folder: str, quality: str = None, progress_callback=None) -> None:
+    def __init__(self, strategy_type: str, link: str, folder: str, quality: str = None, progress_callback=None, max_workers: int = None, show_thumbnail: bool = True,
+                 skip_videos=None, on_video_done=None, progress_channel=None, sync: bool = False, renumber: bool = False,
+                 prune: bool = False, thumbnail_format: str = None, thumbnail_size: tuple = None, timeout: float = None,
+                 overwrite: bool = False) -> None:
         """This holds the download strategy and provides an interface to execute it.
             The context provides a consistent way to execute different strategies.
-            It decouples the strategy execution from the main program."""
-        self._strategy = StrategyFactory.get_strategy(strategy_type=strategy_type, 
-                                              link=link, 
-                                              folder=folder, 
-                                              quality=quality, 
-                                              progress_callback=progress_callback)
+            It decouples the strategy execution from the main program.
+            The download runs as a job of the shared download engine, which builds the strategy
+            when the job starts; `timeout` is the number of seconds the job may run."""
+        self.link = link
+        self.timeout = timeout
+        # `async_engine.EngineJob` of the last download started.
+        self.job = None
+        self._strategy = None
+        self._strategy_options = dict(strategy_type=strategy_type, 
+                                      link=link, 
+                                      folder=folder, 
+                                      quality=quality, 
+                                      progress_callback=progress_callback,
+                                      max_workers=max_workers,
+                                      show_thumbnail=show_thumbnail,
+                                      skip_videos=skip_videos,
+                                      on_video_done=on_video_done,
+                                      progress_channel=progress_channel,
+                                      sync=sync,
+                                      renumber=renumber,
+                                      prune=prune,
+                                      thumbnail_format=thumbnail_format,
+                                      thumbnail_size=thumbnail_size,
+                                      overwrite=overwrite)
+
+    def _create_strategy(self):
+        self._strategy = StrategyFactory.get_strategy(**self._strategy_options)
+        return self._strategy
+
+    def start_download(self) -> EngineJob:
+        """Queue the download on the download engine and return its job without waiting."""
+        self.job = download_engine.submit(self._create_strategy, link=self.link, timeout=self.timeout)
+        return self.job
 
     def execute_download(self) -> None:
-        """Execute the download based on the chosen strategy."""
-        return self._strategy.download()
\ No newline at end of file
+        """Execute the download based on the chosen strategy and wait for it to finish."""
+        return self.start_download().result()
+
+    def cancel(self) -> bool:
+        """Cancel the running download. Returns False if there is none."""
+        return self.job.cancel() if self.job else False
+
+    @property
+    def bytes_downloaded(self) -> int:
+        """Bytes fetched from the network by the last download."""
+        return self._strategy.bytes_downloaded if self._strategy else 0
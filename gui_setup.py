@@ -37,6 +37,10 @@ def setup_gui(window, populate_qualities_func):
     # Add more GUI components here...
     components["progressBar"] = ttk.Progressbar(window, orient="horizontal", length=400, mode="determinate")
     components["progressBar"].place(x=250, y=220)
+
+    # Label under the progress bar for the transferred bytes, throughput and ETA
+    components["progressLabel"] = Label(window, text="", anchor='w')
+    components["progressLabel"].place(x=250, y=250, width=500)
     
     # Button to fetch available qualities
     components["fetchQualitiesButton"] = Button(window, text="Fetch Qualities", command=populate_qualities_func)
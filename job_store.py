@@ -0,0 +1,146 @@
+import json
+import sqlite3
+import threading
+import time
+
+# Job states. A job moves queued -> running -> done/failed/cancelled.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    strategy TEXT NOT NULL,
+    link TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    quality TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    host TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    done_videos TEXT NOT NULL DEFAULT '[]',
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, id);
+"""
+
+
+class JobStore:
+    """
+    Helper class responsible for keeping download jobs in an SQLite database, so queued and
+    in-flight jobs survive a restart of the server.
+
+    Playlist jobs also record which of their videos are finished, so a job that was interrupted
+    half way resumes with the remaining videos only.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Open (or create) the job database.
+
+        :param path: Path to the SQLite database file.
+        """
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def recover(self) -> int:
+        """Put the jobs that were running when the server stopped back in the queue. Returns their count."""
+        with self._lock, self._connection:
+            cursor = self._connection.execute("UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?",
+                                              (QUEUED, RUNNING))
+            return cursor.rowcount
+
+    def add(self, strategy: str, link: str, folder: str, quality: str = None, priority: int = 0, host: str = "") -> dict:
+        """Queue a new job and return it."""
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO jobs (strategy, link, folder, quality, priority, host, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (strategy, link, folder, quality, priority, host, QUEUED, time.time()))
+            job_id = cursor.lastrowid
+        return self.get(job_id)
+
+    def get(self, job_id: int) -> dict:
+        """Return the job with the given ID, or None."""
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, status: str = None) -> list:
+        """Return every job, optionally only those in the given state."""
+        with self._lock:
+            if status:
+                rows = self._connection.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id", (status,)).fetchall()
+            else:
+                rows = self._connection.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def claim_next(self, busy_hosts: set) -> dict:
+        """
+        Mark the next job to run as running and return it, or return None if there is none.
+
+        Jobs with a higher priority go first, then the oldest. Jobs submitted from a host in
+        `busy_hosts` are passed over, so one client can't fill every worker.
+        """
+        with self._lock, self._connection:
+            rows = self._connection.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY priority DESC, id", (QUEUED,)).fetchall()
+            for row in rows:
+                if row["host"] in busy_hosts:
+                    continue
+                self._connection.execute("UPDATE jobs SET status = ?, started_at = ? WHERE id = ?",
+                                         (RUNNING, time.time(), row["id"]))
+                job = self._to_dict(row)
+                job["status"] = RUNNING
+                return job
+        return None
+
+    def update_progress(self, job_id: int, progress: float) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE jobs SET progress = ? WHERE id = ?", (progress, job_id))
+
+    def add_done_video(self, job_id: int, video_count: str) -> None:
+        """Record that a video of a playlist job is finished."""
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT done_videos FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            done_videos = set(json.loads(row["done_videos"])) | {video_count}
+            self._connection.execute("UPDATE jobs SET done_videos = ? WHERE id = ?",
+                                     (json.dumps(sorted(done_videos, key=int)), job_id))
+
+    def finish(self, job_id: int, status: str, error: str = None, bytes_downloaded: int = 0) -> None:
+        """Move a job to one of the finished states."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, bytes = bytes + ?, finished_at = ?, "
+                "progress = CASE WHEN ? = ? THEN 100 ELSE progress END WHERE id = ?",
+                (status, error, bytes_downloaded, time.time(), status, DONE, job_id))
+
+    def cancel_queued(self, job_id: int) -> bool:
+        """Cancel the job if it hasn't started yet. Returns True if it was cancelled."""
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED))
+            return cursor.rowcount == 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        job = dict(row)
+        job["done_videos"] = json.loads(job["done_videos"])
+        return job
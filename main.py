@@ -1,75 +1,144 @@
 from tkinter import Tk, Button, messagebox
-import threading
+import os
+import queue
+import re
 
 from gui_setup import *
-from utils import *
-from strategies import *
-from downloader_context import DownloaderContext
+from async_engine import download_engine
+from utils import validate_link, get_available_qualities, get_quality_choices, quality_from_choice, DownloadCancelled
+from downloader_context import DownloaderContext, describe_result
+from metadata_cache import metadata_cache
+from progress import ProgressChannel, format_snapshot
+
+# Keep resolved links on disk too, so reopening the app doesn't look them up again.
+metadata_cache.cache_dir = os.path.join(os.path.expanduser("~"), ".youtube_downloader", "metadata")
 
 # Define a threading decorator for threaded functions
 def threaded(func):
     """
-    Decorator for threading functions to run them in the background.
+    Decorator running functions in the background, in the download engine's bounded worker
+    pool rather than a new thread per call.
 
     :param func: The function to be threaded.
     :return: Threaded version of the function.
     """
     def wrapper(*args, **kwargs):
-        thread = threading.Thread(target=func, args=args, kwargs=kwargs, daemon=True)
-        thread.start()
+        download_engine.call(func, *args, **kwargs)
     return wrapper
 
-@threaded
-def progress_stream(stream, chunk, combined_percentage):
-    components["progressBar"]['value'] = combined_percentage
-    window.update_idletasks()
+# How often the Tk main loop picks up progress posted by the download threads, in milliseconds.
+PROGRESS_TICK_MS = 100
 
-    if combined_percentage == 100:
-        messagebox.showinfo(message="The video is successfully downloaded")
+# Worker threads never touch the widgets: they post progress to this channel, and message
+# boxes and other widget updates to this queue, and the main loop applies both on its own tick.
+progress_channel = ProgressChannel()
+ui_messages = queue.SimpleQueue()
+last_snapshot = None
+
+# Downloads started from the window and not finished yet, so they can be cancelled.
+running_downloads = set()
+
+def poll_progress():
+    """Show the progress and messages posted since the last tick, then schedule the next tick."""
+    global last_snapshot
+    last_snapshot = progress_channel.drain()
+    if last_snapshot.jobs:
+        components["progressBar"]['value'] = last_snapshot.percentage
+        components["progressLabel"].config(text=format_snapshot(last_snapshot))
+
+    while True:
+        try:
+            show_message, args = ui_messages.get_nowait()
+        except queue.Empty:
+            break
+        show_message(*args)
+    window.after(PROGRESS_TICK_MS, poll_progress)
 
 
-@threaded
 def update_video_name_label(event=None):
-    link = components["Link"].get()
+    fetch_video_name(components["Link"].get())
+
+@threaded
+def fetch_video_name(link):
     try:
         video_pattern = r'https?://www\.youtube\.com/watch\?v=[^&]+'
 
         if re.match(video_pattern, link):
-            yt = YouTube(link)
-            components["videoNameLabel"].config(text=yt.title)
+            yt = metadata_cache.get_video(link)
+            ui_messages.put((show_video_name, (yt.title,)))
         if "youtube.com/playlist?list=" in link:
-            p = Playlist(link)
-            components["videoNameLabel"].config(text=p.title)
+            p = metadata_cache.stream_playlist(link)
+            ui_messages.put((show_video_name, (p.title,)))
     except Exception as e:
-        components["videoNameLabel"].config(text="Error fetching video name.")
+        ui_messages.put((show_video_name, ("Error fetching video name.",)))
 
-# Primary Functions with Threading
-@threaded
+def show_video_name(text):
+    components["videoNameLabel"].config(text=text)
+
+def start_download(strategy_type):
+    """Start a download; the progress bar starts over unless other downloads are still running."""
+    if last_snapshot is None or all(job.done for job in last_snapshot.jobs.values()):
+        progress_channel.reset()
+    execute_download(strategy_type)
+
+# Primary Functions; downloads run as jobs of the download engine
 def execute_download(strategy_type):
     link = components["Link"].get()
     folder = components["fileLocationLabel"]["text"]
-    quality = components["qualityDropdown"].get() if strategy_type == "video" or "playlist" else None
+    quality = quality_from_choice(components["qualityDropdown"].get()) if strategy_type in ("video", "playlist") else None
     
-    video_pattern = r'https?://www\.youtube\.com/watch\?v=[^&]+'
-    if re.match(video_pattern, link) and strategy_type == "playlist":
-        messagebox.showerror("Invalid Operation", "The provided link is a video link, not a playlist!")
-        return
-    if "youtube.com/playlist?list=" in link and strategy_type == "video":
-        messagebox.showerror("Invalid Operation", "The provided link is a playlist link, not a video!")
-        return
-    if "youtube.com/playlist?list=" in link and strategy_type == "thumbnail":
-        messagebox.showerror("Invalid Operation", "The provided link is a playlist link, a playlist doesn't have a thumbnail")
+    error = validate_link(strategy_type, link)
+    if error:
+        ui_messages.put((messagebox.showerror, ("Invalid Operation", error)))
         return
     
-    context = DownloaderContext(strategy_type=strategy_type, link=link, folder=folder, quality=quality, progress_callback=progress_stream)
-    context.execute_download()
+    context = DownloaderContext(strategy_type=strategy_type, link=link, folder=folder, quality=quality, progress_channel=progress_channel)
+    job = context.start_download()
+    running_downloads.add(job)
+    job.add_done_callback(lambda job: report_download(strategy_type, job))
+
+def report_download(strategy_type, job):
+    """Post the outcome of a finished download to the main loop."""
+    running_downloads.discard(job)
+    try:
+        succeeded, error = describe_result(strategy_type, job.result())
+    except DownloadCancelled:
+        ui_messages.put((messagebox.showinfo, ("Download cancelled", f"The {strategy_type} download was cancelled")))
+        return
+    except Exception as e:
+        succeeded, error = False, str(e)
+    if succeeded:
+        ui_messages.put((messagebox.showinfo, ("Download finished", f"The {strategy_type} is successfully downloaded")))
+    else:
+        ui_messages.put((messagebox.showerror, ("Download failed", error)))
+
+def cancel_downloads():
+    """Cancel every download started from the window that hasn't finished yet."""
+    for job in list(running_downloads):
+        job.cancel()
 
     
-@threaded
 def populate_qualities():
+    fetch_qualities(components["Link"].get())
+
+@threaded
+def fetch_qualities(link):
+    ui_messages.put((set_quality_choices, (get_available_qualities(link),)))
+
+def probe_playlist():
+    """Offer the qualities of every video of the playlist, not only of its first one."""
     link = components["Link"].get()
-    dropdown_values = get_available_qualities(link)
+    if "youtube.com/playlist?list=" not in link:
+        ui_messages.put((messagebox.showerror, ("Invalid Operation", "Probing needs a playlist link.")))
+        return
+    fetch_playlist_qualities(link)
+
+@threaded
+def fetch_playlist_qualities(link):
+    # Resolves every video of the playlist, so it only runs when asked for.
+    ui_messages.put((set_quality_choices, (get_quality_choices(link),)))
 
+def set_quality_choices(dropdown_values):
     components["qualityDropdown"]["values"] = dropdown_values
     if dropdown_values:
         components["qualityDropdown"].set(dropdown_values[0])  # Set to the first value
@@ -82,16 +151,23 @@ def reset_all():
     components["videoNameLabel"].config(text="")
     components["qualityDropdown"].set("")
     components["progressBar"]['value'] = 0
+    components["progressLabel"].config(text="")
     components["fileLocationLabel"].config(text="Not selected")
 
 # Initialize and Bind to GUI
 window = Tk()
 components = setup_gui(window, populate_qualities)
 
-Button(window, text="Download Playlist", command=lambda: execute_download("playlist")).place(x=250, y=180)
-Button(window, text="Download Video", command=lambda: execute_download("video")).place(x=375, y=180)
-Button(window, text="Download Thumbnail", command=lambda: execute_download("thumbnail")).place(x=490, y=180)
+Button(window, text="Download Playlist", command=lambda: start_download("playlist")).place(x=250, y=180)
+Button(window, text="Download Video", command=lambda: start_download("video")).place(x=375, y=180)
+Button(window, text="Download Thumbnail", command=lambda: start_download("thumbnail")).place(x=490, y=180)
+Button(window, text="Download Audio", command=lambda: start_download("audio")).place(x=635, y=180)
 components["LinkEntry"].bind("<FocusOut>", update_video_name_label)
+Button(window, text="Probe Playlist", command=probe_playlist).place(x=860, y=80)
 Button(window, text="Reset", command=reset_all).place(x=800, y=215, width=150)
+Button(window, text="Cancel Downloads", command=cancel_downloads).place(x=800, y=250, width=150)
 
+window.after(PROGRESS_TICK_MS, poll_progress)
 window.mainloop()
+# Don't leave ffmpeg running behind a closed window.
+download_engine.shutdown()
@@ -0,0 +1,73 @@
+import asyncio
+import os
+
+# Number of ffmpeg merges run at the same time. Stream copies are disk-bound, so a few are enough.
+DEFAULT_MERGE_WORKERS = max(2, (os.cpu_count() or 2) // 2)
+
+# Number of merges queued or running before downloads wanting to queue another one wait.
+DEFAULT_MAX_PENDING = 2 * DEFAULT_MERGE_WORKERS
+
+
+class MergePool:
+    """
+    Helper class responsible for running the merges of downloaded video/audio pairs as tasks of
+    the download engine's event loop, so a download hands its pair over and moves on while
+    ffmpeg muxes.
+
+    At most `workers` merges run at once and `max_pending` are queued or running. A download
+    handing over one more waits until a merge finishes, so the temporary files of downloaded
+    pairs don't pile up faster than ffmpeg can turn them into videos.
+    """
+
+    def __init__(self, workers: int = DEFAULT_MERGE_WORKERS, max_pending: int = DEFAULT_MAX_PENDING) -> None:
+        """
+        :param workers: Number of merges run at the same time.
+        :param max_pending: Number of merges queued or running at the same time.
+        """
+        # Created on the loop by the first merge, as asyncio primitives belong to one loop.
+        self._condition = None
+        self._slots = None
+        self._pending = 0
+        self.workers = workers
+        self.max_pending = max_pending
+
+    def configure(self, workers: int = DEFAULT_MERGE_WORKERS, max_pending: int = None) -> None:
+        """Resize the pool; merges already queued finish under the old bound."""
+        self.workers = max(1, workers)
+        self.max_pending = max(self.workers, max_pending or 2 * self.workers)
+        self._slots = None
+
+    async def submit(self, coroutine_fn, *args) -> asyncio.Task:
+        """
+        Queue `coroutine_fn(*args)`, typically wrapping a `FileMerger.merge` call, waiting first
+        while `max_pending` merges are already queued or running.
+
+        :return: Task of what the merge returns.
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._pending < self.max_pending)
+            self._pending += 1
+        return asyncio.ensure_future(self._run(self._slots, coroutine_fn, *args))
+
+    async def _run(self, slots: asyncio.Semaphore, coroutine_fn, *args):
+        try:
+            async with slots:
+                return await coroutine_fn(*args)
+        finally:
+            async with self._condition:
+                self._pending -= 1
+                self._condition.notify()
+
+    @property
+    def pending(self) -> int:
+        """Merges queued or running."""
+        return self._pending
+
+
+# Pool shared by every download of the process, so the number of ffmpeg merges stays bounded
+# however many playlists and jobs run at once.
+merge_pool = MergePool()
@@ -0,0 +1,478 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+from urllib.parse import urlsplit, parse_qs
+
+# pytube is imported where it is first needed, so processes that never resolve a link don't pay for it.
+if TYPE_CHECKING:
+    from pytube import YouTube, Playlist
+    from pytube.monostate import Monostate
+    from pytube.query import StreamQuery
+    from stream_index import StreamIndex
+
+# How long a resolved video or playlist is reused before it is looked up again, in seconds.
+DEFAULT_TTL = 60 * 60
+
+# Signed stream URLs stop working at the `expire` time they carry; stop using them a bit earlier.
+STREAM_URL_EXPIRY_MARGIN = 5 * 60
+
+DEFAULT_MAX_ENTRIES = 512
+
+# Keys of a stream's format entry that `Stream` needs to be rebuilt later.
+MANIFEST_KEYS = ("url", "itag", "mimeType", "is_otf", "bitrate", "contentLength", "fps")
+
+
+class CachedVideo:
+    """
+    Snapshot of the metadata of a YouTube video: title, thumbnail URL and stream manifest.
+
+    It offers the parts of the `YouTube` interface the downloader uses (`title`, `thumbnail_url`,
+    `streams`, `register_on_progress_callback`), so it can be passed wherever a `YouTube` object was.
+    """
+
+    def __init__(self, video_id: str, title: str, thumbnail_url: str, manifest: list) -> None:
+        """
+        :param video_id: The 11 character YouTube video ID.
+        :param title: Title of the video.
+        :param thumbnail_url: URL of the largest thumbnail.
+        :param manifest: List of deciphered stream format entries (see `MANIFEST_KEYS`).
+        """
+        self.video_id = video_id
+        self.title = title
+        self.thumbnail_url = thumbnail_url
+        self.manifest = manifest
+        self.watch_url = f"https://youtube.com/watch?v={video_id}"
+        self._stream_monostate = None
+        self._streams = None
+        self._stream_index = None
+
+    @property
+    def stream_monostate(self) -> "Monostate":
+        """State shared by the streams of the video, such as the progress callbacks."""
+        if self._stream_monostate is None:
+            from pytube.monostate import Monostate
+            self._stream_monostate = Monostate(on_progress=None, on_complete=None, title=self.title)
+        return self._stream_monostate
+
+    @property
+    def streams(self) -> "StreamQuery":
+        """The streams of the video, rebuilt from the manifest on first use."""
+        if self._streams is None:
+            from pytube.query import StreamQuery
+            from pytube.streams import Stream
+            self._streams = StreamQuery([Stream(stream=entry, monostate=self.stream_monostate) for entry in self.manifest])
+        return self._streams
+
+    @property
+    def stream_index(self) -> "StreamIndex":
+        """The streams of the video sorted for selection, built on first use with the manifest's sizes."""
+        if self._stream_index is None:
+            from stream_index import StreamIndex
+            sizes = {entry["itag"]: int(entry["contentLength"]) for entry in self.manifest
+                     if str(entry.get("contentLength", "")).isdigit()}
+            self._stream_index = StreamIndex(self.streams, sizes)
+        return self._stream_index
+
+    def register_on_progress_callback(self, func) -> None:
+        self.stream_monostate.on_progress = func
+
+    def register_on_complete_callback(self, func) -> None:
+        self.stream_monostate.on_complete = func
+
+    def expires_at(self, ttl: float) -> float:
+        """Return when this entry should be dropped: after `ttl`, or before its stream URLs expire."""
+        expires_at = time.time() + ttl
+        for entry in self.manifest:
+            expire = parse_qs(urlsplit(entry["url"]).query).get("expire")
+            if expire and expire[0].isdigit():
+                expires_at = min(expires_at, int(expire[0]) - STREAM_URL_EXPIRY_MARGIN)
+        return expires_at
+
+    @classmethod
+    def from_youtube(cls, yt: "YouTube") -> "CachedVideo":
+        """Resolve everything the downloader needs from a `YouTube` object in one go."""
+        # Building `streams` deciphers the signed URLs in place inside `streaming_data`.
+        yt.streams
+        formats = yt.streaming_data.get("formats", []) + yt.streaming_data.get("adaptiveFormats", [])
+        manifest = [{key: entry[key] for key in MANIFEST_KEYS if key in entry} for entry in formats if "url" in entry]
+        return cls(video_id=yt.video_id, title=yt.title, thumbnail_url=yt.thumbnail_url, manifest=manifest)
+
+    def to_dict(self) -> dict:
+        return {"video_id": self.video_id, "title": self.title, "thumbnail_url": self.thumbnail_url, "manifest": self.manifest}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CachedVideo":
+        return cls(**data)
+
+
+class CachedPlaylist:
+    """Snapshot of the metadata of a YouTube playlist: its title and the URLs of its videos."""
+
+    def __init__(self, playlist_id: str, title: str, video_urls: list) -> None:
+        """
+        :param playlist_id: The YouTube playlist ID.
+        :param title: Title of the playlist.
+        :param video_urls: Watch URLs of the playlist entries, in playlist order.
+        """
+        self.playlist_id = playlist_id
+        self.title = title
+        self.video_urls = video_urls
+
+    def expires_at(self, ttl: float) -> float:
+        return time.time() + ttl
+
+    @classmethod
+    def from_playlist(cls, playlist: "Playlist") -> "CachedPlaylist":
+        return cls(playlist_id=playlist.playlist_id, title=playlist.title, video_urls=list(playlist.video_urls))
+
+    def to_dict(self) -> dict:
+        return {"playlist_id": self.playlist_id, "title": self.title, "video_urls": self.video_urls}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "CachedPlaylist":
+        return cls(**data)
+
+
+def sort_qualities(qualities) -> list:
+    """De-duplicate resolutions such as `720p` and sort them from lowest to highest."""
+    return sorted(set(qualities), key=lambda quality: int(quality[:-1]))
+
+
+class QualityMatrix:
+    """
+    The video qualities each entry of a playlist is available in, found by probing the stream
+    manifest of every entry.
+    """
+
+    def __init__(self, playlist_id: str, qualities: dict, failed: list = None) -> None:
+        """
+        :param playlist_id: The YouTube playlist ID.
+        :param qualities: Qualities of each probed video, by watch URL, in playlist order.
+        :param failed: (optional) Watch URLs of the videos that couldn't be probed.
+        """
+        self.playlist_id = playlist_id
+        self.qualities = qualities
+        self.failed = failed or []
+
+    @property
+    def available(self) -> list:
+        """Qualities at least one video has."""
+        return sort_qualities(quality for video_qualities in self.qualities.values() for quality in video_qualities)
+
+    @property
+    def universal(self) -> list:
+        """Qualities every probed video has."""
+        if not self.qualities:
+            return []
+        common = set.intersection(*(set(video_qualities) for video_qualities in self.qualities.values()))
+        return sort_qualities(common)
+
+    def coverage(self, quality: str) -> int:
+        """Number of probed videos available in `quality`."""
+        return sum(1 for video_qualities in self.qualities.values() if quality in video_qualities)
+
+    def expires_at(self, ttl: float) -> float:
+        return time.time() + ttl
+
+    def to_dict(self) -> dict:
+        return {"playlist_id": self.playlist_id, "qualities": self.qualities, "failed": self.failed}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QualityMatrix":
+        return cls(**data)
+
+
+class PlaylistEnumeration:
+    """
+    Entries of a playlist, made available as they are paged in.
+
+    A background thread follows the playlist's continuation pages while consumers iterate over
+    the entries found so far, so the first videos can be used long before the last page of a
+    large playlist is known. Iterating only blocks when a consumer catches up with the pages.
+    Any number of consumers can iterate at once, each from the first entry.
+    """
+
+    def __init__(self, playlist_id: str, title: str, video_urls: list = None, url_iterator=None, on_complete=None) -> None:
+        """
+        :param playlist_id: The YouTube playlist ID.
+        :param title: Title of the playlist.
+        :param video_urls: (optional) Entries already known, e.g. from the cache.
+        :param url_iterator: (optional) Iterator over the remaining entries, consumed in the background.
+                             Without it, the entries are complete.
+        :param on_complete: (optional) Called with the `CachedPlaylist` once every page is in,
+                            or with None if the enumeration failed.
+        """
+        self.playlist_id = playlist_id
+        self.title = title
+        self._urls = list(video_urls or [])
+        self._done = url_iterator is None
+        self._error = None
+        self._condition = threading.Condition()
+        if url_iterator is not None:
+            threading.Thread(target=self._enumerate, args=(url_iterator, on_complete), daemon=True).start()
+
+    @property
+    def complete(self) -> bool:
+        return self._done and self._error is None
+
+    @property
+    def count(self) -> int:
+        """Number of entries known so far."""
+        return len(self._urls)
+
+    def __iter__(self):
+        index = 0
+        while True:
+            with self._condition:
+                while index >= len(self._urls) and not self._done:
+                    self._condition.wait()
+                if index < len(self._urls):
+                    url = self._urls[index]
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    return
+            yield url
+            index += 1
+
+    def wait(self) -> CachedPlaylist:
+        """Block until every page is in and return the whole playlist. Raises the enumeration's error, if any."""
+        with self._condition:
+            while not self._done:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+            return CachedPlaylist(playlist_id=self.playlist_id, title=self.title, video_urls=list(self._urls))
+
+    def _enumerate(self, url_iterator, on_complete) -> None:
+        try:
+            for url in url_iterator:
+                with self._condition:
+                    self._urls.append(url)
+                    self._condition.notify_all()
+        except Exception as e:
+            with self._condition:
+                self._error = e
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+        if on_complete:
+            on_complete(self.wait() if self._error is None else None)
+
+
+class MetadataCache:
+    """
+    Cache of resolved videos and playlists, keyed by video or playlist ID, so each link is looked
+    up on YouTube once no matter how many parts of the app ask about it.
+
+    Entries live in memory with a time-to-live and least-recently-used eviction. When a cache
+    directory is set, entries are also written there as JSON so later sessions can reuse them.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL, cache_dir: str = None) -> None:
+        """
+        :param max_entries: Number of entries kept in memory before the least recently used is dropped.
+        :param ttl: Time-to-live of an entry, in seconds.
+        :param cache_dir: (optional) Directory of the on-disk layer. None keeps the cache in memory only.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Lock of each key being resolved, with the number of threads holding or waiting on it.
+        self._key_locks = {}
+        # Playlists being paged in, shared by everyone asking for them until they are complete.
+        self._enumerations = {}
+
+    def get_video(self, link: str) -> CachedVideo:
+        """Return the metadata of the video at `link`, resolving it on YouTube on a cache miss."""
+        from pytube import YouTube, extract
+        return self._get(f"video_{extract.video_id(link)}", CachedVideo,
+                         lambda: CachedVideo.from_youtube(YouTube(link)))
+
+    def get_playlist(self, link: str) -> CachedPlaylist:
+        """Return the metadata of the playlist at `link`, resolving it on YouTube on a cache miss.
+        Waits for every page of the playlist; see `stream_playlist` to start on the first ones."""
+        return self.stream_playlist(link).wait()
+
+    def stream_playlist(self, link: str) -> PlaylistEnumeration:
+        """
+        Return the entries of the playlist at `link` as they are paged in.
+
+        Only the first page has been fetched when this returns; the others follow in the
+        background. A cached playlist comes back complete. The finished enumeration is cached.
+        """
+        from pytube import Playlist, extract
+        key = f"playlist_{extract.playlist_id(link)}"
+        entry = self._lookup(key, CachedPlaylist)
+        if entry is not None:
+            return PlaylistEnumeration(entry.playlist_id, entry.title, video_urls=entry.video_urls)
+
+        with self._key_lock(key):
+            entry = self._lookup(key, CachedPlaylist)
+            if entry is not None:
+                enumeration = PlaylistEnumeration(entry.playlist_id, entry.title, video_urls=entry.video_urls)
+            else:
+                with self._lock:
+                    enumeration = self._enumerations.get(key)
+                if enumeration is None:
+                    playlist = Playlist(link)
+                    enumeration = PlaylistEnumeration(playlist.playlist_id, playlist.title,
+                                                      url_iterator=playlist.url_generator(),
+                                                      on_complete=lambda complete: self._finish_enumeration(key, complete))
+                    with self._lock:
+                        if not enumeration._done:
+                            self._enumerations[key] = enumeration
+        return enumeration
+
+    def get_quality_matrix(self, link: str, probe) -> QualityMatrix:
+        """
+        Return the quality matrix of the playlist at `link`, building it on a cache miss.
+
+        :param probe: Callable taking the link and returning its `QualityMatrix`.
+        """
+        from pytube import extract
+        return self._get(f"qualities_{extract.playlist_id(link)}", QualityMatrix, lambda: probe(link))
+
+    def fit(self, count: int) -> None:
+        """
+        Keep `count` entries in memory together on top of the usual bound, e.g. the videos of a
+        probed playlist, whose download looks them up again. The bound never shrinks back, so
+        it ends up fitting the largest playlist probed.
+        """
+        with self._lock:
+            self.max_entries = max(self.max_entries, count + DEFAULT_MAX_ENTRIES)
+
+    def _finish_enumeration(self, key: str, playlist: CachedPlaylist) -> None:
+        if playlist is not None:
+            self._store(key, playlist)
+        with self._lock:
+            self._enumerations.pop(key, None)
+
+    def put(self, entry) -> None:
+        """Store an already resolved `CachedVideo` or `CachedPlaylist`."""
+        if isinstance(entry, CachedVideo):
+            self._store(f"video_{entry.video_id}", entry)
+        else:
+            self._store(f"playlist_{entry.playlist_id}", entry)
+
+    def invalidate(self, link: str) -> None:
+        """Forget whatever is cached for the video or playlist at `link`."""
+        from pytube import extract
+        keys = []
+        if "list=" in link:
+            keys.append(f"playlist_{extract.playlist_id(link)}")
+            keys.append(f"qualities_{extract.playlist_id(link)}")
+        else:
+            keys.append(f"video_{extract.video_id(link)}")
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                self._enumerations.pop(key, None)
+        for key in keys:
+            path = self._disk_path(key)
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def clear(self) -> None:
+        """Drop every in-memory entry. The on-disk layer is left untouched."""
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, key: str, entry_class, resolve):
+        entry = self._lookup(key, entry_class)
+        if entry is not None:
+            return entry
+
+        # Only one thread resolves a given key; the others wait and then read its result.
+        with self._key_lock(key):
+            entry = self._lookup(key, entry_class)
+            if entry is None:
+                entry = resolve()
+                self._store(key, entry)
+        return entry
+
+    @contextmanager
+    def _key_lock(self, key: str):
+        """Hold the lock of `key`. It is forgotten only once no thread holds or waits on it,
+        so a thread arriving meanwhile never gets a lock of its own and resolves the key again."""
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                yield
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self._key_locks[key]
+
+    def _lookup(self, key: str, entry_class):
+        with self._lock:
+            if key in self._entries:
+                expires_at, entry = self._entries[key]
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+
+        entry, expires_at = self._read_disk(key, entry_class)
+        if entry is not None:
+            self._remember(key, entry, expires_at)
+        return entry
+
+    def _store(self, key: str, entry) -> None:
+        expires_at = entry.expires_at(self.ttl)
+        self._remember(key, entry, expires_at)
+        self._write_disk(key, entry, expires_at)
+
+    def _remember(self, key: str, entry, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (expires_at, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, key: str):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_disk(self, key: str, entry_class):
+        path = self._disk_path(key)
+        if not path or not os.path.exists(path):
+            return None, 0
+        try:
+            with open(path, encoding="utf-8") as fh:
+                record = json.load(fh)
+            if record["expires_at"] <= time.time():
+                os.remove(path)
+                return None, 0
+            return entry_class.from_dict(record["data"]), record["expires_at"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring unreadable cache entry {path}: {e}")
+            return None, 0
+
+    def _write_disk(self, key: str, entry, expires_at: float) -> None:
+        path = self._disk_path(key)
+        if not path:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as fh:
+                json.dump({"expires_at": expires_at, "data": entry.to_dict()}, fh)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Error writing cache entry {path}: {e}")
+
+
+# Cache shared by the GUI, the quality probe and the download strategies.
+metadata_cache = MetadataCache()
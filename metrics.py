@@ -0,0 +1,247 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# Prefix of every exported Prometheus metric.
+METRIC_PREFIX = "youtube_downloader"
+
+# Functions of the transfer loops, as (file name, function name). The sampling profiler only keeps
+# the stacks of threads that are inside one of them.
+TRANSFER_FUNCTIONS = {
+    ("utils.py", "download_stream"),
+    ("utils.py", "_feed_pipe"),
+    ("thumbnails.py", "fetch"),
+    ("segmented_downloader.py", "_fetch_range"),
+}
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+class JobMetrics:
+    """
+    Timings and counters of one download job: how long each phase took, how many bytes were
+    transferred, how often a phase was retried and how every ffmpeg run ended.
+
+    Phases may run in several threads at once; their durations add up.
+    """
+
+    def __init__(self, job_id: str, strategy: str) -> None:
+        """
+        :param job_id: Identifies the job, typically its link.
+        :param strategy: Strategy type of the job, e.g. `video`.
+        """
+        self.job_id = job_id
+        self.strategy = strategy
+        self.started_at = time.time()
+        self.phases = {}
+        self.retries = Counter()
+        self.ffmpeg_runs = []
+        self.bytes = 0
+        self.status = None
+        self.elapsed = None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Add the time spent in the block to the phase `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        """Add `seconds` to the phase `name`, for time not spent inside a block, e.g. a scheduled backoff."""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count_retry(self, phase: str) -> None:
+        with self._lock:
+            self.retries[phase] += 1
+
+    def record_ffmpeg(self, exit_status: int, duration: float, mode: str) -> None:
+        """
+        :param exit_status: Exit status of ffmpeg, or None if it couldn't be started.
+        :param duration: Seconds ffmpeg ran for.
+        :param mode: `files` for a merge of downloaded files, `pipes` for a streaming merge,
+                     `copy` or `transcode` for an audio conversion.
+        """
+        with self._lock:
+            self.ffmpeg_runs.append({"exit_status": exit_status, "duration": duration, "mode": mode})
+
+    def finish(self, status: str, bytes_transferred: int) -> None:
+        """Close the job with its final status (`ok`, `failed` or `cancelled`) and byte count."""
+        self.status = status
+        self.bytes = bytes_transferred
+        self.elapsed = time.perf_counter() - self._start
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second over the whole job, waiting and merging included."""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def transfer_throughput(self) -> float:
+        """Bytes per second over the time spent transferring."""
+        transfer_time = self.phases.get("transfer", 0.0) + self.phases.get("stream_merge", 0.0)
+        return self.bytes / transfer_time if transfer_time else 0.0
+
+    def to_dict(self) -> dict:
+        return {"job": self.job_id, "strategy": self.strategy, "status": self.status, "started_at": self.started_at,
+                "elapsed": self.elapsed, "phases": dict(self.phases), "bytes": self.bytes,
+                "throughput": self.throughput, "transfer_throughput": self.transfer_throughput,
+                "retries": dict(self.retries), "ffmpeg": list(self.ffmpeg_runs)}
+
+
+class MetricsRecorder:
+    """
+    Helper class responsible for exporting the metrics of finished jobs.
+
+    Every job is appended to a JSON lines file, and the totals of all jobs since the process
+    started are rewritten to a Prometheus textfile (for node_exporter's textfile collector) after
+    each job. Both outputs are optional; with neither configured, recording does nothing.
+    """
+
+    def __init__(self, jsonl_path: str = None, prometheus_path: str = None) -> None:
+        """
+        :param jsonl_path: (optional) File the metrics of every job are appended to.
+        :param prometheus_path: (optional) Prometheus textfile the totals are written to.
+        """
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self._jobs = Counter()
+        self._phase_seconds = defaultdict(float)
+        self._bytes = Counter()
+        self._retries = Counter()
+        self._ffmpeg_runs = Counter()
+        self._ffmpeg_seconds = defaultdict(float)
+        self._last_throughput = {}
+
+    def configure(self, jsonl_path: str = None, prometheus_path: str = None) -> None:
+        with self._lock:
+            self.jsonl_path = jsonl_path
+            self.prometheus_path = prometheus_path
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.jsonl_path or self.prometheus_path)
+
+    def record(self, job: JobMetrics) -> None:
+        """Export a finished job. Safe to call from any thread; export errors are printed, not raised."""
+        if not self.enabled:
+            return
+        with self._lock:
+            strategy = job.strategy
+            self._jobs[strategy, job.status] += 1
+            for phase, seconds in job.phases.items():
+                self._phase_seconds[strategy, phase] += seconds
+            self._bytes[strategy] += job.bytes
+            for phase, count in job.retries.items():
+                self._retries[strategy, phase] += count
+            for run in job.ffmpeg_runs:
+                self._ffmpeg_runs[run["mode"], str(run["exit_status"])] += 1
+                self._ffmpeg_seconds[run["mode"]] += run["duration"]
+            if job.bytes:
+                self._last_throughput[strategy] = job.throughput
+            try:
+                if self.jsonl_path:
+                    with open(self.jsonl_path, "a", encoding="utf-8") as fh:
+                        fh.write(json.dumps(job.to_dict()) + "\n")
+                if self.prometheus_path:
+                    self._write_prometheus()
+            except OSError as e:
+                print(f"Error writing download metrics: {e}")
+
+    def _write_prometheus(self) -> None:
+        lines = []
+
+        def add(name, kind, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for labels, value in sorted(samples.items()):
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value:.10g}")
+
+        add("jobs_total", "counter", "Download jobs finished, by strategy and status.",
+            {(("strategy", s), ("status", status)): n for (s, status), n in self._jobs.items()})
+        add("phase_seconds_total", "counter", "Time spent in each phase of the download jobs.",
+            {(("strategy", s), ("phase", phase)): v for (s, phase), v in self._phase_seconds.items()})
+        add("bytes_total", "counter", "Bytes transferred by the download jobs.",
+            {(("strategy", s),): v for s, v in self._bytes.items()})
+        add("retries_total", "counter", "Retries of a phase of the download jobs.",
+            {(("strategy", s), ("phase", phase)): n for (s, phase), n in self._retries.items()})
+        add("ffmpeg_runs_total", "counter", "ffmpeg runs, by merge mode and exit status.",
+            {(("mode", mode), ("exit_status", status)): n for (mode, status), n in self._ffmpeg_runs.items()})
+        add("ffmpeg_seconds_total", "counter", "Time ffmpeg ran for, by merge mode.",
+            {(("mode", mode),): v for mode, v in self._ffmpeg_seconds.items()})
+        add("last_job_throughput_bytes_per_second", "gauge", "Effective throughput of the last job of each strategy.",
+            {(("strategy", s),): v for s, v in self._last_throughput.items()})
+
+        # Write and rename so the collector never reads a half-written file.
+        temp_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as fh:
+            fh.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.prometheus_path)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of the transfer loops.
+
+    A background thread looks at the stack of every thread `interval` times per second and counts
+    the stacks that are inside one of the `TRANSFER_FUNCTIONS`. `write()` saves them in the
+    collapsed format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = DEFAULT_SAMPLE_INTERVAL) -> None:
+        """
+        :param interval: Seconds between two samples.
+        """
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> "SamplingProfiler":
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def write(self, path: str) -> None:
+        """Write the collected stacks, one `frame;frame;frame count` line per distinct stack."""
+        with open(path, "w", encoding="utf-8") as fh:
+            for stack, count in self.samples.most_common():
+                fh.write(f"{';'.join(stack)} {count}\n")
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                in_transfer = False
+                while frame is not None:
+                    code = frame.f_code
+                    file_name = os.path.basename(code.co_filename)
+                    in_transfer = in_transfer or (file_name, code.co_name) in TRANSFER_FUNCTIONS
+                    stack.append(f"{file_name}:{code.co_name}")
+                    frame = frame.f_back
+                if in_transfer:
+                    self.samples[tuple(reversed(stack))] += 1
+
+
+# Recorder shared by every download of the process. Exports nothing until configured.
+metrics_recorder = MetricsRecorder()
@@ -0,0 +1,196 @@
+import errno
+import os
+import shutil
+import threading
+
+# Size of the write buffer of each output file. Network reads come in 64 KiB blocks; gathering
+# them into larger writes keeps spinning disks and network filesystems streaming.
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# When written data is forced to the device.
+FSYNC_NEVER = "never"        # Leave it to the OS, the fastest.
+FSYNC_CLOSE = "close"        # Once per file, when it is closed.
+FSYNC_PERIODIC = "periodic"  # Every `sync_interval` bytes, so dirty pages never pile up.
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_CLOSE, FSYNC_PERIODIC)
+
+DEFAULT_SYNC_INTERVAL = 64 * 1024 * 1024
+
+# Space left free on the destination on top of what the downloads need.
+DEFAULT_MIN_FREE = 64 * 1024 * 1024
+
+
+class InsufficientSpaceError(OSError):
+    """The destination doesn't have room for a download."""
+
+    def __init__(self, folder: str, needed: int, available: int) -> None:
+        super().__init__(errno.ENOSPC, f"Not enough space in '{folder}': {needed / 1024 ** 2:.1f} MiB needed, "
+                                       f"{available / 1024 ** 2:.1f} MiB available")
+        self.needed = needed
+        self.available = available
+
+
+class Reservation:
+    """Space set aside on a device for one download until it is released."""
+
+    def __init__(self, writer: "OutputWriter", device: int, size: int) -> None:
+        self._writer = writer
+        self.device = device
+        self.size = size
+
+    def release(self) -> None:
+        """Give the space back; releasing twice is harmless."""
+        size, self.size = self.size, 0
+        if size:
+            self._writer._release(self.device, size)
+
+
+class OutputFile:
+    """
+    A file opened by `OutputWriter`: buffered writes, preallocated when its size is known, and
+    synced to the device as the writer's fsync policy says.
+    """
+
+    def __init__(self, path: str, mode: str, buffer_size: int, fsync: str, sync_interval: int) -> None:
+        self.path = path
+        self.fsync = fsync
+        self.sync_interval = sync_interval
+        self._fh = open(path, mode, buffering=buffer_size)
+        self._unsynced = 0
+
+    def seek(self, offset: int) -> int:
+        return self._fh.seek(offset)
+
+    def tell(self) -> int:
+        return self._fh.tell()
+
+    def write(self, data) -> int:
+        written = self._fh.write(data)
+        if self.fsync == FSYNC_PERIODIC:
+            self._unsynced += written
+            if self._unsynced >= self.sync_interval:
+                self.sync()
+        return written
+
+    def sync(self) -> None:
+        """Flush the buffer and force the file's data to the device."""
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+
+    def close(self) -> None:
+        if self._fh.closed:
+            return
+        try:
+            if self.fsync != FSYNC_NEVER:
+                self.sync()
+        finally:
+            self._fh.close()
+
+    def __enter__(self) -> "OutputFile":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.close()
+
+
+class OutputWriter:
+    """
+    Helper class responsible for where downloads write to disk.
+
+    Before a download starts, `reserve()` checks that the destination has room for every file
+    the download will write, so a full disk fails the job at once rather than after most of the
+    transfer. Space reserved by downloads still running is counted as taken, so jobs starting
+    together don't all count on the same free space. Files of known size are preallocated,
+    which keeps them in few extents, and written through large buffers.
+    """
+
+    def __init__(self, buffer_size: int = DEFAULT_BUFFER_SIZE, fsync: str = FSYNC_NEVER,
+                 sync_interval: int = DEFAULT_SYNC_INTERVAL, min_free: int = DEFAULT_MIN_FREE) -> None:
+        """
+        :param buffer_size: Size of the write buffer of each file, in bytes.
+        :param fsync: When data is forced to the device: `never`, `close` or `periodic`.
+        :param sync_interval: Bytes written between two syncs with the `periodic` policy.
+        :param min_free: Bytes left free on the destination on top of what the downloads need.
+        """
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.sync_interval = sync_interval
+        self.min_free = min_free
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+    def configure(self, buffer_size: int = DEFAULT_BUFFER_SIZE, fsync: str = FSYNC_NEVER,
+                  sync_interval: int = DEFAULT_SYNC_INTERVAL, min_free: int = DEFAULT_MIN_FREE) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}', expected one of {', '.join(FSYNC_POLICIES)}")
+        self.buffer_size = max(4096, buffer_size or DEFAULT_BUFFER_SIZE)
+        self.fsync = fsync
+        self.sync_interval = max(self.buffer_size, sync_interval or DEFAULT_SYNC_INTERVAL)
+        self.min_free = min_free if min_free is not None else DEFAULT_MIN_FREE
+
+    def reserve(self, folder: str, size: int) -> Reservation:
+        """
+        Set aside `size` bytes in `folder` for a download.
+
+        :return: The reservation, to be released once the download's files are final.
+        :raises InsufficientSpaceError: If the free space, less the space other downloads
+                                        reserved and `min_free`, is smaller than `size`.
+        """
+        os.makedirs(folder, exist_ok=True)
+        device = os.stat(folder).st_dev
+        with self._lock:
+            available = shutil.disk_usage(folder).free - self._reserved.get(device, 0) - self.min_free
+            if size > available:
+                raise InsufficientSpaceError(folder, size, max(0, available))
+            self._reserved[device] = self._reserved.get(device, 0) + size
+        return Reservation(self, device, size)
+
+    def _release(self, device: int, size: int) -> None:
+        with self._lock:
+            self._reserved[device] -= size
+            if self._reserved[device] <= 0:
+                del self._reserved[device]
+
+    def open(self, path: str, mode: str = "wb", size: int = None) -> OutputFile:
+        """
+        Open a file for writing with the writer's buffer size and fsync policy.
+
+        :param mode: `wb` to start the file over, `r+b` to write into an existing one.
+        :param size: (optional) Final size of the file, preallocated when starting it over.
+        """
+        if size and mode == "wb":
+            self.preallocate(path, size)
+            mode = "r+b"
+        return OutputFile(path, mode, self.buffer_size, self.fsync, self.sync_interval)
+
+    @staticmethod
+    def preallocate(path: str, size: int, keep: bool = False) -> None:
+        """
+        Make `path` a file of `size` bytes with its blocks allocated up front where the
+        filesystem supports it, and sized with a sparse truncate where it doesn't.
+
+        :param keep: Keep the existing content of the file, e.g. when resuming a download.
+        """
+        with open(path, "r+b" if keep and os.path.exists(path) else "wb") as fh:
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fh.fileno(), 0, size)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        raise
+                    # The filesystem doesn't allocate ahead (e.g. some network mounts).
+            fh.truncate(size)
+
+    def sync_path(self, path: str) -> None:
+        """Force a file written by someone else, e.g. ffmpeg, to the device unless the policy is `never`."""
+        if self.fsync == FSYNC_NEVER or not path or not os.path.exists(path):
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# Writer shared by every download of the process, so space reservations see every running job.
+output_writer = OutputWriter()
@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import time
+
+MANIFEST_FILENAME = ".playlist_manifest.json"
+
+# States of a manifest entry.
+DOWNLOADING = "downloading"
+COMPLETE = "complete"
+FAILED = "failed"
+
+
+def video_id_of(url: str) -> str:
+    from pytube import extract
+    return extract.video_id(url)
+
+
+class SyncPlan:
+    """What a sync run has to do to bring a playlist folder up to date."""
+
+    def __init__(self, to_download: list, up_to_date: list, moved: list, removed: list) -> None:
+        """
+        :param to_download: Indexes (0-based) of the entries that are new or incomplete.
+        :param up_to_date: Indexes of the entries already downloaded at the wanted quality.
+        :param moved: Up to date entries whose position changed, as (video ID, old number, new number).
+        :param removed: Video IDs of manifest entries no longer in the playlist.
+        """
+        self.to_download = to_download
+        self.up_to_date = up_to_date
+        self.moved = moved
+        self.removed = removed
+
+
+class PlaylistManifest:
+    """
+    Helper class responsible for recording what has been downloaded into a playlist folder, so a
+    later run only fetches the new or incomplete entries.
+
+    The manifest maps each video ID to its playlist number, quality, output file, size and state.
+    It is saved in the folder as JSON after every change, so an interrupted run loses nothing.
+    """
+
+    def __init__(self, folder: str) -> None:
+        """
+        Load the manifest of `folder`, or start an empty one.
+
+        :param folder: The playlist folder.
+        """
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILENAME)
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as fh:
+                    self.entries = json.load(fh).get("entries", {})
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable playlist manifest {self.path}: {e}")
+
+    def plan(self, video_urls: list, quality: str) -> SyncPlan:
+        """Compare the manifest with the current playlist entries."""
+        to_download, up_to_date, moved = [], [], []
+        current_ids = set()
+        for index, url in enumerate(video_urls):
+            video_id = video_id_of(url)
+            current_ids.add(video_id)
+            entry = self.entries.get(video_id)
+            if entry and self._is_complete(entry, quality):
+                up_to_date.append(index)
+                if entry["number"] != str(index + 1):
+                    moved.append((video_id, entry["number"], str(index + 1)))
+            else:
+                to_download.append(index)
+        removed = [video_id for video_id in self.entries if video_id not in current_ids]
+        return SyncPlan(to_download, up_to_date, moved, removed)
+
+    def _is_complete(self, entry: dict, quality: str) -> bool:
+        if entry.get("state") != COMPLETE or entry.get("quality") != quality or not entry.get("output"):
+            return False
+        path = os.path.join(self.folder, entry["output"])
+        return os.path.exists(path) and os.path.getsize(path) == entry.get("size")
+
+    def mark_downloading(self, video_id: str, number: str, url: str, quality: str) -> None:
+        self._update(video_id, number=number, url=url, quality=quality, state=DOWNLOADING)
+
+    def mark_complete(self, video_id: str, output_path: str) -> None:
+        self._update(video_id, output=os.path.basename(output_path), size=os.path.getsize(output_path),
+                     state=COMPLETE, completed_at=time.time())
+
+    def mark_failed(self, video_id: str, error: str) -> None:
+        self._update(video_id, state=FAILED, error=error)
+
+    def renumber(self, video_id: str, new_number: str) -> None:
+        """Rename the output of an entry that moved, e.g. `3_Title_720p.mp4` to `2_Title_720p.mp4`."""
+        with self._lock:
+            entry = self.entries[video_id]
+            old_prefix = f"{entry['number']}_"
+            if entry.get("output", "").startswith(old_prefix):
+                new_output = f"{new_number}_{entry['output'][len(old_prefix):]}"
+                new_path = os.path.join(self.folder, new_output)
+                if os.path.exists(new_path):
+                    print(f"Not renumbering {entry['output']}: {new_output} already exists.")
+                    return
+                os.rename(os.path.join(self.folder, entry["output"]), new_path)
+                entry["output"] = new_output
+            entry["number"] = new_number
+            self._save()
+
+    def prune(self, video_id: str) -> None:
+        """Delete the output of an entry that left the playlist and forget the entry."""
+        with self._lock:
+            entry = self.entries.pop(video_id)
+            if entry.get("output"):
+                path = os.path.join(self.folder, entry["output"])
+                if os.path.exists(path):
+                    os.remove(path)
+            self._save()
+
+    def _update(self, video_id: str, **fields) -> None:
+        with self._lock:
+            self.entries.setdefault(video_id, {}).update(fields)
+            self._save()
+
+    def _save(self) -> None:
+        os.makedirs(self.folder, exist_ok=True)
+        # Write to a temporary file first so a kill mid-write never leaves a corrupt manifest.
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as fh:
+            json.dump({"entries": self.entries}, fh, indent=1)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,136 @@
+import queue
+import time
+from typing import NamedTuple
+
+
+class ProgressEvent(NamedTuple):
+    """Compact progress report posted by a download worker."""
+    job_id: str
+    bytes_done: int
+    total: int
+    rate: float
+    done: bool = False
+
+
+class ProgressSnapshot(NamedTuple):
+    """Merged view of every job known to a `ProgressChannel`, as of the last `drain()`."""
+    jobs: dict
+    percentage: float
+    bytes_done: int
+    throughput: float
+    eta: float
+    finished: list
+
+
+class ProgressChannel:
+    """
+    Helper class responsible for carrying progress from download workers to the GUI or CLI.
+
+    Workers `post()` events to a queue without touching any UI state. The UI drains the queue on
+    its own fixed tick and gets one merged snapshot, however many events were posted in between,
+    so progress reporting costs the UI the same whether a download has ten chunks or ten thousand.
+    """
+
+    def __init__(self) -> None:
+        self._queue = queue.SimpleQueue()
+        self._jobs = {}
+        self._started_at = None
+
+    def post(self, job_id: str, bytes_done: int, total: int, rate: float = 0.0) -> None:
+        """Report how far a job has got. Safe to call from any thread."""
+        self._queue.put(ProgressEvent(job_id, bytes_done, total, rate))
+
+    def complete(self, job_id: str) -> None:
+        """Report that a job has finished, whether it succeeded or not. Safe to call from any thread."""
+        self._queue.put(ProgressEvent(job_id, 0, 0, 0.0, done=True))
+
+    def reset(self) -> None:
+        """Forget every job, drained or still queued. Call from the draining thread only."""
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._jobs = {}
+        self._started_at = None
+
+    def drain(self) -> ProgressSnapshot:
+        """
+        Merge every event posted since the last call into the per-job state and summarize it.
+        Call from a single thread, typically the UI thread on a timer.
+
+        The percentage averages the jobs' own percentages, so a playlist whose later videos haven't
+        reported their size yet still moves steadily. The ETA extrapolates from the time elapsed.
+        """
+        finished = []
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if self._started_at is None:
+                self._started_at = time.monotonic()
+            if event.done:
+                previous = self._jobs.get(event.job_id)
+                total = previous.total if previous and previous.total else previous.bytes_done if previous else 0
+                self._jobs[event.job_id] = ProgressEvent(event.job_id, total, total, 0.0, done=True)
+                finished.append(event.job_id)
+            elif not (event.job_id in self._jobs and self._jobs[event.job_id].done):
+                self._jobs[event.job_id] = event
+
+        jobs = dict(self._jobs)
+        if not jobs:
+            return ProgressSnapshot(jobs, 0.0, 0, 0.0, None, finished)
+
+        fractions = [1.0 if job.done else (job.bytes_done / job.total if job.total else 0.0) for job in jobs.values()]
+        fraction = min(sum(fractions) / len(fractions), 1.0)
+        bytes_done = sum(job.bytes_done for job in jobs.values())
+        throughput = sum(job.rate for job in jobs.values() if not job.done)
+        eta = None
+        if 0 < fraction < 1:
+            elapsed = time.monotonic() - self._started_at
+            eta = elapsed * (1 - fraction) / fraction
+        elif fraction >= 1:
+            eta = 0.0
+        return ProgressSnapshot(jobs, fraction * 100, bytes_done, throughput, eta, finished)
+
+
+class JobProgress:
+    """Producer-side helper that posts a job's byte count with its average transfer rate."""
+
+    def __init__(self, channel: ProgressChannel, job_id: str, total: int = 0) -> None:
+        """
+        :param channel: Channel to post to.
+        :param job_id: Identifies the job in the channel.
+        :param total: (optional) Total bytes of the job, if known.
+        """
+        self.channel = channel
+        self.job_id = job_id
+        self.total = total
+        self._started_at = time.monotonic()
+        channel.post(job_id, 0, total)
+
+    def update(self, bytes_done: int) -> None:
+        elapsed = time.monotonic() - self._started_at
+        self.channel.post(self.job_id, bytes_done, self.total, bytes_done / elapsed if elapsed > 0 else 0.0)
+
+    def complete(self) -> None:
+        self.channel.complete(self.job_id)
+
+
+def format_bytes(byte_count: float) -> str:
+    """Format a byte count as e.g. `12.3 MB`."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if byte_count < 1024 or unit == "GB":
+            return f"{byte_count:.1f} {unit}" if unit != "B" else f"{int(byte_count)} B"
+        byte_count /= 1024
+
+
+def format_snapshot(snapshot: ProgressSnapshot) -> str:
+    """Describe a snapshot in one line, e.g. `42% of 3 jobs, 12.3 MB at 4.1 MB/s, ETA 0:35`."""
+    text = f"{snapshot.percentage:.0f}% of {len(snapshot.jobs)} job{'s' if len(snapshot.jobs) != 1 else ''}, " \
+           f"{format_bytes(snapshot.bytes_done)} at {format_bytes(snapshot.throughput)}/s"
+    if snapshot.eta is not None:
+        minutes, seconds = divmod(int(snapshot.eta), 60)
+        text += f", ETA {minutes}:{seconds:02d}"
+    return text
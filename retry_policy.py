@@ -0,0 +1,300 @@
+import asyncio
+import heapq
+import http.client
+import random
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+from concurrent.futures import Future, InvalidStateError
+
+# How a failed attempt is treated.
+RETRYABLE = "retryable"
+THROTTLED = "throttled"
+FATAL = "fatal"
+
+# HTTP statuses with which the upstream asks us to slow down, and those worth another try.
+THROTTLING_STATUSES = {429, 503}
+RETRYABLE_STATUSES = {408, 500, 502, 504}
+
+# Network errors that a later attempt may not run into: resets, timeouts, DNS hiccups, cut responses.
+RETRYABLE_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, ssl.SSLError,
+                    http.client.HTTPException, urllib.error.URLError)
+
+DEFAULT_ATTEMPTS = 5
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+
+class HTTPStatusError(http.client.HTTPException):
+    """An HTTP request answered with an unexpected status."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def classify(error: BaseException) -> str:
+    """
+    Tell whether a failed attempt is worth retrying.
+
+    :return: `THROTTLED` when the upstream asked us to slow down, `RETRYABLE` for transient
+             network errors and `FATAL` for everything else, e.g. `VideoUnavailable`.
+    """
+    status = None
+    if isinstance(error, HTTPStatusError):
+        status = error.status
+    elif isinstance(error, urllib.error.HTTPError):
+        status = error.code
+    if status is not None:
+        if status in THROTTLING_STATUSES:
+            return THROTTLED
+        return RETRYABLE if status in RETRYABLE_STATUSES else FATAL
+    if isinstance(error, RETRYABLE_ERRORS):
+        return RETRYABLE
+    return FATAL
+
+
+class CircuitBreaker:
+    """
+    Pauses every request of the process while the upstream is throttling us.
+
+    `threshold` throttling answers within `window` seconds open the breaker for `cooldown`
+    seconds. Each time it opens again before a request succeeds, the pause doubles, up to
+    `max_cooldown`.
+    """
+
+    def __init__(self, threshold: int = 3, window: float = 30.0, cooldown: float = 30.0, max_cooldown: float = 300.0) -> None:
+        """
+        :param threshold: Number of throttling answers that open the breaker.
+        :param window: Seconds within which the throttling answers are counted.
+        :param cooldown: Seconds the breaker stays open the first time.
+        :param max_cooldown: Longest pause, in seconds.
+        """
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._next_cooldown = cooldown
+        self._throttled_at = []
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def record_throttle(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._throttled_at = [moment for moment in self._throttled_at if now - moment < self.window] + [now]
+            if len(self._throttled_at) >= self.threshold and now >= self._open_until:
+                self._open_until = now + self._next_cooldown
+                print(f"The server is throttling requests; pausing all requests for {self._next_cooldown:.0f}s.")
+                self._next_cooldown = min(self._next_cooldown * 2, self.max_cooldown)
+                self._throttled_at = []
+
+    def record_success(self) -> None:
+        with self._lock:
+            if time.monotonic() >= self._open_until:
+                self._next_cooldown = self.cooldown
+
+    def remaining(self) -> float:
+        """Seconds until the breaker closes, 0 if it is closed."""
+        with self._lock:
+            return max(0.0, self._open_until - time.monotonic())
+
+    def wait(self) -> None:
+        """Block while the breaker is open."""
+        while True:
+            remaining = self.remaining()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+
+class _Timer:
+    """One background thread running callbacks once their time has come."""
+
+    def __init__(self) -> None:
+        self._queue = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._counter = 0
+
+    def schedule(self, delay: float, callback) -> None:
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._queue, (time.monotonic() + delay, self._counter, callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="retry-timer", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    self._condition.wait(self._queue[0][0] - time.monotonic() if self._queue else None)
+                _, _, callback = heapq.heappop(self._queue)
+            callback()
+
+
+class RetryPolicy:
+    """
+    Helper class responsible for retrying metadata lookups and transfers that fail for transient
+    reasons, shared by every download of the process.
+
+    Attempts are spaced by an exponential backoff with jitter, so parallel jobs that failed
+    together don't retry together. Fatal errors are raised at once, and throttling answers feed
+    the circuit breaker, which holds back every attempt while it is open.
+    """
+
+    def __init__(self, attempts: int = DEFAULT_ATTEMPTS, base_delay: float = DEFAULT_BASE_DELAY,
+                 max_delay: float = DEFAULT_MAX_DELAY, breaker: CircuitBreaker = None) -> None:
+        """
+        :param attempts: Number of attempts, the first one included.
+        :param base_delay: Backoff before the second attempt, in seconds; it doubles after each failure.
+        :param max_delay: Longest backoff, in seconds.
+        :param breaker: (optional) Circuit breaker shared by the attempts.
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self._timer = _Timer()
+
+    def configure(self, attempts: int = DEFAULT_ATTEMPTS, base_delay: float = DEFAULT_BASE_DELAY,
+                  max_delay: float = DEFAULT_MAX_DELAY) -> None:
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait after the failure of attempt number `attempt` (0-based): half fixed, half random."""
+        ceiling = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+    def run(self, fn, *args, on_retry=None):
+        """
+        Call `fn(*args)` until it succeeds, sleeping between attempts in the calling thread.
+        For callers with a thread of their own; pool workers should use `submit()`.
+
+        :param on_retry: (optional) Callback taking (error, delay) before each backoff.
+        :return: What `fn` returned.
+        :raises Exception: The error of the last attempt, or the first fatal one.
+        """
+        attempt = 0
+        while True:
+            self.breaker.wait()
+            try:
+                result = fn(*args)
+            except Exception as e:
+                delay = self._after_failure(e, attempt)
+                if on_retry:
+                    on_retry(e, delay)
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.record_success()
+                return result
+
+    def submit(self, executor, fn, *args, on_retry=None) -> Future:
+        """
+        Run `fn(*args)` in `executor` until it succeeds. Between attempts, and while the breaker
+        is open, no worker of the executor is held: the next attempt waits on the policy's timer
+        and is submitted again when due.
+
+        :param on_retry: (optional) Callback taking (error, delay) before each backoff.
+        :return: Future of what `fn` returned, or of the error of the last attempt.
+        """
+        result = Future()
+
+        def settle(method, value):
+            try:
+                method(value)
+            except InvalidStateError:
+                pass  # Cancelled meanwhile.
+
+        def attempt(number):
+            if result.done():
+                return
+            paused = self.breaker.remaining()
+            if paused > 0:
+                self._timer.schedule(paused, lambda: submit_attempt(number))
+                return
+            try:
+                value = fn(*args)
+            except Exception as e:
+                try:
+                    delay = self._after_failure(e, number)
+                except Exception as error:
+                    settle(result.set_exception, error)
+                    return
+                if on_retry:
+                    on_retry(e, delay)
+                self._timer.schedule(delay, lambda: submit_attempt(number + 1))
+            else:
+                self.breaker.record_success()
+                settle(result.set_result, value)
+
+        def submit_attempt(number):
+            try:
+                executor.submit(attempt, number)
+            except RuntimeError as e:
+                # The executor was shut down while the attempt was waiting.
+                settle(result.set_exception, e)
+
+        submit_attempt(0)
+        return result
+
+    async def run_async(self, fn, *args, on_retry=None, executor=None):
+        """
+        Call the blocking `fn(*args)` in `executor` until it succeeds, from a coroutine. The
+        backoff between attempts and the breaker's pauses are awaited on the event loop, so
+        neither a thread nor a worker of the executor is held meanwhile.
+
+        :param on_retry: (optional) Callback taking (error, delay) before each backoff.
+        :param executor: (optional) Executor the attempts run in; the loop's default one if None.
+        :return: What `fn` returned.
+        :raises Exception: The error of the last attempt, or the first fatal one.
+        """
+        loop = asyncio.get_running_loop()
+        return await self.retry_async(lambda: loop.run_in_executor(executor, lambda: fn(*args)), on_retry=on_retry)
+
+    async def retry_async(self, coroutine_fn, *args, on_retry=None):
+        """
+        Await `coroutine_fn(*args)` until it succeeds, e.g. a range request made on the event
+        loop, awaiting the backoff between attempts and the breaker's pauses.
+
+        :param on_retry: (optional) Callback taking (error, delay) before each backoff.
+        :return: What the coroutine returned.
+        :raises Exception: The error of the last attempt, or the first fatal one.
+        """
+        attempt = 0
+        while True:
+            paused = self.breaker.remaining()
+            if paused > 0:
+                await asyncio.sleep(paused)
+                continue
+            try:
+                result = await coroutine_fn(*args)
+            except Exception as e:
+                delay = self._after_failure(e, attempt)
+                if on_retry:
+                    on_retry(e, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.record_success()
+                return result
+
+    def _after_failure(self, error: Exception, attempt: int) -> float:
+        """Return the backoff before the next attempt, or raise `error` if there is none."""
+        kind = classify(error)
+        if kind == THROTTLED:
+            self.breaker.record_throttle()
+        if kind == FATAL or attempt + 1 >= self.attempts:
+            raise error
+        return self.backoff(attempt)
+
+
+# Policy shared by every download of the process, so they all back off together when throttled.
+retry_policy = RetryPolicy()
@@ -0,0 +1,507 @@
+import asyncio
+import http.client
+import json
+import os
+import queue
+import re
+import ssl
+import threading
+from collections import deque
+from contextlib import aclosing
+from functools import partial
+from urllib.parse import urlsplit, urljoin
+from bandwidth_governor import governor
+from output_writer import output_writer
+from retry_policy import HTTPStatusError, retry_policy
+
+# Size of each byte range fetched with its own request. Small enough that an interrupted job
+# loses little work, large enough that the request overhead stays negligible.
+DEFAULT_SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Number of connections a single stream is fetched over.
+DEFAULT_CONNECTIONS = 4
+
+# Size of the blocks read from a response and written to disk.
+READ_BLOCK_SIZE = 64 * 1024
+
+MAX_REDIRECTS = 5
+
+# Same headers pytube sends, so the CDN treats both download paths alike.
+DEFAULT_HEADERS = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}
+
+
+class ConnectionPool:
+    """
+    Helper class responsible for keeping HTTP connections alive between requests,
+    so consecutive range requests to the same host skip the TCP and TLS handshakes.
+    """
+
+    def __init__(self, max_idle_per_host: int = DEFAULT_CONNECTIONS, timeout: float = 30) -> None:
+        """
+        Initialize an empty pool.
+
+        :param max_idle_per_host: Number of idle connections kept open per host.
+        :param timeout: Socket timeout of the connections, in seconds.
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _idle_queue(self, key) -> queue.LifoQueue:
+        with self._lock:
+            if key not in self._idle:
+                self._idle[key] = queue.LifoQueue(maxsize=self.max_idle_per_host)
+            return self._idle[key]
+
+    def acquire(self, scheme: str, host: str, port: int = None) -> http.client.HTTPConnection:
+        """Return an idle connection to the host, or open a new one."""
+        try:
+            return self._idle_queue((scheme, host, port)).get_nowait()
+        except queue.Empty:
+            return self._new_connection(scheme, host, port)
+
+    def release(self, scheme: str, host: str, port: int, connection: http.client.HTTPConnection) -> None:
+        """Give a connection whose response has been fully read back to the pool."""
+        try:
+            self._idle_queue((scheme, host, port)).put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def request(self, method: str, url: str, headers: dict = None):
+        """
+        Send a request over a pooled connection, following redirects.
+
+        :return: Tuple of (response, release) where `release(reusable)` must be called once the
+                 response body has been read (or abandoned, with `reusable=False`).
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+            connection = self.acquire(parts.scheme, parts.hostname, parts.port)
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                # A kept-alive connection may have been closed by the server; retry once on a fresh one.
+                connection.close()
+                connection = self._new_connection(parts.scheme, parts.hostname, parts.port)
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                response.read()
+                self.release(parts.scheme, parts.hostname, parts.port, connection)
+                url = urljoin(url, response.getheader("Location"))
+                continue
+
+            def release(reusable: bool = True, key=(parts.scheme, parts.hostname, parts.port), connection=connection):
+                if reusable and not response.will_close:
+                    self.release(*key, connection)
+                else:
+                    connection.close()
+            return response, release
+        raise http.client.HTTPException(f"Too many redirects for {url}")
+
+    def _new_connection(self, scheme: str, host: str, port: int = None) -> http.client.HTTPConnection:
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return connection_class(host, port, timeout=self.timeout)
+
+    def close(self) -> None:
+        """Close every idle connection."""
+        with self._lock:
+            idle_queues, self._idle = list(self._idle.values()), {}
+        for idle in idle_queues:
+            while not idle.empty():
+                idle.get_nowait().close()
+
+
+class AsyncResponse:
+    """Status, headers and body of an HTTP/1.1 response read by `AsyncConnectionPool`."""
+
+    def __init__(self, pool: "AsyncConnectionPool", key: tuple, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, status: int, headers: dict) -> None:
+        self.status = status
+        # Header names are lowercase.
+        self.headers = headers
+        self._pool = pool
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        length = headers.get("content-length")
+        self._remaining = int(length) if length and length.isdigit() else None
+        self._keep_alive = headers.get("connection", "").lower() != "close"
+
+    async def read(self, size: int) -> bytes:
+        """
+        Read exactly `size` bytes of the body, or what is left of it if less.
+
+        :raises http.client.IncompleteRead: If the connection closes before the body is complete.
+        """
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+        if size <= 0:
+            return b""
+        try:
+            data = await asyncio.wait_for(self._reader.readexactly(size), self._pool.timeout)
+        except asyncio.IncompleteReadError as e:
+            raise http.client.IncompleteRead(e.partial, size - len(e.partial)) from None
+        if self._remaining is not None:
+            self._remaining -= len(data)
+        return data
+
+    def release(self, reusable: bool = True) -> None:
+        """Give the connection back to the pool once the body has been read, or close it."""
+        if self._writer is None:
+            return
+        if reusable and self._keep_alive and self._remaining == 0:
+            self._pool.release(self._key, self._reader, self._writer)
+        else:
+            self._writer.close()
+        self._writer = None
+
+
+class AsyncConnectionPool:
+    """
+    Helper class responsible for HTTP/1.1 connections of the event loop, the asyncio
+    counterpart of `ConnectionPool`: requests are made and their responses read by coroutines,
+    so a transfer waiting on the network holds no thread.
+
+    Connections are kept alive between requests to the same host. Bodies are read by their
+    `Content-Length`, which every range response has; other responses are read no further than
+    their headers and their connection is closed.
+    """
+
+    def __init__(self, max_idle_per_host: int = DEFAULT_CONNECTIONS, timeout: float = 30) -> None:
+        """
+        :param max_idle_per_host: Number of idle connections kept open per host.
+        :param timeout: Seconds a connection, or a read from it, may take.
+        """
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._idle = {}
+        self._ssl_context = None
+
+    def release(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.max_idle_per_host and not writer.is_closing():
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def request(self, method: str, url: str, headers: dict = None) -> AsyncResponse:
+        """
+        Send a request over a pooled connection, following redirects.
+
+        :return: The response, whose `release()` must be called once its body has been read.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            key = (parts.scheme, parts.hostname, port)
+            target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+            host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+            request = "".join([f"{method} {target} HTTP/1.1\r\nHost: {host}\r\n"]
+                              + [f"{name}: {value}\r\n" for name, value in (headers or {}).items()]
+                              + ["\r\n"]).encode("latin-1")
+            idle = self._idle.get(key)
+            if idle:
+                reader, writer = idle.pop()
+                try:
+                    response = await self._send(key, reader, writer, request)
+                except (OSError, http.client.HTTPException, asyncio.IncompleteReadError):
+                    # A kept-alive connection may have been closed by the server; retry once on a fresh one.
+                    writer.close()
+                    response = await self._send(key, *await self._open(key), request)
+            else:
+                response = await self._send(key, *await self._open(key), request)
+
+            location = response.headers.get("location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                await response.read(response._remaining or 0)
+                response.release()
+                url = urljoin(url, location)
+                continue
+            return response
+        raise http.client.HTTPException(f"Too many redirects for {url}")
+
+    async def _open(self, key: tuple) -> tuple:
+        scheme, host, port = key
+        context = None
+        if scheme == "https":
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            context = self._ssl_context
+        return await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context, limit=4 * READ_BLOCK_SIZE), self.timeout)
+
+    async def _send(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    request: bytes) -> AsyncResponse:
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+            match = re.match(rb"HTTP/1\.[01] (\d{3})", status_line)
+            if not match:
+                raise http.client.BadStatusLine(status_line.decode("latin-1", "replace"))
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+        return AsyncResponse(self, key, reader, writer, int(match.group(1)), headers)
+
+    def close(self) -> None:
+        """Close every idle connection."""
+        idle_lists, self._idle = list(self._idle.values()), {}
+        for idle in idle_lists:
+            for _, writer in idle:
+                writer.close()
+
+
+class SegmentedDownloader:
+    """
+    Helper class responsible for downloading a file of known size as several byte ranges
+    fetched in parallel, each by a task of the running event loop over pooled connections.
+
+    Each range is written straight to its offset in a preallocated file, through the shared
+    output writer's buffers; the writes, and the hashing of what is written, are handed to the
+    loop's executor in batches of the writer's buffer size, so the loop only waits on the network.
+    The finished ranges are recorded in a small sidecar journal (`<file>.journal`), so an
+    interrupted download resumes with only the missing ranges; with an fsync policy, a range is
+    on the device before the journal counts it as done. The journal is removed once the file is
+    complete. A range cut by a transient error is retried through the shared retry policy, from
+    where it stopped.
+    """
+
+    def __init__(self, connections: int = DEFAULT_CONNECTIONS, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 pool: AsyncConnectionPool = None, job_id=None) -> None:
+        """
+        Initialize the downloader.
+
+        :param connections: Number of ranges fetched at the same time.
+        :param segment_size: Size of each range, in bytes.
+        :param pool: (optional) Connection pool to share with other downloaders.
+        :param job_id: (optional) Job the transfers count against in the bandwidth governor.
+                       Defaults to the connection pool, i.e. one job per pool.
+        """
+        self.connections = connections
+        self.segment_size = segment_size
+        self.pool = pool or AsyncConnectionPool(max_idle_per_host=connections)
+        self.job_id = job_id if job_id is not None else id(self.pool)
+
+    async def download(self, url: str, file_path: str, filesize: int, on_progress=None, hasher=None) -> str:
+        """
+        Download `url` into `file_path`, resuming from the journal left by an earlier attempt.
+
+        :param url: URL of the file; the server must honour Range requests.
+        :param file_path: Path of the file to write.
+        :param filesize: Size of the file, in bytes.
+        :param on_progress: (optional) Callback taking (chunk, bytes_remaining), called on the loop.
+        :param hasher: (optional) `content_store.BlockHasher` fed every range as it arrives. Ranges
+                       kept from an earlier attempt are read back from the file to be hashed.
+        :return: Path to the saved file.
+        """
+        journal_path = file_path + ".journal"
+        segments = [(start, min(start + self.segment_size, filesize) - 1)
+                    for start in range(0, filesize, self.segment_size)]
+        done = await offload(self._load_journal, journal_path, file_path, filesize, self.segment_size)
+
+        # Preallocate the file, keeping what an earlier attempt wrote when resuming.
+        await offload(partial(output_writer.preallocate, file_path, filesize, keep=bool(done)))
+        if hasher and done:
+            await offload(self._hash_done, file_path, segments, done, hasher)
+
+        progress = {"bytes_done": sum(end - start + 1 for start, end in segments if start in done)}
+
+        def report(chunk):
+            progress["bytes_done"] += len(chunk)
+            if on_progress:
+                on_progress(chunk, filesize - progress["bytes_done"])
+
+        # Offset each range has been written up to, so a retry picks up where the last attempt stopped.
+        positions = {}
+        slots = asyncio.Semaphore(self.connections)
+        # One journal write at a time, so they land in order and the newest set of ranges wins.
+        journal_lock = asyncio.Lock()
+
+        async def fetch(segment):
+            start, end = segment
+            async with slots:
+                await retry_policy.retry_async(
+                    lambda: self._fetch_segment(url, file_path, start, end, positions, report, hasher),
+                    on_retry=self._on_retry)
+            async with journal_lock:
+                done.add(start)
+                await offload(self._save_journal, journal_path, filesize, self.segment_size, set(done))
+
+        await gather_tasks(*(fetch(segment) for segment in segments if segment[0] not in done))
+
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        return file_path
+
+    async def fetch_size(self, url: str) -> int:
+        """Ask the server for the size of `url` with a one-byte range request."""
+        async with governor.connection_async():
+            response = await self.pool.request("GET", url, headers=dict(DEFAULT_HEADERS, Range="bytes=0-0"))
+            try:
+                match = re.match(r"bytes \d+-\d+/(\d+)", response.headers.get("content-range", ""))
+                if response.status != 206 or not match:
+                    raise HTTPStatusError(response.status, f"Size request for {url} returned HTTP {response.status}")
+                await response.read(1)
+                response.release()
+                return int(match.group(1))
+            finally:
+                response.release(False)
+
+    async def iter_chunks(self, url: str, filesize: int):
+        """
+        Yield the bytes of `url` in order, for consumers that can't seek, such as a pipe.
+
+        Up to `connections` ranges are fetched ahead by tasks of the loop and held in memory
+        until their turn comes, so the ordered stream still benefits from several connections.
+        Close the generator (e.g. with `contextlib.aclosing`) to cancel the ranges fetched ahead.
+
+        :param url: URL of the file; the server must honour Range requests.
+        :param filesize: Size of the file, in bytes.
+        :return: Asynchronous iterator over the file's bytes, one range at a time.
+        """
+        segments = [(start, min(start + self.segment_size, filesize) - 1)
+                    for start in range(0, filesize, self.segment_size)]
+        pending = deque()
+        try:
+            for start, end in segments:
+                pending.append(asyncio.ensure_future(
+                    retry_policy.retry_async(self._read_segment, url, start, end, on_retry=self._on_retry)))
+                if len(pending) >= self.connections:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _on_retry(error, delay) -> None:
+        print(f"Range request failed ({error}), retrying in {delay:.1f}s.")
+
+    async def _read_segment(self, url: str, start: int, end: int) -> bytes:
+        async with aclosing(self._fetch_range(url, start, end)) as chunks:
+            return b"".join([chunk async for chunk in chunks])
+
+    async def _fetch_segment(self, url: str, file_path: str, start: int, end: int, positions: dict, report,
+                             hasher=None) -> None:
+        position = positions.get(start, start)
+        if position > end:
+            return
+        fh = await offload(output_writer.open, file_path, "r+b")
+        batch = []
+
+        def write(offset, data):
+            if hasher:
+                hasher.update(offset, data)
+            fh.seek(offset)
+            fh.write(data)
+
+        async def flush():
+            data, offset = b"".join(batch), positions.get(start, start)
+            batch.clear()
+            await offload(write, offset, data)
+            positions[start] = offset + len(data)
+
+        try:
+            batch_size = 0
+            async with aclosing(self._fetch_range(url, position, end)) as chunks:
+                async for chunk in chunks:
+                    batch.append(chunk)
+                    batch_size += len(chunk)
+                    report(chunk)
+                    if batch_size >= output_writer.buffer_size:
+                        await flush()
+                        batch_size = 0
+        finally:
+            # What came in before an error is written, so the retry starts after it.
+            try:
+                if batch:
+                    await flush()
+            finally:
+                await offload(fh.close)
+
+    async def _fetch_range(self, url: str, start: int, end: int):
+        """Yield the bytes `start` to `end` of `url` in blocks, throttled by the bandwidth governor."""
+        headers = dict(DEFAULT_HEADERS, Range=f"bytes={start}-{end}")
+        async with governor.connection_async():
+            response = await self.pool.request("GET", url, headers=headers)
+            reusable = False
+            try:
+                if response.status != 206:
+                    raise HTTPStatusError(response.status, f"Range request for bytes {start}-{end} returned HTTP {response.status}")
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await response.read(min(READ_BLOCK_SIZE, remaining))
+                    if not chunk:
+                        raise http.client.IncompleteRead(b"", remaining)
+                    await governor.throttle_async(len(chunk), self.job_id)
+                    remaining -= len(chunk)
+                    yield chunk
+                reusable = True
+            finally:
+                response.release(reusable)
+
+    @staticmethod
+    def _hash_done(file_path: str, segments: list, done: set, hasher) -> None:
+        with open(file_path, "rb") as fh:
+            for start, end in segments:
+                if start in done:
+                    fh.seek(start)
+                    hasher.update(start, fh.read(end - start + 1))
+
+    @staticmethod
+    def _load_journal(journal_path: str, file_path: str, filesize: int, segment_size: int) -> set:
+        """Return the start offsets of the ranges already on disk, or an empty set to start over."""
+        if not (os.path.exists(journal_path) and os.path.exists(file_path)):
+            return set()
+        try:
+            with open(journal_path) as fh:
+                journal = json.load(fh)
+        except (OSError, ValueError):
+            return set()
+        if journal.get("filesize") != filesize or journal.get("segment_size") != segment_size:
+            return set()
+        return set(journal.get("done", []))
+
+    @staticmethod
+    def _save_journal(journal_path: str, filesize: int, segment_size: int, done: set) -> None:
+        # Write to a temporary file first so a kill mid-write never leaves a corrupt journal.
+        temp_path = f"{journal_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as fh:
+            json.dump({"filesize": filesize, "segment_size": segment_size, "done": sorted(done)}, fh)
+        os.replace(temp_path, journal_path)
+
+
+async def offload(fn, *args):
+    """Run blocking file or CPU work in the executor of the running loop, the download engine's workers."""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+async def gather_tasks(*coroutines) -> list:
+    """
+    Run the coroutines as tasks and wait for them all. If one fails or the caller is cancelled,
+    the others are cancelled and waited for before the error is raised.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,318 @@
+"""
+Local HTTP job server for the YouTube downloader.
+
+    python server.py --folder downloads --port 8765 --workers 4 --per-host 2
+
+API (JSON in and out):
+    POST   /jobs        {"type": "video", "link": "...", "quality": "720p", "priority": 0, "folder": "...", "client": "..."}
+                        for "audio" jobs (videos or playlists), "quality" is the format: m4a, mp3 or opus
+    GET    /jobs        every job, or only those in one state with ?status=queued
+    GET    /jobs/<id>   one job, with its progress
+    DELETE /jobs/<id>   cancel a queued or running job
+    GET    /governor    current bandwidth limit and connection cap
+    PUT    /governor    {"rate": "2M", "max_connections": 8}; null or "unlimited" removes a limit
+
+Jobs are kept in an SQLite database. Jobs that were running when the server stopped are queued
+again on the next start; finished videos of a playlist job are not downloaded again.
+"""
+import argparse
+import json
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from async_engine import DEFAULT_BLOCKING_WORKERS, download_engine
+from bandwidth_governor import governor, parse_rate
+from content_store import content_store, parse_size
+from downloader_context import DownloaderContext, describe_result
+from job_store import JobStore, DONE, FAILED, CANCELLED
+from merge_pool import DEFAULT_MERGE_WORKERS, merge_pool
+from metrics import SamplingProfiler, metrics_recorder
+from output_writer import DEFAULT_BUFFER_SIZE, DEFAULT_MIN_FREE, DEFAULT_SYNC_INTERVAL, FSYNC_NEVER, FSYNC_POLICIES, output_writer
+from retry_policy import DEFAULT_ATTEMPTS, retry_policy
+from utils import AUDIO_FORMATS, DownloadCancelled, validate_link
+
+STRATEGY_TYPES = ("video", "playlist", "thumbnail", "audio")
+
+
+class JobDispatcher:
+    """
+    Helper class responsible for running the queued jobs of a `JobStore` on a pool of workers.
+
+    Higher priority jobs start first. No more than `per_host` jobs of the same client run at once,
+    so a large batch from one client leaves workers free for the others.
+    """
+
+    def __init__(self, store: JobStore, workers: int = 4, per_host: int = 2, playlist_workers: int = None,
+                 job_timeout: float = None) -> None:
+        """
+        :param store: Where the jobs are kept.
+        :param workers: Number of jobs run at the same time.
+        :param per_host: Number of jobs of the same client run at the same time.
+        :param playlist_workers: (optional) Number of videos of one playlist downloaded at the same time.
+        :param job_timeout: (optional) Seconds a job may run before it is stopped and marked failed.
+        """
+        self.store = store
+        self.workers = workers
+        self.per_host = per_host
+        self.playlist_workers = playlist_workers
+        self.job_timeout = job_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._condition = threading.Condition()
+        self._running = {}
+        self._stopped = False
+
+    def start(self) -> None:
+        """Requeue the jobs interrupted by the last shutdown and start dispatching."""
+        recovered = self.store.recover()
+        if recovered:
+            print(f"Requeued {recovered} job(s) interrupted by the last shutdown.")
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def notify(self) -> None:
+        """Wake the dispatcher up, e.g. after a job was queued."""
+        with self._condition:
+            self._condition.notify_all()
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a queued or running job. Returns False if the job had already finished."""
+        if self.store.cancel_queued(job_id):
+            return True
+        with self._condition:
+            if job_id in self._running:
+                self._running[job_id]["cancel"].set()
+                if self._running[job_id].get("context"):
+                    self._running[job_id]["context"].cancel()
+                return True
+        return False
+
+    def _dispatch_loop(self) -> None:
+        with self._condition:
+            while not self._stopped:
+                if len(self._running) >= self.workers:
+                    self._condition.wait()
+                    continue
+                host_counts = Counter(running["host"] for running in self._running.values())
+                busy_hosts = {host for host, count in host_counts.items() if count >= self.per_host}
+                job = self.store.claim_next(busy_hosts)
+                if job is None:
+                    # Also wake up now and then, in case a job was added by another process.
+                    self._condition.wait(timeout=5)
+                    continue
+                self._running[job["id"]] = {"host": job["host"], "cancel": threading.Event()}
+                self._executor.submit(self._run, job, self._running[job["id"]]["cancel"])
+
+    def _run(self, job: dict, cancel: threading.Event) -> None:
+        job_id = job["id"]
+
+        def progress_callback(stream, chunk, percentage):
+            if cancel.is_set():
+                raise DownloadCancelled()
+            self.store.update_progress(job_id, percentage)
+
+        def on_video_done(video_count, url, succeeded):
+            if succeeded:
+                self.store.add_done_video(job_id, video_count)
+
+        context = None
+        try:
+            context = DownloaderContext(strategy_type=job["strategy"], link=job["link"], folder=job["folder"],
+                                        quality=job["quality"], progress_callback=progress_callback,
+                                        max_workers=self.playlist_workers, show_thumbnail=False,
+                                        skip_videos=job["done_videos"], on_video_done=on_video_done,
+                                        timeout=self.job_timeout)
+            with self._condition:
+                self._running[job_id]["context"] = context
+            succeeded, error = describe_result(job["strategy"], context.execute_download())
+            status = DONE if succeeded else FAILED
+        except DownloadCancelled:
+            status, error = CANCELLED, None
+        except Exception as e:
+            status, error = FAILED, str(e)
+        if cancel.is_set():
+            status = CANCELLED
+
+        self.store.finish(job_id, status, error=error, bytes_downloaded=context.bytes_downloaded if context else 0)
+        with self._condition:
+            del self._running[job_id]
+            self._condition.notify_all()
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """Maps the HTTP API onto the `JobStore` and `JobDispatcher` attached to the server."""
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        job_id = self._job_id(parts.path)
+        if parts.path.rstrip("/") == "/governor":
+            self._send_json(200, self._governor_state())
+        elif parts.path.rstrip("/") == "/jobs":
+            status = parse_qs(parts.query).get("status", [None])[0]
+            self._send_json(200, self.server.store.list(status))
+        elif job_id is not None:
+            job = self.server.store.get(job_id)
+            self._send_json(200, job) if job else self._send_error(404, "No such job")
+        else:
+            self._send_error(404, "Not found")
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip("/") != "/jobs":
+            return self._send_error(404, "Not found")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            strategy_type, link = body["type"], body["link"]
+            priority = int(body.get("priority", 0))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send_error(400, f"Invalid job: {e}")
+        if strategy_type not in STRATEGY_TYPES:
+            return self._send_error(400, f"Strategy type '{strategy_type}' not recognized!")
+        error = validate_link(strategy_type, link)
+        if error:
+            return self._send_error(400, error)
+        if strategy_type == "audio" and body.get("quality") and body["quality"] not in AUDIO_FORMATS:
+            return self._send_error(400, f"Audio format '{body['quality']}' not recognized!")
+
+        job = self.server.store.add(strategy=strategy_type, link=link,
+                                    folder=body.get("folder") or self.server.folder,
+                                    quality=body.get("quality"), priority=priority,
+                                    host=body.get("client") or self.client_address[0])
+        self.server.dispatcher.notify()
+        self._send_json(201, job)
+
+    def do_PUT(self):
+        if urlsplit(self.path).path.rstrip("/") != "/governor":
+            return self._send_error(404, "Not found")
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if "rate" in body:
+                rate = body["rate"]
+                governor.set_rate(parse_rate(str(rate)) if rate is not None else None)
+            if "max_connections" in body:
+                max_connections = body["max_connections"]
+                governor.set_max_connections(int(max_connections) if max_connections else None)
+        except (ValueError, TypeError, IndexError) as e:
+            return self._send_error(400, f"Invalid governor settings: {e}")
+        self._send_json(200, self._governor_state())
+
+    def do_DELETE(self):
+        job_id = self._job_id(urlsplit(self.path).path)
+        if job_id is None or self.server.store.get(job_id) is None:
+            return self._send_error(404, "No such job")
+        if not self.server.dispatcher.cancel(job_id):
+            return self._send_error(409, "The job has already finished")
+        self._send_json(202, self.server.store.get(job_id))
+
+    @staticmethod
+    def _governor_state() -> dict:
+        return {"rate": governor.rate, "max_connections": governor.max_connections,
+                "open_connections": governor.open_connections}
+
+    def log_message(self, format, *args):
+        print(f"{self.client_address[0]} - {format % args}")
+
+    @staticmethod
+    def _job_id(path: str):
+        segments = path.strip("/").split("/")
+        if len(segments) == 2 and segments[0] == "jobs" and segments[1].isdigit():
+            return int(segments[1])
+        return None
+
+    def _send_json(self, status: int, payload) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str) -> None:
+        self._send_json(status, {"error": message})
+
+
+class JobServer(ThreadingHTTPServer):
+    """HTTP server holding the job store, the dispatcher and the default download folder."""
+
+    def __init__(self, address, store: JobStore, dispatcher: JobDispatcher, folder: str) -> None:
+        super().__init__(address, JobRequestHandler)
+        self.store = store
+        self.dispatcher = dispatcher
+        self.folder = folder
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Run the YouTube downloader as a local HTTP job server.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1).")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765).")
+    parser.add_argument("-o", "--folder", default=".", help="Default destination folder of the jobs.")
+    parser.add_argument("--db", default="jobs.sqlite3", help="Path to the job database (default: jobs.sqlite3).")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of jobs run at the same time.")
+    parser.add_argument("--per-host", type=int, default=2, help="Number of jobs of the same client run at the same time.")
+    parser.add_argument("--playlist-workers", type=int, help="Number of videos of one playlist downloaded at the same time.")
+    parser.add_argument("--rate-limit", type=parse_rate, help="Total bandwidth of all jobs, e.g. 500K or 2M bytes per second.")
+    parser.add_argument("--max-connections", type=int, help="Total number of connections open at the same time.")
+    parser.add_argument("--job-timeout", type=float, help="Seconds a job may run before it is stopped and marked failed.")
+    parser.add_argument("--engine-workers", type=int, default=DEFAULT_BLOCKING_WORKERS,
+                        help=f"Number of metadata lookups, file writes and hashes run at the same time across all jobs (default: {DEFAULT_BLOCKING_WORKERS}).")
+    parser.add_argument("--merge-workers", type=int, default=DEFAULT_MERGE_WORKERS,
+                        help=f"Number of ffmpeg merges run at the same time (default: {DEFAULT_MERGE_WORKERS}).")
+    parser.add_argument("--retries", type=int, default=DEFAULT_ATTEMPTS,
+                        help=f"Attempts of each metadata lookup and transfer before it fails (default: {DEFAULT_ATTEMPTS}).")
+    parser.add_argument("--write-buffer", type=parse_size, default=DEFAULT_BUFFER_SIZE,
+                        help="Write buffer of each output file, e.g. 4M (default: 1M).")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default=FSYNC_NEVER,
+                        help="Force output to the device on every file close, periodically (see --sync-interval) or never (default).")
+    parser.add_argument("--sync-interval", type=parse_size, default=DEFAULT_SYNC_INTERVAL,
+                        help="Bytes written between syncs with --fsync periodic (default: 64M).")
+    parser.add_argument("--min-free", type=parse_size, default=DEFAULT_MIN_FREE,
+                        help="Space left free in the destination; jobs that don't fit fail before downloading (default: 64M).")
+    parser.add_argument("--store", help="Content store directory; videos already in it are copied instead of downloaded.")
+    parser.add_argument("--store-max-size", type=parse_size, help="Size the content store is kept within, e.g. 50G.")
+    parser.add_argument("--store-hardlink", action="store_true",
+                        help="Hardlink videos restored from the content store instead of copying them; editing one in place also changes the stored copy.")
+    parser.add_argument("--metrics-jsonl", help="Append the phase timings, bytes, retries and ffmpeg runs of every job to this file.")
+    parser.add_argument("--metrics-prom", help="Write the totals of every job to this Prometheus textfile.")
+    parser.add_argument("--profile", help="Sample the transfer loops and write the stacks to this file on shutdown.")
+    args = parser.parse_args(argv)
+    governor.set_rate(args.rate_limit)
+    governor.set_max_connections(args.max_connections)
+    metrics_recorder.configure(jsonl_path=args.metrics_jsonl, prometheus_path=args.metrics_prom)
+    retry_policy.configure(attempts=args.retries)
+    merge_pool.configure(workers=args.merge_workers)
+    download_engine.configure(blocking_workers=args.engine_workers)
+    output_writer.configure(buffer_size=args.write_buffer, fsync=args.fsync, sync_interval=args.sync_interval,
+                            min_free=args.min_free or 0)
+    if args.store:
+        content_store.configure(args.store, max_bytes=args.store_max_size, hardlink_outputs=args.store_hardlink)
+    profiler = SamplingProfiler().start() if args.profile else None
+
+    store = JobStore(args.db)
+    dispatcher = JobDispatcher(store, workers=args.workers, per_host=args.per_host, playlist_workers=args.playlist_workers,
+                               job_timeout=args.job_timeout)
+    server = JobServer((args.host, args.port), store, dispatcher, args.folder)
+    dispatcher.start()
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        dispatcher.stop()
+        store.close()
+        if profiler:
+            profiler.stop()
+            profiler.write(args.profile)
+
+
+if __name__ == "__main__":
+    main()
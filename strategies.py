@@ -1,106 +1,695 @@
-import urllib.request
-from PIL import Image
+import asyncio
+import contextlib
+import os
 import re
+import threading
 from abc import ABC, abstractmethod
-from pytube import YouTube, Playlist
-from utils import VideoStreamFetcher, AudioStreamFetcher, StreamDownloader, FileMerger, CombinedProgress
-import time
+from async_engine import download_engine
+from content_store import BlockHasher, combine_digests, content_store
+from merge_pool import merge_pool
+from metadata_cache import metadata_cache
+from metrics import JobMetrics, metrics_recorder
+from output_writer import output_writer, InsufficientSpaceError
+from playlist_manifest import PlaylistManifest, video_id_of
+from progress import JobProgress
+from retry_policy import retry_policy
+from segmented_downloader import gather_tasks, offload
+from stream_index import stream_index_of
+from thumbnails import thumbnail_pipeline, DEFAULT_THUMBNAIL_FETCHERS
+from utils import AudioStreamFetcher, StreamDownloader, FileMerger, AudioConverter, CombinedProgress, PlaylistProgress, DownloadCancelled, DEFAULT_AUDIO_FORMAT
+
+# Number of playlist videos downloaded at the same time unless the caller asks otherwise.
+DEFAULT_PLAYLIST_WORKERS = 3
 
 class IDownloadStrategy(ABC):    
     def __init__(self, link, folder):
         self.link = link
         self.folder = folder
+        # Bytes fetched from the network by the last `download()` call.
+        self.bytes_downloaded = 0
+        # Set by `cancel()`; the download stops at its next progress report.
+        self.cancelled = threading.Event()
 
     @abstractmethod
     def download(self):
         """Downloads the content based on the strategy's implementation."""
         pass
 
+    def cancel(self):
+        """Ask the download to stop. It raises `DownloadCancelled` at its next progress report or step."""
+        self.cancelled.set()
+
+    def _check_cancelled(self):
+        if self.cancelled.is_set():
+            raise DownloadCancelled()
+
+    def _retry_reporter(self, phase, link=None):
+        """Return an `on_retry` callback for `retry_policy` that counts the retries of `phase` in the job's metrics."""
+        def on_retry(error, delay):
+            self.metrics.count_retry(phase)
+            self.metrics.add_time("retry_wait", delay)
+            print(f"Retrying {phase} of {link or self.link} in {delay:.1f}s after: {error}")
+        return on_retry
+
 class VideoDownloadStrategy(IDownloadStrategy):
-    def __init__(self, link, folder, video_quality, progress_callback, if_playlist_video_count=""):
+    # Strategy name the job's metrics are recorded under.
+    metrics_name = "video"
+
+    def __init__(self, link, folder, video_quality, progress_callback, if_playlist_video_count="", streaming_merge=True,
+                 progress_channel=None, overwrite=False):
         super().__init__(link, folder)
         self.video_quality = video_quality
         self.progress_callback = progress_callback
         self.if_playlist_video_count = if_playlist_video_count
+        # Pipe the streams straight into ffmpeg when possible instead of merging temp files.
+        self.streaming_merge = streaming_merge
+        # `progress.ProgressChannel` the byte counts are posted to, under the video link.
+        self.progress_channel = progress_channel
+        # Download again and replace an output file that already exists. Otherwise it is kept
+        # as it is and nothing is downloaded.
+        self.overwrite = overwrite
+        # Path of the merged file produced by the last `download()` call, if any.
+        self.output_filename = None
+        # `output_writer.Reservation` of the space the download's files need until they are final.
+        self._reservation = None
+        # (optional) `asyncio.Semaphore` the transfer holds a slot of, e.g. a playlist's
+        # `max_workers`. A merge waiting in the merge pool doesn't hold it.
+        self.transfer_slots = None
 
     def download(self):
-        if self._initiate_download():
-            self._perform_download()
+        """Download the video and return True if the merged file was produced."""
+        return download_engine.run(self.download_async())
 
-    def _initiate_download(self):
-        """Attempt to initialize the YouTube object with retries."""
-        for _ in range(3):  # Try 3 times
-            try:
-                self.yt = YouTube(self.link, on_progress_callback=self.progress_callback)
-                return True
-            except Exception as e:
-                time.sleep(5)
-                print(str(e))
-        else:
-            print("Failed to fetch the video after 3 attempts.")
+    async def download_async(self):
+        """
+        Download the video's streams as tasks of the running event loop. When they had to be
+        downloaded to temporary files, their merge is queued in the shared merge pool and the
+        transfer slot, if any, is given back while it runs, so the caller's next download starts.
+
+        :return: True if the merged file was produced.
+        """
+        self.metrics = JobMetrics(self.link, self.metrics_name)
+        output = None
+        try:
+            async with self.transfer_slots or contextlib.nullcontext():
+                if await self._initiate_download():
+                    output = await self._perform_download()
+            if isinstance(output, asyncio.Task):
+                output = await output
+        except BaseException as e:
+            self._finish(None, "cancelled" if isinstance(e, (DownloadCancelled, asyncio.CancelledError)) else "failed")
+            raise
+        self._finish(output, "ok" if output else "failed")
+        return output is not None
+
+    def _finish(self, output_filename, status):
+        if self._reservation:
+            self._reservation.release()
+        self.output_filename = output_filename
+        self.metrics.finish(status, self.bytes_downloaded)
+        metrics_recorder.record(self.metrics)
+        if self.progress_channel:
+            self.progress_channel.complete(self.link)
+
+    async def _initiate_download(self):
+        """Resolve the video metadata (from the cache when possible), retrying transient failures."""
+        def resolve():
+            with self.metrics.phase("resolve"):
+                return metadata_cache.get_video(self.link)
+        try:
+            self.yt = await retry_policy.run_async(resolve, on_retry=self._retry_reporter("resolve"))
+            return True
+        except Exception as e:
+            print(f"Failed to fetch the video: {e}")
             return False
 
-    def _perform_download(self):
-        """Execute the download actions assuming YouTube object is initialized."""
-        video_fetcher = VideoStreamFetcher(yt=self.yt, video_quality=self.video_quality)
-        audio_fetcher = AudioStreamFetcher(self.yt, self.video_quality)
+    async def _perform_download(self):
+        """
+        Execute the download actions assuming YouTube object is initialized.
 
-        video_stream = video_fetcher.get_video_stream()
-        audio_stream = audio_fetcher.get_audio_stream()
+        :return: Path of the merged file, None on failure, or the merge pool's task of either
+                 when the streams were downloaded to temporary files.
+        """
+        self._check_cancelled()
+        file_merger = FileMerger(yt=self.yt, 
+                                 folder=self.folder, 
+                                 video_quality=self.video_quality,
+                                 metrics=self.metrics)
+        output_filename = file_merger.output_filename(self.if_playlist_video_count)
+        if self._keep_existing(output_filename):
+            return output_filename
+
+        with self.metrics.phase("select"):
+            try:
+                selection = await offload(lambda: stream_index_of(self.yt).select(self.video_quality))
+            except Exception as e:
+                print(f"Error fetching streams of quality {self.video_quality}: {e}")
+                selection = None
 
         # Make sure we have valid streams before proceeding
-        if not video_stream or not audio_stream:
+        if not selection:
             print("Error fetching video or audio stream.")
-            return
+            return None
+
+        # The same video at the same quality may already be in the content store.
+        store_key = (self.yt.video_id, selection.itag, self.video_quality)
+        if await self._restore(store_key, output_filename):
+            return output_filename
+
+        if selection.progressive:
+            if not await offload(self._reserve_space, selection.video.filesize):
+                return None
+            return await self._download_progressive(selection.video, file_merger, store_key)
 
-        combined_progress = CombinedProgress(video_stream=video_stream, 
-                                             audio_stream=audio_stream, 
-                                             progress_callback=self._update_combined_progress)
+        video_stream, audio_stream = selection.video, selection.audio
+        streaming = self.streaming_merge and file_merger.can_merge_streams(video_stream, audio_stream)
+        # Piped into ffmpeg, the streams only take the room of the merged file; downloaded to
+        # temporary files, they take it twice until the merge removes them.
+        streams_size = video_stream.filesize + audio_stream.filesize
+        if not await offload(self._reserve_space, streams_size if streaming else 2 * streams_size):
+            return None
+        hashers = None
+        if content_store.enabled and video_stream.filesize and audio_stream.filesize:
+            hashers = (BlockHasher(video_stream.filesize), BlockHasher(audio_stream.filesize))
+        combined_progress = self._combined_progress(video_stream, audio_stream)
+
+        if streaming:
+            with self.metrics.phase("stream_merge"):
+                output_filename = await file_merger.merge_streams(video_stream, audio_stream, 
+                                                                  video_count=self.if_playlist_video_count, 
+                                                                  on_video_progress=combined_progress.video_progress, 
+                                                                  on_audio_progress=combined_progress.audio_progress,
+                                                                  video_hasher=hashers[0] if hashers else None,
+                                                                  audio_hasher=hashers[1] if hashers else None)
+            if output_filename:
+                self.bytes_downloaded = video_stream.filesize + audio_stream.filesize
+                await self._store_output(store_key, hashers, output_filename)
+                return output_filename
+            if file_merger.cancelled:
+                raise DownloadCancelled()
+            self.metrics.count_retry("stream_merge")
+            print("Streaming merge failed, downloading to temporary files instead.")
+            if not await offload(self._reserve_space, 2 * streams_size):
+                return None
+            if hashers:
+                hashers = (BlockHasher(video_stream.filesize), BlockHasher(audio_stream.filesize))
+            combined_progress = self._combined_progress(video_stream, audio_stream)
         
         downloader = StreamDownloader(folder=self.folder)
 
-        self.yt.register_on_progress_callback(combined_progress.video_progress)
-        video_filename = downloader.download_stream(stream=video_stream, prefix="video_")
+        # Fetch both DASH streams at the same time; each one reports to its own progress slot.
+        try:
+            with self.metrics.phase("transfer"):
+                video_filename, audio_filename = await gather_tasks(
+                    downloader.download_stream(video_stream, "video_", combined_progress.video_progress,
+                                               hashers[0] if hashers else None),
+                    downloader.download_stream(audio_stream, "audio_", combined_progress.audio_progress,
+                                               hashers[1] if hashers else None))
+        finally:
+            downloader.close()
+        self.bytes_downloaded = os.path.getsize(video_filename) + os.path.getsize(audio_filename)
 
-        self.yt.register_on_progress_callback(combined_progress.audio_progress)  # Switch to audio progress
-        audio_filename = downloader.download_stream(audio_stream, "audio_")
+        async def merge():
+            with self.metrics.phase("merge"):
+                output_filename = await file_merger.merge(video_count=self.if_playlist_video_count, video_filename=video_filename, audio_filename=audio_filename)
+            if output_filename:
+                await self._store_output(store_key, hashers, output_filename)
+            return output_filename
+        # Waits while the merge pool is full, so downloaded pairs don't pile up on disk.
+        with self.metrics.phase("merge_wait"):
+            return await merge_pool.submit(merge)
 
-        file_merger = FileMerger(yt=self.yt, 
-                                 folder=self.folder, 
-                                 video_quality=self.video_quality)
-        file_merger.merge(video_count=self.if_playlist_video_count, video_filename=video_filename, audio_filename=audio_filename)
+    def _keep_existing(self, output_filename):
+        """
+        Tell whether an output file already at `output_filename` is kept instead of downloaded
+        again, which is checked before any stream is fetched.
+
+        :return: True if the file exists and `overwrite` is off.
+        """
+        if self.overwrite or not os.path.exists(output_filename):
+            return False
+        print(f"'{output_filename}' already exists, not downloading it again.")
+        return True
+
+    def _reserve_space(self, size):
+        """
+        Reserve room for the download's files in the destination folder, replacing any earlier
+        reservation of this download, so a full disk fails the job before the transfer starts.
+
+        :return: True if there is room.
+        """
+        if self._reservation:
+            self._reservation.release()
+        try:
+            self._reservation = output_writer.reserve(self.folder, size)
+            return True
+        except InsufficientSpaceError as e:
+            print(f"Not downloading '{self.yt.title}': {e.strerror}")
+            return False
+
+    async def _download_progressive(self, stream, file_merger, store_key):
+        """
+        Download a stream that already carries both video and audio straight into the output
+        file: one transfer and no ffmpeg run.
+
+        :return: Path of the output file.
+        """
+        hashers = (BlockHasher(stream.filesize),) if content_store.enabled and stream.filesize else None
+        with self.metrics.phase("transfer"):
+            filename = await self._download_stream(stream, "progressive_", hashers)
+        self.bytes_downloaded = os.path.getsize(filename)
+        output_filename = file_merger.output_filename(self.if_playlist_video_count)
+        os.replace(filename, output_filename)
+        await self._store_output(store_key, hashers, output_filename)
+        return output_filename
+
+    async def _download_stream(self, stream, prefix, hashers):
+        """Download a lone stream to a file of the folder, reporting its progress like `CombinedProgress` does."""
+        downloader = StreamDownloader(folder=self.folder)
+        try:
+            return await downloader.download_stream(stream, prefix, self._stream_progress(stream),
+                                                    hashers[0] if hashers else None)
+        finally:
+            downloader.close()
+
+    async def _restore(self, store_key, output_filename):
+        """Put the output at `output_filename` from the content store if it is stored there. Returns True if it was."""
+        stored = await offload(content_store.lookup, *store_key)
+        if stored and await offload(content_store.materialize, stored, output_filename, self.overwrite):
+            print(f"Restored '{self.yt.title}' from the content store.")
+            return True
+        return False
+
+    async def _store_output(self, store_key, hashers, output_filename):
+        """Record a merged file in the content store under the digest of the streams it was made from."""
+        if not hashers:
+            return
+        try:
+            digest = combine_digests(*(hasher.hexdigest() for hasher in hashers))
+        except ValueError as e:
+            print(f"Not adding '{self.yt.title}' to the content store: {e}")
+            return
+        with self.metrics.phase("store"):
+            await offload(content_store.add, *store_key, digest, output_filename)
+
+    def _combined_progress(self, video_stream, audio_stream):
+        job_progress = None
+        if self.progress_channel:
+            job_progress = JobProgress(self.progress_channel, self.link, video_stream.filesize + audio_stream.filesize)
+        return CombinedProgress(video_stream=video_stream, 
+                                audio_stream=audio_stream, 
+                                progress_callback=self._update_combined_progress,
+                                job_progress=job_progress)
 
     def _update_combined_progress(self, combined_percentage):
+        self._check_cancelled()
         if self.progress_callback:
             self.progress_callback(None, None, combined_percentage)
 
+    def _stream_progress(self, single_stream):
+        """Return an `on_progress` callback reporting a lone stream's progress like `CombinedProgress` does."""
+        job_progress = JobProgress(self.progress_channel, self.link, single_stream.filesize) if self.progress_channel else None
+        last_reported = [0]
+
+        def on_progress(stream, chunk, bytes_remaining):
+            bytes_done = single_stream.filesize - bytes_remaining
+            if job_progress:
+                job_progress.update(bytes_done)
+            percentage = bytes_done / single_stream.filesize * 100 if single_stream.filesize else 0
+            if abs(percentage - last_reported[0]) > 5:
+                last_reported[0] = percentage
+                self._update_combined_progress(percentage)
+        return on_progress
+
+
+class AudioDownloadStrategy(VideoDownloadStrategy):
+    """
+    Downloads only the audio stream of a video, picked by `AudioStreamFetcher`, and turns it
+    into an M4A file by stream copy, or an MP3 or Opus file by transcoding. The conversion runs
+    in the merge pool like the merges of videos.
+    """
+    metrics_name = "audio"
+
+    def __init__(self, link, folder, audio_format=DEFAULT_AUDIO_FORMAT, progress_callback=None, if_playlist_video_count="",
+                 progress_channel=None, overwrite=False):
+        super().__init__(link, folder, video_quality=None, progress_callback=progress_callback,
+                         if_playlist_video_count=if_playlist_video_count, progress_channel=progress_channel,
+                         overwrite=overwrite)
+        self.audio_format = audio_format or DEFAULT_AUDIO_FORMAT
+
+    async def _perform_download(self):
+        """
+        Download the audio stream and queue its conversion.
+
+        :return: Path of the audio file restored from the content store, None on failure, or the
+                 merge pool's task of either.
+        """
+        self._check_cancelled()
+        converter = AudioConverter(yt=self.yt, folder=self.folder, audio_format=self.audio_format, metrics=self.metrics)
+        output_filename = converter.output_filename(self.if_playlist_video_count)
+        if self._keep_existing(output_filename):
+            return output_filename
+
+        with self.metrics.phase("select"):
+            # Prefer the stream a stream copy can be made from.
+            audio_stream = await offload(AudioStreamFetcher(self.yt, None, subtype=converter.stream_subtype).get_audio_stream)
+        if not audio_stream:
+            print("Error fetching audio stream.")
+            return None
+
+        store_key = (self.yt.video_id, str(audio_stream.itag), self.audio_format)
+        if await self._restore(store_key, output_filename):
+            return output_filename
+
+        # The downloaded stream, then the audio file made from it, of about the same size.
+        if not await offload(self._reserve_space, 2 * audio_stream.filesize):
+            return None
+        hashers = None
+        if content_store.enabled and audio_stream.filesize:
+            hashers = (BlockHasher(audio_stream.filesize),)
+        with self.metrics.phase("transfer"):
+            audio_filename = await self._download_stream(audio_stream, "audio_", hashers)
+        self.bytes_downloaded = os.path.getsize(audio_filename)
+
+        async def convert():
+            with self.metrics.phase("merge"):
+                output_filename = await converter.convert(audio_filename, audio_stream.subtype, self.if_playlist_video_count)
+            if output_filename:
+                await self._store_output(store_key, hashers, output_filename)
+            return output_filename
+        with self.metrics.phase("merge_wait"):
+            return await merge_pool.submit(convert)
+
 
 class PlaylistDownloadStrategy(IDownloadStrategy):
-    def __init__(self, link, folder, video_quality, progress_callback):
+    def __init__(self, link, folder, video_quality, progress_callback, max_workers=None, skip_videos=None, on_video_done=None,
+                 progress_channel=None, sync=False, renumber=False, prune=False, audio_format=None, overwrite=False):
         super().__init__(link, folder)
         self.video_quality = video_quality
+        # Download only the audio of the videos, in this format (see `AudioDownloadStrategy`).
+        self.audio_format = audio_format
         self.progress_callback = progress_callback
+        self.max_workers = max_workers or DEFAULT_PLAYLIST_WORKERS
+        # Playlist numbers (as strings) of videos already downloaded by an earlier run.
+        self.skip_videos = set(skip_videos or ())
+        # Called with (video number, url, succeeded) as each video finishes.
+        self.on_video_done = on_video_done
+        # `progress.ProgressChannel` each video posts its byte counts to, under its own link.
+        self.progress_channel = progress_channel
+        # Sync mode: keep a manifest in the playlist folder and only download new or incomplete entries.
+        # Optionally rename the files of entries that moved and delete those of removed entries.
+        self.sync = sync
+        self.renumber = renumber
+        self.prune = prune
+        # Download again the videos whose file already exists (see `VideoDownloadStrategy`). Sync
+        # mode always does, as it only downloads the entries the manifest found missing or incomplete.
+        self.overwrite = overwrite or sync
+        self.manifest = None
+        self.metrics = JobMetrics(self.link, "playlist")
     
-        self.playlist = Playlist(self.link)    
+        with self.metrics.phase("resolve"):
+            if self.sync:
+                # A sync is about the playlist as it is now, not as it was when it was cached.
+                metadata_cache.invalidate(self.link)
+            # Only the first page is fetched here; the rest of the playlist is paged in the background.
+            self.playlist = metadata_cache.stream_playlist(self.link)
         self.folder += f"/{self.playlist.title}" 
 
     def download(self):
-        for index, url in enumerate(self.playlist.video_urls):
-            video = VideoDownloadStrategy(link=url, folder=self.folder, video_quality=self.video_quality, progress_callback=self.progress_callback, if_playlist_video_count=str(index + 1))
-            video.download()
+        """Download the playlist videos; see `download_async`."""
+        return download_engine.run(self.download_async())
+
+    async def download_async(self):
+        """
+        Download the playlist videos as tasks of the running event loop, with up to `max_workers`
+        videos transferring at once.
+
+        Videos are queued as the playlist's pages come in, so the first ones start downloading
+        while the rest of a large playlist is still being enumerated. Sync mode waits for the
+        whole playlist instead, since it needs every entry to tell which ones were removed.
+
+        Each video keeps the number it has in the playlist, whatever order they finish in.
+        A failing video is recorded and does not stop the others. Videos listed in `skip_videos`,
+        and in sync mode the videos the manifest lists as complete, count as done without being
+        downloaded again. Cancelling (`cancel()`, or `DownloadCancelled` raised by the progress
+        callback) stops the videos not yet started and is raised once the others stop.
+
+        :return: List of (video number, url, succeeded, error message) tuples in playlist order.
+        """
+        self._skip = set(self.skip_videos)
+        if self.sync:
+            playlist = await offload(self.playlist.wait)
+            self._skip |= await offload(self._plan_sync, playlist.video_urls)
+        self.bytes_downloaded = 0
+        self._bytes_lock = threading.Lock()
+        playlist_progress = PlaylistProgress(video_count=0, progress_callback=self.progress_callback)
+        # A video holds a slot while it resolves and transfers, not while its merge is pending.
+        transfer_slots = asyncio.Semaphore(self.max_workers)
+
+        status = "cancelled"
+        enumeration_error = None
+        tasks = []
+        try:
+            with self.metrics.phase("videos"):
+                try:
+                    # Later pages are fetched as the enumeration reaches them, which blocks.
+                    videos = enumerate(self.playlist)
+                    while not self.cancelled.is_set():
+                        entry = await offload(next, videos, None)
+                        if entry is None:
+                            break
+                        index, url = entry
+                        playlist_progress.add_video()
+                        if self.progress_channel:
+                            # Announce each video as soon as it is known so the playlist-wide figure counts it.
+                            self.progress_channel.post(url, 0, 0)
+                        tasks.append(asyncio.ensure_future(
+                            self._download_video(index, url, playlist_progress, transfer_slots)))
+                except Exception as e:
+                    enumeration_error = e
+                    print(f"Could not list the whole playlist '{self.playlist.title}': {e}")
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+                # A cancellation stops the other videos before it is raised.
+                results = await gather_tasks(*tasks)
+            status = "ok" if enumeration_error is None and all(result[2] for result in results) else "failed"
+        finally:
+            self.metrics.finish(status, self.bytes_downloaded)
+            metrics_recorder.record(self.metrics)
+
+        self._print_summary(results)
+        return results
+
+    @property
+    def output_quality(self):
+        """What the manifest records the entries as downloaded at: the video quality, or the audio format."""
+        return self.audio_format or self.video_quality
+
+    async def _download_video(self, index, url, playlist_progress, transfer_slots):
+        """
+        Download one playlist entry and report how it went instead of raising. Its metadata is
+        resolved first through the retry policy, which backs off without holding one of the
+        `max_workers` transfer slots.
+
+        :return: The (video number, url, succeeded, error message) of the entry.
+        """
+        self._check_cancelled()
+        video_count = str(index + 1)
+        if video_count in self._skip:
+            playlist_progress.video_finished(index)
+            if self.progress_channel:
+                self.progress_channel.complete(url)
+            return video_count, url, True, ""
+
+        resolve_error = None
+        try:
+            await retry_policy.run_async(metadata_cache.get_video, url, on_retry=self._retry_reporter("resolve", url))
+        except Exception as e:
+            resolve_error = e
+
+        if self.audio_format:
+            video = AudioDownloadStrategy(link=url,
+                                          folder=self.folder,
+                                          audio_format=self.audio_format,
+                                          progress_callback=playlist_progress.video_progress(index),
+                                          if_playlist_video_count=video_count,
+                                          progress_channel=self.progress_channel,
+                                          overwrite=self.overwrite)
+        else:
+            video = VideoDownloadStrategy(link=url, 
+                                          folder=self.folder, 
+                                          video_quality=self.video_quality, 
+                                          progress_callback=playlist_progress.video_progress(index), 
+                                          if_playlist_video_count=video_count,
+                                          progress_channel=self.progress_channel,
+                                          overwrite=self.overwrite)
+        # Cancelling the playlist cancels its videos.
+        video.cancelled = self.cancelled
+        video.transfer_slots = transfer_slots
+        video_id = video_id_of(url) if self.manifest else None
+        if self.manifest:
+            await offload(self.manifest.mark_downloading, video_id, video_count, url, self.output_quality)
+        error = ""
+        try:
+            if resolve_error:
+                raise resolve_error
+            succeeded = await video.download_async()
+            if not succeeded:
+                error = "Video could not be downloaded."
+        except DownloadCancelled:
+            self.cancelled.set()
+            raise
+        except Exception as e:
+            succeeded, error = False, str(e)
+        return await offload(self._video_done, index, url, video, video_id, playlist_progress, succeeded, error)
+
+    def _video_done(self, index, url, video, video_id, playlist_progress, succeeded, error=""):
+        """
+        Record how a playlist entry went: in the manifest, the byte count and the progress.
+
+        :return: The (video number, url, succeeded, error message) of the entry.
+        """
+        video_count = str(index + 1)
+        if self.manifest:
+            if succeeded:
+                self.manifest.mark_complete(video_id, video.output_filename)
+            else:
+                self.manifest.mark_failed(video_id, error)
+        with self._bytes_lock:
+            self.bytes_downloaded += video.bytes_downloaded
+        if self.on_video_done:
+            self.on_video_done(video_count, url, succeeded)
+        playlist_progress.video_finished(index)
+        return video_count, url, succeeded, error
+
+    def _plan_sync(self, video_urls):
+        """Compare the folder's manifest with the playlist, apply renumbering and pruning, and
+        return the playlist numbers that are already up to date."""
+        self.manifest = PlaylistManifest(self.folder)
+        plan = self.manifest.plan(video_urls, self.output_quality)
+        print(f"Playlist '{self.playlist.title}': {len(plan.to_download)} new or incomplete, "
+              f"{len(plan.up_to_date)} up to date, {len(plan.moved)} moved, {len(plan.removed)} removed.")
+        if self.renumber:
+            for video_id, _, new_number in plan.moved:
+                self.manifest.renumber(video_id, new_number)
+        if self.prune:
+            for video_id in plan.removed:
+                self.manifest.prune(video_id)
+        return {str(index + 1) for index in plan.up_to_date}
+
+    def _print_summary(self, results):
+        failed = [result for result in results if not result[2]]
+        print(f"Playlist '{self.playlist.title}': {len(results) - len(failed)} of {len(results)} videos downloaded.")
+        for video_count, url, _, error in failed:
+            print(f"  #{video_count} {url} failed: {error}")
 
 
 class ThumbnailDownloadStrategy(IDownloadStrategy):
-    def __init__(self, link, folder):
+    def __init__(self, link, folder, show_thumbnail=True, image_format=None, size=None, max_workers=None):
         super().__init__(link, folder)
+        # Open the downloaded thumbnail in the image viewer; headless callers turn this off.
+        # Never done for playlists.
+        self.show_thumbnail = show_thumbnail
+        # Pillow format and (width, height) box the thumbnails are converted to; None keeps them as fetched.
+        self.image_format = image_format
+        self.size = size
+        # Number of playlist thumbnails fetched at the same time.
+        self.max_workers = max_workers or DEFAULT_THUMBNAIL_FETCHERS
 
     def download(self):
-        yt = YouTube(self.link)
-        title = yt.title
-        valid_filename = re.sub(r'[^\w\s-]', '', title).strip().replace(' ', '_')
-        PicUrl = yt.thumbnail_url
-        filename = f"{self.folder}/{valid_filename}.png"
-        urllib.request.urlretrieve(PicUrl, filename)
-        img = Image.open(filename)
-        img.show()
-        return img
+        """Download the thumbnails; see `download_async`."""
+        return download_engine.run(self.download_async())
+
+    async def download_async(self):
+        """
+        Download the thumbnail of a video, or of every video of a playlist into a folder named
+        after the playlist. Failed fetches back off on the event loop, without holding a worker.
+
+        :return: Path of the written file for a video. For a playlist, a list of
+                 (video number, url, succeeded, error message) tuples in playlist order.
+        """
+        self.metrics = JobMetrics(self.link, "thumbnail")
+        self.bytes_downloaded = 0
+        self._bytes_lock = threading.Lock()
+        status = "failed"
+        try:
+            if "youtube.com/playlist?list=" in self.link:
+                result = await self._download_playlist()
+                status = "ok" if all(item[2] for item in result) else "failed"
+            else:
+                result = await self._download_video()
+                status = "ok"
+        finally:
+            self.metrics.finish(status, self.bytes_downloaded)
+            metrics_recorder.record(self.metrics)
+        return result
+
+    async def _download_video(self):
+        saved = await retry_policy.run_async(self._fetch, self.link, self.folder,
+                                             on_retry=self._retry_reporter("transfer"))
+        path = await asyncio.wrap_future(saved)
+        if self.show_thumbnail:
+            # Pillow is only needed here, so it isn't imported until a thumbnail is shown.
+            from PIL import Image
+            await offload(lambda: Image.open(path).show())
+        return path
+
+    async def _download_playlist(self):
+        """
+        Fetch the thumbnails as the playlist's pages come in, up to `max_workers` at once, while
+        the ones already fetched are converted and written in the pipeline's worker pool.
+        """
+        with self.metrics.phase("resolve"):
+            playlist = await offload(metadata_cache.stream_playlist, self.link)
+        folder = f"{self.folder}/{playlist.title}"
+        fetch_slots = asyncio.Semaphore(self.max_workers)
+
+        async def download(index, url):
+            try:
+                async with fetch_slots:
+                    saved = await retry_policy.run_async(self._fetch, url, folder, f"{index + 1}_",
+                                                         on_retry=self._retry_reporter("transfer", url))
+                await asyncio.wrap_future(saved)
+                return str(index + 1), url, True, ""
+            except Exception as e:
+                return str(index + 1), url, False, str(e)
+
+        tasks = []
+        try:
+            # Later pages are fetched as the enumeration reaches them, which blocks.
+            videos = enumerate(playlist)
+            while True:
+                entry = await offload(next, videos, None)
+                if entry is None:
+                    break
+                tasks.append(asyncio.ensure_future(download(*entry)))
+            results = await gather_tasks(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        failed = [result for result in results if not result[2]]
+        print(f"Playlist '{playlist.title}': {len(results) - len(failed)} of {len(results)} thumbnails downloaded.")
+        for video_count, url, _, error in failed:
+            print(f"  #{video_count} {url} failed: {error}")
+        return results
+
+    def _fetch(self, url, folder, prefix=""):
+        """Fetch the thumbnail of the video at `url` and return the future of its conversion."""
+        self._check_cancelled()
+        with self.metrics.phase("resolve"):
+            yt = metadata_cache.get_video(url)
+        valid_filename = re.sub(r'[^\w\s-]', '', yt.title).strip().replace(' ', '_')
+        with self.metrics.phase("transfer"):
+            data = thumbnail_pipeline.fetch(yt.thumbnail_url, job_id=self.link)
+        with self._bytes_lock:
+            self.bytes_downloaded += len(data)
+        return thumbnail_pipeline.submit(self._save, data, f"{folder}/{prefix}{valid_filename}")
+
+    def _save(self, data, path_stem):
+        with self.metrics.phase("convert"):
+            return thumbnail_pipeline.save(data, path_stem, self.image_format, self.size)
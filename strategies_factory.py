@@ -1,4 +1,5 @@
-from strategies import VideoDownloadStrategy, PlaylistDownloadStrategy, ThumbnailDownloadStrategy, IDownloadStrategy
+from strategies import VideoDownloadStrategy, AudioDownloadStrategy, PlaylistDownloadStrategy, ThumbnailDownloadStrategy, IDownloadStrategy
+from utils import AUDIO_FORMATS, DEFAULT_AUDIO_FORMAT
 
 class StrategyFactory:
     """
@@ -7,27 +8,76 @@ class StrategyFactory:
     """
     
     @staticmethod
-    def get_strategy(strategy_type: str, link: str, folder: str, quality: str = None, progress_callback=None) -> IDownloadStrategy:
+    def get_strategy(strategy_type: str, link: str, folder: str, quality: str = None, progress_callback=None, max_workers: int = None, show_thumbnail: bool = True,
+                     skip_videos=None, on_video_done=None, progress_channel=None, sync=False, renumber=False,
+                     prune=False, thumbnail_format=None, thumbnail_size=None, overwrite=False) -> IDownloadStrategy:
         """
         Returns an instance of a download strategy based on the provided strategy type.
 
         :param strategy_type: Type of strategy to create.
         :param link: The link to the content to be downloaded.
         :param folder: Destination folder for the download.
-        :param quality: (optional) Quality of the content.
+        :param quality: (optional) Quality of the content; for the `audio` strategy, the audio format (m4a, mp3 or opus).
         :param progress_callback: (optional) Callback function to track download progress.
+        :param max_workers: (optional) Number of playlist videos to download at the same time.
+        :param show_thumbnail: (optional) Whether a downloaded thumbnail is opened in the image viewer.
+        :param skip_videos: (optional) Playlist numbers of videos already downloaded, which are skipped.
+        :param on_video_done: (optional) Callback taking (video number, url, succeeded) for each playlist video.
+        :param progress_channel: (optional) `progress.ProgressChannel` the videos post their byte counts to.
+        :param sync: (optional) Only download the playlist videos that are new or incomplete in the folder's manifest.
+        :param renumber: (optional) When syncing, rename the files of videos that moved in the playlist.
+        :param prune: (optional) When syncing, delete the files of videos removed from the playlist.
+        :param thumbnail_format: (optional) Image format thumbnails are converted to, e.g. `PNG`.
+        :param thumbnail_size: (optional) (width, height) box thumbnails are shrunk to fit.
+        :param overwrite: (optional) Download again and replace the video and audio files that already exist.
         :return: Instance of a download strategy.
         """
+        if strategy_type == "audio" and quality and quality not in AUDIO_FORMATS:
+            raise ValueError(f"Audio format '{quality}' not recognized, expected one of {', '.join(AUDIO_FORMATS)}")
         if strategy_type == "video":
             return VideoDownloadStrategy(link=link, 
                                 folder=folder, 
-                                video_quality=quality, progress_callback=progress_callback)
+                                video_quality=quality, progress_callback=progress_callback,
+                                progress_channel=progress_channel,
+                                overwrite=overwrite)
         elif strategy_type == "playlist":
             return PlaylistDownloadStrategy(link=link, 
                                 folder=folder, 
                                 video_quality=quality,
-                                progress_callback=progress_callback)
+                                progress_callback=progress_callback,
+                                max_workers=max_workers,
+                                skip_videos=skip_videos,
+                                on_video_done=on_video_done,
+                                progress_channel=progress_channel,
+                                sync=sync,
+                                renumber=renumber,
+                                prune=prune,
+                                overwrite=overwrite)
+        elif strategy_type == "audio":
+            if "youtube.com/playlist?list=" in link:
+                return PlaylistDownloadStrategy(link=link,
+                                    folder=folder,
+                                    video_quality=None,
+                                    progress_callback=progress_callback,
+                                    max_workers=max_workers,
+                                    skip_videos=skip_videos,
+                                    on_video_done=on_video_done,
+                                    progress_channel=progress_channel,
+                                    sync=sync,
+                                    renumber=renumber,
+                                    prune=prune,
+                                    audio_format=quality or DEFAULT_AUDIO_FORMAT,
+                                    overwrite=overwrite)
+            return AudioDownloadStrategy(link=link,
+                                folder=folder,
+                                audio_format=quality,
+                                progress_callback=progress_callback,
+                                progress_channel=progress_channel,
+                                overwrite=overwrite)
         elif strategy_type == "thumbnail":
-            return ThumbnailDownloadStrategy(link, folder)
+            return ThumbnailDownloadStrategy(link, folder, show_thumbnail=show_thumbnail,
+                                             image_format=thumbnail_format,
+                                             size=thumbnail_size,
+                                             max_workers=max_workers)
         else:
             raise ValueError(f"Strategy type '{strategy_type}' not recognized!")
@@ -0,0 +1,156 @@
+from collections import defaultdict
+
+# Video codecs in the order they are preferred: H.264 plays everywhere, AV1 needs recent decoders.
+# Codecs not listed rank last.
+CODEC_PREFERENCE = ("avc1", "vp9", "av01")
+
+
+def _resolution_value(resolution: str) -> int:
+    return int(resolution[:-1]) if resolution else 0
+
+
+def _abr_value(abr: str) -> int:
+    return int(abr[:-4]) if abr and abr.endswith("kbps") else 0
+
+
+def codec_family(stream) -> str:
+    """The codec of a stream's video track without its profile, e.g. `avc1` for `avc1.640028`."""
+    return (getattr(stream, "video_codec", None) or "").split(".")[0]
+
+
+def _codec_rank(stream) -> int:
+    codec = codec_family(stream)
+    return CODEC_PREFERENCE.index(codec) if codec in CODEC_PREFERENCE else len(CODEC_PREFERENCE)
+
+
+class StreamSelection:
+    """The streams to download for a request: one progressive stream, or a video/audio pair to merge."""
+
+    def __init__(self, video, audio=None) -> None:
+        """
+        :param video: The progressive stream, or the video stream of the pair.
+        :param audio: (optional) The audio stream of the pair; None for a progressive stream.
+        """
+        self.video = video
+        self.audio = audio
+
+    @property
+    def progressive(self) -> bool:
+        return self.audio is None
+
+    @property
+    def streams(self) -> tuple:
+        return (self.video,) if self.progressive else (self.video, self.audio)
+
+    @property
+    def itag(self) -> str:
+        """Identifies the selection in the content store, e.g. `18` or `137+140`."""
+        return "+".join(str(stream.itag) for stream in self.streams)
+
+
+class StreamIndex:
+    """
+    The streams of one video, grouped once by kind and resolution, so picking streams doesn't go
+    through the whole stream list again for every question.
+
+    At each resolution, streams are ranked by codec as `CODEC_PREFERENCE` says, then by size
+    within a codec, so a smaller AV1 stream never replaces the H.264 one. Sizes come from the
+    stream manifest. A stream whose size the manifest doesn't give ranks after those of known
+    size, so choosing never costs a request.
+    """
+
+    def __init__(self, streams, sizes: dict = None) -> None:
+        """
+        :param streams: The video's streams, e.g. `yt.streams`.
+        :param sizes: (optional) Size in bytes of each stream by itag, from the manifest.
+        """
+        self.sizes = sizes or {}
+        self.progressive = defaultdict(list)
+        self.video = defaultdict(list)
+        self.audio = []
+        for stream in streams:
+            if stream.is_progressive:
+                self.progressive[stream.resolution].append(stream)
+            elif stream.includes_video_track:
+                self.video[stream.resolution].append(stream)
+            elif stream.includes_audio_track:
+                self.audio.append(stream)
+        for streams_at_resolution in list(self.progressive.values()) + list(self.video.values()):
+            streams_at_resolution.sort(key=lambda stream: (_codec_rank(stream), self.size_key(stream)))
+        # Highest bitrate first; the smallest file first among equal bitrates.
+        self.audio.sort(key=lambda stream: (-_abr_value(stream.abr), self.size_key(stream)))
+
+    def size(self, stream) -> int:
+        """Size of the stream in bytes as the manifest gives it, 0 if unknown."""
+        return self.sizes.get(stream.itag, 0)
+
+    def size_key(self, stream) -> tuple:
+        size = self.size(stream)
+        return (size == 0, size)
+
+    def resolutions(self, subtype: str = "mp4") -> list:
+        """Resolutions available in the container `subtype`, as a video-only or progressive stream, lowest first."""
+        resolutions = {resolution for group in (self.video, self.progressive)
+                       for resolution, streams in group.items()
+                       if resolution and any(stream.subtype == subtype for stream in streams)}
+        return sorted(resolutions, key=_resolution_value)
+
+    def video_stream(self, resolution: str = None, subtype: str = "mp4", codec: str = None):
+        """
+        The video-only stream at `resolution` in the container `subtype` of the most preferred
+        codec, the smallest of that codec, or None. Without a resolution, the highest one available.
+
+        :param codec: (optional) Only consider this codec, e.g. `vp9`.
+        """
+        def matches(stream):
+            return stream.subtype == subtype and (codec is None or codec_family(stream) == codec)
+        if resolution is None:
+            available = [res for res, streams in self.video.items() if any(matches(s) for s in streams)]
+            resolution = max(available, key=_resolution_value, default=None)
+        return next((stream for stream in self.video.get(resolution, []) if matches(stream)), None)
+
+    def progressive_stream(self, resolution: str, subtype: str = "mp4"):
+        """The progressive stream at `resolution` in the container `subtype`, ranked like video streams, or None."""
+        return next((stream for stream in self.progressive.get(resolution, []) if stream.subtype == subtype), None)
+
+    def audio_streams(self, subtype: str = None) -> list:
+        """Audio-only streams, best bitrate first, limited to the container `subtype` if it has any."""
+        if subtype and any(stream.subtype == subtype for stream in self.audio):
+            return [stream for stream in self.audio if stream.subtype == subtype]
+        return list(self.audio)
+
+    def audio_stream(self, video_quality: str = None, subtype: str = None):
+        """
+        The audio stream that goes with a video quality: the best one for 1080p, 720p and audio
+        on its own (None), the third best for lower qualities.
+        """
+        audio_streams = self.audio_streams(subtype)
+        if not audio_streams:
+            return None
+        if video_quality in [None, "1080p", "720p"]:
+            return audio_streams[0]
+        return audio_streams[2] if len(audio_streams) > 2 else audio_streams[-1]
+
+    def select(self, video_quality: str = None) -> StreamSelection:
+        """
+        Choose what to download for a video quality: a progressive stream at that resolution if
+        there is one, as it needs a single download and no merge; otherwise the video stream at
+        that resolution picked by `video_stream()` with its audio stream.
+
+        :return: The selection, or None if the quality isn't available.
+        """
+        if video_quality:
+            progressive = self.progressive_stream(video_quality)
+            if progressive:
+                return StreamSelection(progressive)
+        video = self.video_stream(video_quality)
+        audio = self.audio_stream(video_quality)
+        if not video or not audio:
+            return None
+        return StreamSelection(video, audio)
+
+
+def stream_index_of(yt) -> StreamIndex:
+    """The stream index of a video: built once by `CachedVideo`, or on the spot for a `YouTube` object."""
+    index = getattr(yt, "stream_index", None)
+    return index if index is not None else StreamIndex(yt.streams)
@@ -0,0 +1,140 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bandwidth_governor import governor
+from retry_policy import HTTPStatusError
+from segmented_downloader import ConnectionPool, DEFAULT_HEADERS, READ_BLOCK_SIZE
+
+# Number of thumbnails fetched at the same time by a bulk download.
+DEFAULT_THUMBNAIL_FETCHERS = 16
+
+# Number of thumbnails converted at the same time. Pillow releases the GIL while it decodes,
+# resizes and encodes, so threads are enough.
+DEFAULT_PROCESS_WORKERS = os.cpu_count() or 4
+
+# File extension of each image format Pillow may report or be asked for.
+EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "GIF": "gif", "BMP": "bmp"}
+
+# Formats without an alpha channel, for which transparent images are flattened first.
+OPAQUE_FORMATS = ("JPEG", "BMP")
+
+
+def parse_image_format(text: str) -> str:
+    """
+    Parse an image format such as `png`, `jpg` or `webp` into Pillow's name for it.
+
+    :raises ValueError: If the format isn't supported.
+    """
+    image_format = text.strip().upper()
+    image_format = "JPEG" if image_format == "JPG" else image_format
+    if image_format not in EXTENSIONS:
+        raise ValueError(f"Unsupported image format '{text}', expected one of {', '.join(sorted(EXTENSIONS.values()))}")
+    return image_format
+
+
+def parse_thumbnail_size(text: str) -> tuple:
+    """
+    Parse a size such as `320x180` into (width, height).
+
+    :raises ValueError: If the text isn't a size.
+    """
+    width, separator, height = text.lower().partition("x")
+    if not separator or int(width) < 1 or int(height) < 1:
+        raise ValueError(f"Invalid size '{text}', expected WIDTHxHEIGHT")
+    return int(width), int(height)
+
+
+class ThumbnailPipeline:
+    """
+    Helper class responsible for fetching thumbnails in bulk and turning them into image files.
+
+    Thumbnails are fetched over kept-alive connections through the bandwidth governor and held
+    in memory; converting them to another format or size happens in a separate worker pool, so
+    fetching the next thumbnails never waits for the images already fetched. Each file is
+    written once, with the extension of its actual format.
+    """
+
+    def __init__(self, connections: int = DEFAULT_THUMBNAIL_FETCHERS, process_workers: int = DEFAULT_PROCESS_WORKERS) -> None:
+        """
+        :param connections: Number of idle connections kept open per host.
+        :param process_workers: Number of thumbnails converted at the same time.
+        """
+        self.pool = ConnectionPool(max_idle_per_host=connections)
+        self.process_workers = process_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def fetch(self, url: str, job_id=None) -> bytes:
+        """
+        Fetch a thumbnail into memory.
+
+        :param job_id: (optional) Job the transfer counts against in the governor.
+        :raises HTTPStatusError: If the server doesn't answer with the image.
+        """
+        with governor.connection():
+            response, release = self.pool.request("GET", url, headers=DEFAULT_HEADERS)
+            try:
+                if response.status != 200:
+                    raise HTTPStatusError(response.status, f"HTTP {response.status} fetching {url}")
+                chunks = []
+                while True:
+                    chunk = response.read(READ_BLOCK_SIZE)
+                    if not chunk:
+                        break
+                    governor.throttle(len(chunk), job_id)
+                    chunks.append(chunk)
+            except Exception:
+                release(reusable=False)
+                raise
+            release()
+        return b"".join(chunks)
+
+    def convert(self, data: bytes, image_format: str = None, size: tuple = None) -> tuple:
+        """
+        Decode a thumbnail in memory and, if asked, shrink it and re-encode it.
+
+        :param image_format: (optional) Pillow format to re-encode to, e.g. `PNG`. None keeps the original format.
+        :param size: (optional) (width, height) box the image is shrunk to fit, keeping its aspect ratio.
+        :return: Tuple of (image bytes, file extension).
+        """
+        # Pillow is only needed for thumbnails, so it isn't imported until one is converted.
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as img:
+            source_format = img.format
+            image_format = image_format or source_format
+            if image_format == source_format and (size is None or (img.width <= size[0] and img.height <= size[1])):
+                # Nothing to change: keep the bytes as they came.
+                return data, EXTENSIONS.get(source_format, source_format.lower())
+            if size:
+                img.thumbnail(size)
+            if image_format in OPAQUE_FORMATS and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            output = io.BytesIO()
+            img.save(output, format=image_format)
+        return output.getvalue(), EXTENSIONS[image_format]
+
+    def save(self, data: bytes, path_stem: str, image_format: str = None, size: tuple = None) -> str:
+        """
+        Convert a fetched thumbnail and write it to `path_stem` plus the extension of its format.
+
+        :return: Path of the written file.
+        """
+        image, extension = self.convert(data, image_format, size)
+        path = f"{path_stem}.{extension}"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as fh:
+            fh.write(image)
+        return path
+
+    def submit(self, fn, *args):
+        """Run `fn(*args)` in the conversion worker pool and return its future."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.process_workers, thread_name_prefix="thumbnail")
+            return self._executor.submit(fn, *args)
+
+
+# Pipeline shared by every thumbnail download of the process, so batches of thumbnail jobs reuse
+# the same connections and conversion workers.
+thumbnail_pipeline = ThumbnailPipeline()
@@ -1,16 +1,72 @@
+import asyncio
 import os
-from pytube import YouTube, Playlist
+import shutil
+import threading
+import time
 import subprocess
-import win32com.client
 import re
-from pytube.exceptions import VideoUnavailable
+from contextlib import aclosing
+from typing import TYPE_CHECKING
+from bandwidth_governor import governor
+from concurrent.futures import ThreadPoolExecutor
+from metadata_cache import metadata_cache, QualityMatrix
+from retry_policy import retry_policy
+from stream_index import stream_index_of
+from output_writer import output_writer
+from segmented_downloader import (SegmentedDownloader, AsyncConnectionPool, DEFAULT_CONNECTIONS, READ_BLOCK_SIZE,
+                                  gather_tasks, offload)
+
+# pytube and pywin32 are imported where they are first needed, so startup stays fast and
+# the module loads on platforms without pywin32.
+if TYPE_CHECKING:
+    from pytube import YouTube
+
+class DownloadCancelled(Exception):
+    """Raised from a progress callback to stop the download it reports on."""
+
+
+async def run_ffmpeg(cmd: list) -> int:
+    """
+    Run an ffmpeg command to completion as a subprocess of the download engine's event loop,
+    which stops it if its task is cancelled or the engine is shut down.
+
+    :return: The exit status, 0.
+    :raises subprocess.CalledProcessError: If ffmpeg failed.
+    """
+    from async_engine import download_engine
+    returncode = await download_engine.run_process(cmd)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
+
+
+def partial_path(path: str) -> str:
+    """
+    Name an output is written under in its folder until it is complete, e.g. `Title_720p.part.mp4`.
+    It keeps the extension, from which ffmpeg picks the container.
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}.part{extension}"
+
+
+def finish_output(partial_filename: str, output_filename: str) -> str:
+    """Move a complete output from its partial name onto its final one, replacing any earlier file there."""
+    output_writer.sync_path(partial_filename)
+    os.replace(partial_filename, output_filename)
+    return output_filename
+
+
+def discard_output(partial_filename: str) -> None:
+    if os.path.exists(partial_filename):
+        os.remove(partial_filename)
+
 
 class VideoStreamFetcher:
     """
     Helper class responsible for fetching video streams based on the desired quality from YouTube.
     """
     
-    def __init__(self, yt: YouTube, video_quality: str = None) -> None:
+    def __init__(self, yt: "YouTube", video_quality: str = None) -> None:
         """
         Initialize the fetcher with the YouTube video and desired quality.
 
@@ -23,7 +79,7 @@ class VideoStreamFetcher:
     def get_video_stream(self):
         """Returns the video stream corresponding to the desired quality."""
         try:
-            return self.yt.streams.filter(only_video=True, res=self.video_quality, file_extension="mp4").first()
+            return stream_index_of(self.yt).video_stream(self.video_quality)
         except Exception as e:
             print(f"Error fetching video stream of quality {self.video_quality}: {e}")
             return None
@@ -42,23 +98,20 @@ class VideoStreamFetcher:
 
 
 class AudioStreamFetcher:
-    def __init__(self, yt, video_quality):
+    def __init__(self, yt, video_quality, subtype=None):
+        """
+        :param yt: Instance of the YouTube video.
+        :param video_quality: Quality of the video the audio goes with. 1080p, 720p and None
+                              (audio on its own) get the best audio, lower qualities a lesser one.
+        :param subtype: (optional) Container to prefer, e.g. `mp4` for AAC or `webm` for Opus.
+        """
         self.yt = yt
         self.video_quality = video_quality
+        self.subtype = subtype
 
     def get_audio_stream(self):
         try:
-            if self.video_quality in ["1080p", "720p"]:
-                stream = self.yt.streams.filter(only_audio=True).order_by("abr").desc().first()
-            else:
-                audio_qualities = self.yt.streams.filter(only_audio=True).order_by("abr").desc()
-                stream = audio_qualities[2] if len(audio_qualities) > 2 else audio_qualities[-1]
-
-            # If the desired quality isn't found, get the best available audio quality
-            if not stream:
-                stream = self.yt.streams.filter(only_audio=True).order_by("abr").desc().first()
-            
-            return stream
+            return stream_index_of(self.yt).audio_stream(self.video_quality, self.subtype)
         except Exception as e:
             print(f"Error fetching audio stream: {e}")
             return None
@@ -68,22 +121,34 @@ class StreamDownloader:
     Helper class responsible for downloading a given stream.
     """
     
-    def __init__(self, folder: str) -> None:
+    def __init__(self, folder: str, connections: int = DEFAULT_CONNECTIONS) -> None:
         """
         Initialize the downloader with a destination folder.
 
         :param folder: Path to the destination folder.
+        :param connections: Number of connections each stream is fetched over.
+                            With 1, its ranges are fetched one after the other.
         """
         self.folder = folder
+        self.connections = connections
+        # Shared by every stream fetched through this downloader, e.g. the video and audio of one video.
+        self.pool = AsyncConnectionPool(max_idle_per_host=connections)
 
-
-    def download_stream(self, stream, prefix: str) -> str:
+    async def download_stream(self, stream, prefix: str, on_progress=None, hasher=None) -> str:
         """
         Download the provided stream with a given prefix and ensure a certain file extension.
 
+        The stream is fetched as parallel byte ranges by `SegmentedDownloader`, on the running
+        event loop, which resumes an interrupted download instead of starting over. A stream
+        whose size pytube doesn't know is first asked for it with a one-byte range. The callback
+        belongs to this call only and not to the shared `YouTube` object, so several streams of
+        the same video can download at the same time, and every chunk goes through the
+        bandwidth governor.
+
         :param stream: Stream to be downloaded.
         :param prefix: Prefix for the saved file.
-        :param file_extension: Desired file extension (without the dot). Default is None.
+        :param on_progress: (optional) Callback taking (stream, chunk, bytes_remaining), called on the loop.
+        :param hasher: (optional) `content_store.BlockHasher` fed the bytes as they arrive.
         :return: Path to the saved file.
         """
 
@@ -97,7 +162,21 @@ class StreamDownloader:
         new_filename = prefix + default_filename
         
         # Download the stream
-        return stream.download(output_path=normalized_folder, filename=new_filename)
+        os.makedirs(normalized_folder, exist_ok=True)
+        file_path = os.path.join(normalized_folder, new_filename)
+        segmented_downloader = SegmentedDownloader(connections=self.connections, pool=self.pool)
+        # pytube may ask the server for the size of a stream it doesn't know; that request blocks.
+        filesize = await offload(getattr, stream, "filesize")
+        if not filesize:
+            filesize = await retry_policy.retry_async(segmented_downloader.fetch_size, stream.url)
+        return await segmented_downloader.download(
+            stream.url, file_path, filesize,
+            on_progress=(lambda chunk, bytes_remaining: on_progress(stream, chunk, bytes_remaining)) if on_progress else None,
+            hasher=hasher)
+
+    def close(self) -> None:
+        """Close the connections kept alive for the streams of this downloader."""
+        self.pool.close()
 
 
 class FileMerger:
@@ -105,45 +184,258 @@ class FileMerger:
     Helper class responsible for merging video and audio files into a single file.
     """
     
-    def __init__(self, yt: YouTube, folder: str, video_quality: str) -> None:
+    def __init__(self, yt: "YouTube", folder: str, video_quality: str, metrics=None) -> None:
         """
         Initialize the merger with the YouTube video, destination folder, and video quality.
 
         :param yt: Instance of the YouTube video.
         :param folder: Path to the destination folder.
         :param video_quality: Quality of the video file to merge.
+        :param metrics: (optional) `metrics.JobMetrics` every ffmpeg run is recorded in.
         """
         self.yt = yt
         self.folder = folder
         self.video_quality = video_quality
+        self.metrics = metrics
+        # Set when the last `merge_streams` call stopped because a progress callback cancelled it.
+        self.cancelled = False
+
+    def output_filename(self, video_count: str = "") -> str:
+        """Return the path of the merged file, prefixed with its playlist number if any."""
+        valid_title = "".join([c for c in self.yt.title if c.isalpha() or c.isdigit() or c == ' ']).rstrip()
+        if video_count:
+            return os.path.join(self.folder, f"{video_count}_{valid_title}_{self.video_quality}.mp4")
+        return os.path.join(self.folder, f"{valid_title}_{self.video_quality}.mp4")
 
-    def merge(self, video_count: str = "", video_filename: str = "", audio_filename: str = "") -> None:
+    async def merge(self, video_count: str = "", video_filename: str = "", audio_filename: str = "") -> str:
         """
         Merge video and audio files into a single file.
 
+        :param video_count: (optional) Number of the video in its playlist, used as a filename prefix.
         :param video_filename: Path to the video file.
         :param audio_filename: Path to the audio file.
+        :return: Path to the merged file, or None if ffmpeg failed.
         """
-        valid_title = "".join([c for c in self.yt.title if c.isalpha() or c.isdigit() or c == ' ']).rstrip()
-        if video_count:
-            output_filename = os.path.join(self.folder, f"{video_count}_{valid_title}_{self.video_quality}.mp4")
-        else:
-            output_filename = os.path.join(self.folder, f"{valid_title}_{self.video_quality}.mp4")
+        output_filename = self.output_filename(video_count)
+        # ffmpeg writes to a partial file that replaces the output once complete, so an earlier,
+        # stale output is replaced rather than making ffmpeg refuse to overwrite it.
+        partial_filename = partial_path(output_filename)
         cmd = [
-            'ffmpeg',
+            'ffmpeg', '-y',
             '-i', video_filename,
             '-i', audio_filename,
             '-c:v', 'copy',
             '-c:a', 'copy',
-            output_filename
+            partial_filename
         ]
+        start = time.perf_counter()
+        returncode = None
+        finished = False
         try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
+            returncode = await run_ffmpeg(cmd)
+            output_filename = await offload(finish_output, partial_filename, output_filename)
+            finished = True
+        except (subprocess.CalledProcessError, OSError) as e:
+            returncode = getattr(e, "returncode", None)
             print(f"Error during merging video and audio: {e}")
-            
-        os.remove(video_filename)
-        os.remove(audio_filename)
+            output_filename = None
+        finally:
+            if self.metrics:
+                self.metrics.record_ffmpeg(returncode, time.perf_counter() - start, "files")
+            # Also when the merge is cancelled, so nothing is left behind for a released reservation.
+            if not finished:
+                discard_output(partial_filename)
+            for filename in (video_filename, audio_filename):
+                if os.path.exists(filename):
+                    os.remove(filename)
+        return output_filename
+
+    @staticmethod
+    def can_merge_streams(video_stream, audio_stream) -> bool:
+        """Return True if `merge_streams` can be used: inherited pipes, ffmpeg and known stream sizes."""
+        return (os.name == "posix" and shutil.which("ffmpeg") is not None
+                and bool(video_stream.filesize) and bool(audio_stream.filesize))
+
+    async def merge_streams(self, video_stream, audio_stream, video_count: str = "",
+                            on_video_progress=None, on_audio_progress=None, connections: int = DEFAULT_CONNECTIONS,
+                            video_hasher=None, audio_hasher=None) -> str:
+        """
+        Download the video and audio streams straight into ffmpeg through pipes, so the merged
+        file is produced in one pass without writing and re-reading temporary files.
+
+        ffmpeg reads each stream from a pipe it inherits (`-i pipe:<fd>`); the ranges are fetched
+        and written to the pipes by tasks of the running event loop. If a stream fails, the other
+        one is cancelled and ffmpeg is killed.
+
+        :param video_stream: Video stream to download.
+        :param audio_stream: Audio stream to download.
+        :param video_count: (optional) Number of the video in its playlist, used as a filename prefix.
+        :param on_video_progress: (optional) Callback taking (stream, chunk, bytes_remaining).
+        :param on_audio_progress: (optional) Callback taking (stream, chunk, bytes_remaining).
+        :param connections: Number of connections each stream is fetched over.
+        :param video_hasher: (optional) `content_store.BlockHasher` fed the video bytes as they stream through.
+        :param audio_hasher: (optional) `content_store.BlockHasher` fed the audio bytes as they stream through.
+        :return: Path to the merged file, or None if streaming failed and the caller should
+                 fall back to `merge` over downloaded files.
+        """
+        from async_engine import download_engine
+        output_filename = self.output_filename(video_count)
+        partial_filename = partial_path(output_filename)
+        os.makedirs(self.folder, exist_ok=True)
+        video_read, video_write = os.pipe()
+        audio_read, audio_write = os.pipe()
+        video_pipe, audio_pipe = open(video_write, "wb", buffering=0), open(audio_write, "wb", buffering=0)
+
+        cmd = [
+            'ffmpeg', '-y',
+            '-i', f'pipe:{video_read}',
+            '-i', f'pipe:{audio_read}',
+            '-c:v', 'copy',
+            '-c:a', 'copy',
+            partial_filename
+        ]
+        downloader = SegmentedDownloader(connections=connections)
+        errors = []
+        returncode = None
+        start = time.perf_counter()
+        try:
+            async with download_engine.process(cmd, pass_fds=(video_read, audio_read)) as process:
+                # ffmpeg holds its own copies of the read ends.
+                os.close(video_read)
+                os.close(audio_read)
+                video_read = audio_read = None
+                try:
+                    await gather_tasks(
+                        self._feed_pipe(video_pipe, video_stream, on_video_progress, downloader, video_hasher),
+                        self._feed_pipe(audio_pipe, audio_stream, on_audio_progress, downloader, audio_hasher))
+                except Exception as e:
+                    # Leaving the block kills ffmpeg, which would otherwise wait for the missing input.
+                    errors.append(e)
+                else:
+                    returncode = await process.wait()
+        except OSError as e:
+            errors.append(e)
+        except asyncio.CancelledError:
+            discard_output(partial_filename)
+            raise
+        finally:
+            for fd in (video_read, audio_read):
+                if fd is not None:
+                    os.close(fd)
+            video_pipe.close()
+            audio_pipe.close()
+            downloader.pool.close()
+        if self.metrics:
+            self.metrics.record_ffmpeg(returncode, time.perf_counter() - start, "pipes")
+
+        self.cancelled = any(isinstance(error, DownloadCancelled) for error in errors)
+        if returncode != 0 or errors:
+            print(f"Error during streaming merge of video and audio: ffmpeg exit status {returncode}, {errors}")
+            discard_output(partial_filename)
+            return None
+        return await offload(finish_output, partial_filename, output_filename)
+
+    @staticmethod
+    async def _feed_pipe(pipe, stream, on_progress, downloader, hasher=None) -> None:
+        """Download `stream` in order into the write end of the pipe read by ffmpeg, and close it."""
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, pipe)
+        writer = asyncio.StreamWriter(transport, protocol, None, loop)
+        try:
+            bytes_remaining = stream.filesize
+            async with aclosing(downloader.iter_chunks(stream.url, stream.filesize)) as segments:
+                async for segment in segments:
+                    if hasher:
+                        await offload(hasher.update, stream.filesize - bytes_remaining, segment)
+                    view = memoryview(segment)
+                    for offset in range(0, len(view), READ_BLOCK_SIZE):
+                        chunk = view[offset:offset + READ_BLOCK_SIZE]
+                        writer.write(chunk)
+                        bytes_remaining -= len(chunk)
+                        if on_progress:
+                            on_progress(stream, chunk, bytes_remaining)
+                        # Waits while ffmpeg is behind; raises if it exited.
+                        await writer.drain()
+        finally:
+            writer.close()
+
+
+# Audio formats the audio strategy produces: file extension, container of the YouTube streams
+# that can be stream-copied into it, and ffmpeg's encoder settings for the other streams.
+AUDIO_FORMATS = {
+    "m4a": ("mp4", ["-c:a", "aac", "-b:a", "192k"]),
+    "opus": ("webm", ["-c:a", "libopus", "-b:a", "128k"]),
+    "mp3": (None, ["-c:a", "libmp3lame", "-q:a", "2"]),
+}
+DEFAULT_AUDIO_FORMAT = "m4a"
+
+
+class AudioConverter:
+    """
+    Helper class responsible for turning a downloaded audio stream into an audio file, by stream
+    copy when the stream's codec fits the format and by transcoding otherwise.
+    """
+
+    def __init__(self, yt: "YouTube", folder: str, audio_format: str = DEFAULT_AUDIO_FORMAT, metrics=None) -> None:
+        """
+        :param yt: Instance of the YouTube video.
+        :param folder: Path to the destination folder.
+        :param audio_format: One of `AUDIO_FORMATS`.
+        :param metrics: (optional) `metrics.JobMetrics` every ffmpeg run is recorded in.
+        """
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format '{audio_format}', expected one of {', '.join(AUDIO_FORMATS)}")
+        self.yt = yt
+        self.folder = folder
+        self.audio_format = audio_format
+        self.metrics = metrics
+
+    @property
+    def stream_subtype(self) -> str:
+        """Container of the streams that can be copied without transcoding, or None."""
+        return AUDIO_FORMATS[self.audio_format][0]
+
+    def output_filename(self, video_count: str = "") -> str:
+        """Return the path of the audio file, prefixed with its playlist number if any."""
+        valid_title = "".join([c for c in self.yt.title if c.isalpha() or c.isdigit() or c == ' ']).rstrip()
+        if video_count:
+            return os.path.join(self.folder, f"{video_count}_{valid_title}.{self.audio_format}")
+        return os.path.join(self.folder, f"{valid_title}.{self.audio_format}")
+
+    async def convert(self, audio_filename: str, subtype: str, video_count: str = "") -> str:
+        """
+        Convert a downloaded audio stream, then remove it.
+
+        :param audio_filename: Path to the downloaded stream.
+        :param subtype: Container of the downloaded stream, e.g. `mp4`.
+        :param video_count: (optional) Number of the video in its playlist, used as a filename prefix.
+        :return: Path to the audio file, or None if ffmpeg failed.
+        """
+        output_filename = self.output_filename(video_count)
+        copy = subtype == self.stream_subtype
+        codec = ["-c:a", "copy"] if copy else AUDIO_FORMATS[self.audio_format][1]
+        # Like the merges, ffmpeg writes a partial file that replaces any earlier output once complete.
+        partial_filename = partial_path(output_filename)
+        cmd = ['ffmpeg', '-y', '-i', audio_filename, '-vn'] + codec + [partial_filename]
+        start = time.perf_counter()
+        returncode = None
+        finished = False
+        try:
+            returncode = await run_ffmpeg(cmd)
+            output_filename = await offload(finish_output, partial_filename, output_filename)
+            finished = True
+        except (subprocess.CalledProcessError, OSError) as e:
+            returncode = getattr(e, "returncode", None)
+            print(f"Error during converting the audio to {self.audio_format}: {e}")
+            output_filename = None
+        finally:
+            if self.metrics:
+                self.metrics.record_ffmpeg(returncode, time.perf_counter() - start, "copy" if copy else "transcode")
+            if not finished:
+                discard_output(partial_filename)
+            if os.path.exists(audio_filename):
+                os.remove(audio_filename)
+        return output_filename
 
 class CombinedProgress:
     """
@@ -165,7 +457,7 @@ class CombinedProgress:
                                  frequent and minimal updates.
     """
     
-    def __init__(self, video_stream, audio_stream, progress_callback) -> None:
+    def __init__(self, video_stream, audio_stream, progress_callback, job_progress=None) -> None:
         """
         Initialize the progress tracker with video and audio streams, and a progress callback.
 
@@ -173,6 +465,8 @@ class CombinedProgress:
         :param audio_stream: Audio stream to track.
         :param progress_callback: Callback function that gets triggered as download progresses.
                                   This callback function typically updates UI components.
+        :param job_progress: (optional) `progress.JobProgress` that gets every combined byte count,
+                             without the 5% threshold; it only queues the count for the UI to pick up.
         """
         self.video_stream = video_stream
         self.audio_stream = audio_stream
@@ -180,7 +474,9 @@ class CombinedProgress:
         self.audio_bytes = 0
         self.total_bytes = video_stream.filesize + audio_stream.filesize
         self.progress_callback = progress_callback
+        self.job_progress = job_progress
         self.last_updated_percentage = 0
+        self._lock = threading.Lock()
 
     def video_progress(self, stream, chunk, bytes_remaining) -> None:
         """
@@ -216,32 +512,164 @@ class CombinedProgress:
         from the last reported percentage). This method is private and should not be 
         called outside the context of this class.
         """
-        combined_bytes_downloaded = self.video_bytes + self.audio_bytes
-        combined_percentage = (combined_bytes_downloaded / self.total_bytes) * 100
+        # Both streams report from their own threads, so the check-and-set below is locked.
+        with self._lock:
+            combined_bytes_downloaded = self.video_bytes + self.audio_bytes
+            combined_percentage = (combined_bytes_downloaded / self.total_bytes) * 100
+            if self.job_progress:
+                self.job_progress.update(combined_bytes_downloaded)
 
-        # Update only if the difference in progress is more than 5%.
-        if abs(combined_percentage - self.last_updated_percentage) > 5:
-            self.progress_callback(combined_percentage)
-            self.last_updated_percentage = combined_percentage
+            # Update only if the difference in progress is more than 5%.
+            if abs(combined_percentage - self.last_updated_percentage) > 5:
+                self.progress_callback(combined_percentage)
+                self.last_updated_percentage = combined_percentage
 
 
+class PlaylistProgress:
+    """
+    Helper class responsible for aggregating the progress of the videos of a playlist
+    that are downloaded in parallel into a single playlist-wide percentage.
+
+    Every video counts for the same share of the playlist, whatever its size, since the
+    sizes of the videos that have not started yet are unknown. Videos can be added while
+    others are downloading, for playlists whose later pages are still being enumerated.
+    """
+
+    def __init__(self, video_count: int, progress_callback) -> None:
+        """
+        Initialize the tracker for a playlist of `video_count` videos.
+
+        :param video_count: Number of videos in the playlist, or known so far.
+        :param progress_callback: (optional) Callback taking (stream, chunk, percentage), called
+                                  with the playlist-wide percentage.
+        """
+        self.video_percentages = [0.0] * video_count
+        self.progress_callback = progress_callback
+        self.last_updated_percentage = 0
+        self._lock = threading.Lock()
+
+    def add_video(self) -> int:
+        """Count one more video in the playlist and return its index."""
+        with self._lock:
+            self.video_percentages.append(0.0)
+            return len(self.video_percentages) - 1
+
+    def video_progress(self, index: int):
+        """Return a progress callback for the video at position `index` of the playlist."""
+        def callback(stream, chunk, percentage):
+            self._set_percentage(index, percentage)
+        return callback
+
+    def video_finished(self, index: int) -> None:
+        """Count the video at `index` as done, whether it succeeded or failed."""
+        self._set_percentage(index, 100)
+
+    def _set_percentage(self, index: int, percentage: float) -> None:
+        with self._lock:
+            self.video_percentages[index] = percentage
+            playlist_percentage = sum(self.video_percentages) / len(self.video_percentages)
+
+            # Same 5% threshold as CombinedProgress, but always report the end of the playlist.
+            if abs(playlist_percentage - self.last_updated_percentage) > 5 or \
+                    (playlist_percentage == 100 and self.last_updated_percentage != 100):
+                self.last_updated_percentage = playlist_percentage
+                if self.progress_callback:
+                    self.progress_callback(None, None, playlist_percentage)
+
+
+def validate_link(strategy_type: str, link: str):
+    """Return an error message if the link doesn't suit the download strategy, otherwise None."""
+    video_pattern = r'https?://www\.youtube\.com/watch\?v=[^&]+'
+    if re.match(video_pattern, link) and strategy_type == "playlist":
+        return "The provided link is a video link, not a playlist!"
+    if "youtube.com/playlist?list=" in link and strategy_type == "video":
+        return "The provided link is a playlist link, not a video!"
+    return None
+
 def get_youtube_object(link: str):
-    """Return a YouTube object if the link is a valid YouTube link, otherwise None."""
+    """Return the (cached) metadata of the video if the link is a valid YouTube link, otherwise None."""
     video_pattern = r'https?://www\.youtube\.com/watch\?v=[^&]+'
     if re.match(video_pattern, link):
-        return YouTube(link)
+        return metadata_cache.get_video(link)
     return None
 
 def get_playlist_first_video(link: str):
     """Return the first video in a playlist, if the link is a valid playlist link, otherwise None."""
     if "youtube.com/playlist?list=" in link:
-        playlist = Playlist(link)
-        if playlist.video_urls:
-            return YouTube(playlist.video_urls[0])
+        # Only the first page of the playlist is needed; the rest is paged in the background.
+        first_url = next(iter(metadata_cache.stream_playlist(link)), None)
+        if first_url:
+            return metadata_cache.get_video(first_url)
     return None
 
+# Number of playlist videos whose stream manifests are fetched at the same time when probing qualities.
+DEFAULT_PROBE_WORKERS = 8
+
+def mp4_qualities(yt) -> list:
+    """Return the resolutions the video can be downloaded in as .mp4, video-only or progressive, lowest first."""
+    if not VideoStreamFetcher(yt).get_all_streams():
+        return []
+    return stream_index_of(yt).resolutions("mp4")
+
+def probe_playlist_qualities(link: str, max_workers: int = DEFAULT_PROBE_WORKERS) -> QualityMatrix:
+    """
+    Build the quality matrix of a playlist by fetching the stream manifests of all its videos,
+    up to `max_workers` at once, starting as soon as the first page of entries is known.
+    Each lookup goes through the retry policy and holds one of the bandwidth governor's
+    connections, like the downloads' own lookups.
+
+    The matrix is cached, and so is every manifest fetched, with room kept in memory for all
+    of them, so downloading the playlist afterwards doesn't resolve its videos again.
+    """
+    def resolve(url):
+        with governor.connection():
+            return metadata_cache.get_video(url)
+
+    def probe(link):
+        enumeration = metadata_cache.stream_playlist(link)
+        # Retries are submitted again when due, so the pool stays open until every lookup has ended.
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = []
+            for count, url in enumerate(enumeration, start=1):
+                metadata_cache.fit(count)
+                futures.append((url, retry_policy.submit(executor, resolve, url, on_retry=lambda error, delay, url=url: print(
+                    f"Retrying probe of {url} in {delay:.1f}s after: {error}"))))
+            qualities, failed = {}, []
+            for url, future in futures:
+                try:
+                    qualities[url] = mp4_qualities(future.result())
+                except Exception as e:
+                    print(f"Could not probe {url}: {e}")
+                    failed.append(url)
+        finally:
+            executor.shutdown(wait=False)
+        return QualityMatrix(enumeration.playlist_id, qualities, failed)
+    return metadata_cache.get_quality_matrix(link, probe)
+
+def get_quality_choices(link: str) -> list:
+    """
+    Return the qualities to offer for a link. For a playlist, qualities every video has come
+    first, followed by the others labelled with how many videos have them, e.g. `1080p (12 of 15 videos)`.
+    """
+    if "youtube.com/playlist?list=" not in link:
+        return get_available_qualities(link)
+    try:
+        matrix = probe_playlist_qualities(link)
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        return []
+    universal = matrix.universal
+    partial = [quality for quality in matrix.available if quality not in universal]
+    return universal + [f"{quality} ({matrix.coverage(quality)} of {len(matrix.qualities)} videos)" for quality in partial]
+
+def quality_from_choice(choice: str) -> str:
+    """Return the quality of a choice made from `get_quality_choices`, e.g. `1080p` for `1080p (12 of 15 videos)`."""
+    return choice.split(" ")[0] if choice else choice
+
 def get_available_qualities(link: str) -> list:
     """Retrieve available video qualities for a given YouTube link, specifically for the .mp4 file extension."""
+    from pytube.exceptions import VideoUnavailable
 
     yt = get_youtube_object(link) or get_playlist_first_video(link)
     
@@ -250,14 +678,8 @@ def get_available_qualities(link: str) -> list:
         return []
     
     try:
-        fetcher = VideoStreamFetcher(yt)
-        all_streams = fetcher.get_all_streams()
-
-        # We're only interested in .mp4 streams that have video content, so we filter those and extract the resolution.
-        mp4_qualities = [stream.resolution for stream in all_streams if stream.video_codec and not stream.audio_codec and stream.subtype == "mp4"]
-
-        # Sorting and de-duping qualities
-        return sorted(list(set(mp4_qualities)), key=lambda x: int(x[:-1]))
+        # We're only interested in .mp4 streams that have video content, sorted and de-duplicated.
+        return mp4_qualities(yt)
     
     except VideoUnavailable:
         print("This video is unavailable.")
@@ -267,7 +689,11 @@ def get_available_qualities(link: str) -> list:
 
 
 def refresh_folder(folder_path):
-    """Refresh a specific folder in Windows Explorer."""
+    """Refresh a specific folder in Windows Explorer. Does nothing where pywin32 isn't available."""
+    try:
+        import win32com.client
+    except ImportError:
+        return
     try:
         shell = win32com.client.Dispatch("Shell.Application")
         folder = shell.NameSpace(folder_path)